@@ -0,0 +1,396 @@
+"""End-to-end benchmarks of the consumers and processors against the
+local stand-ins in `benchmarks.fakes`. No network services are needed.
+
+Each scenario (a consumer and a processor) runs in a fresh python process,
+so that the peak RSS of one doesn't hide the others'. Timings are
+collected from the feed readers and processors with a statsd sink, which
+works across the processes of the multiprocess consumer too.
+
+The s3 scenarios measure boto3 more than the processor. Each upload costs
+boto3 a few milliseconds of CPU time. The upload threads share the GIL, so
+on localhost the processor manages about as many uploads per second as a
+bare `put_object` loop against the stand-in. Don't read those numbers as
+the processor's throughput against s3.
+
+Run with::
+
+    python -m benchmarks.e2e --changes 20000 --doc-size 2048 --limit 500
+
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import cchain
+
+from . import fakes
+
+
+logger = logging.getLogger(__name__)
+
+
+CONSUMERS = collections.OrderedDict([
+    ('base', cchain.consumers.base.BaseChangesConsumer),
+    ('mp', cchain.consumers.mp.MPChangesConsumer),
+])
+
+PROCESSORS = ('none', 'es', 'couchdb', 's3', )
+
+
+class MemorySeqTracker(cchain.seqtrackers.base.BaseSeqTracker):
+
+    def __init__(self):
+        self._seq = ''
+
+    def put_seq(self, seq):
+        self._seq = seq
+
+    def get_seq(self):
+        return self._seq
+
+    def cleanup(self):
+        pass
+
+
+class StatsdCollector(object):
+    """Receives statsd lines over udp and keeps the timings in memory.
+
+    """
+
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.settimeout(0.1)
+        self._stopped = threading.Event()
+        self.timings = collections.defaultdict(list)
+        self.counters = collections.Counter()
+
+        self._thread = threading.Thread(target=self._receive)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    def _receive(self):
+        while not self._stopped.is_set():
+            try:
+                data = self._socket.recv(65536)
+            except socket.timeout:
+                continue
+
+            name, rest = data.decode('utf-8').split(':', 1)
+            value, metric_type = rest.split('|', 1)
+            # Drop the prefix.
+            name = name.split('.', 1)[-1]
+
+            if metric_type == 'ms':
+                self.timings[name].append(float(value))
+            elif metric_type == 'c':
+                self.counters[name] += int(value)
+
+    def stop(self):
+        # Let the last lines arrive.
+        time.sleep(0.2)
+        self._stopped.set()
+        self._thread.join()
+        self._socket.close()
+
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percentile / 100.0))
+    return values[index]
+
+
+def get_processor(name, server_url, metrics):
+    if name == 'none':
+        return cchain.processors.base.BaseDocChangesProcessor(
+            metrics=metrics
+        )
+
+    if name == 'es':
+        return cchain.processors.es.SimpleESChangesProcessor(
+            [server_url],
+            'benchmark',
+            'doc',
+            metrics=metrics
+        )
+
+    if name == 'couchdb':
+        return cchain.processors.couchdb.SimpleCouchdbChangesProcessor(
+            server_url,
+            'target',
+            metrics=metrics
+        )
+
+    if name == 's3':
+        # Point boto3 at the stand-in.
+        os.environ.update({
+            'AWS_ACCESS_KEY_ID': 'benchmark',
+            'AWS_SECRET_ACCESS_KEY': 'benchmark',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+            'AWS_ENDPOINT_URL_S3': server_url,
+            'AWS_REQUEST_CHECKSUM_CALCULATION': 'when_required',
+        })
+        return cchain.processors.s3.SimpleS3ChangesProcessor(
+            'benchmark',
+            max_workers=8,
+            metrics=metrics
+        )
+
+    raise ValueError('Unknown processor: %s' % name)
+
+
+def get_expected_persisted(processor_name, changes):
+    """Returns the number of documents the stand-ins should receive when
+    the whole feed is persisted. The processors don't coalesce changes, so
+    every change is persisted, deletions included; the base processor
+    persists nothing.
+
+    """
+
+    if processor_name == 'none':
+        return 0
+
+    return changes.change_count
+
+
+def get_peak_rss():
+    """Returns the peak RSS of this process and its children, in MB.
+
+    """
+
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+    # Linux reports kilobytes, macosx bytes.
+    if sys.platform == 'darwin':
+        peak_rss /= 1024
+
+    return peak_rss / 1024.0
+
+
+def run_scenario(consumer_name, processor_name, args):
+    """Consumes the whole synthetic feed once.
+
+    :returns: a dict with the results.
+
+    """
+
+    changes = fakes.SyntheticChanges(
+        change_count=args.changes,
+        doc_size=args.doc_size,
+        update_ratio=args.update_ratio,
+        delete_ratio=args.delete_ratio,
+        heartbeat_every=args.heartbeat_every
+    )
+
+    fake_server = fakes.FakeServer(changes)
+    fake_server.start()
+
+    collector = StatsdCollector()
+    metrics = cchain.metrics.statsd.StatsdMetricsSink(
+        '127.0.0.1',
+        collector.port,
+        prefix='benchmark'
+    )
+
+    processor = get_processor(processor_name, fake_server.url, metrics)
+
+    consumer = CONSUMERS[consumer_name](
+        fake_server.url,
+        'source',
+        limit=args.limit,
+        flush_interval=args.flush_interval,
+        processor=processor,
+        seqtracker=MemorySeqTracker(),
+        metrics=metrics
+    )
+
+    start = time.perf_counter()
+    consumer.consume()
+    elapsed = time.perf_counter() - start
+
+    cleanup = getattr(processor, 'cleanup', None)
+    if cleanup is not None:
+        cleanup()
+
+    collector.stop()
+    fake_server.stop()
+
+    result = {
+        'consumer': consumer_name,
+        'processor': processor_name,
+        'changes': args.changes,
+        'feed_mb': changes.byte_count / 1024.0 / 1024.0,
+        'seconds': elapsed,
+        'peak_rss_mb': get_peak_rss(),
+        'batches': collector.counters['batches'],
+        # Consumers log failures and exit, so check what actually arrived.
+        'persisted': fake_server.persisted_count,
+        'expected_persisted': get_expected_persisted(processor_name, changes),
+    }
+
+    if result['persisted'] != result['expected_persisted']:
+        # The throughput of a run that didn't persist everything means
+        # nothing.
+        result['error'] = 'persisted %d of %d changes' % (
+            result['persisted'],
+            result['expected_persisted'],
+        )
+        return result
+
+    result['changes_per_second'] = args.changes / elapsed
+
+    for stage in ('process_changes', 'persist_changes', 'put_seq', ):
+        timings = collector.timings.get(stage)
+        if timings:
+            result['%s_p50_ms' % stage] = get_percentile(timings, 50)
+            result['%s_p95_ms' % stage] = get_percentile(timings, 95)
+
+    return result
+
+
+def print_results(results):
+    columns = [
+        ('consumer', '%-8s', 8),
+        ('processor', '%-9s', 9),
+        ('changes_per_second', '%10.0f', 10),
+        ('persisted', '%9d', 9),
+        ('seconds', '%8.2f', 8),
+        ('peak_rss_mb', '%8.1f', 8),
+        ('process_changes_p50_ms', '%10.2f', 10),
+        ('persist_changes_p50_ms', '%10.2f', 10),
+        ('persist_changes_p95_ms', '%10.2f', 10),
+        ('put_seq_p50_ms', '%8.3f', 8),
+    ]
+    headers = [
+        'consumer', 'processor', 'changes/s', 'persisted', 'seconds', 'rss MB',
+        'proc p50', 'pers p50', 'pers p95', 'seq p50',
+    ]
+
+    print(' '.join(
+        header.rjust(width)
+        for header, (key, format, width) in zip(headers, columns)
+    ))
+
+    for result in results:
+        if 'error' in result:
+            print('%-8s %-9s failed: %s' % (
+                result['consumer'],
+                result['processor'],
+                result['error'],
+            ))
+            continue
+
+        cells = []
+        for key, format, width in columns:
+            value = result.get(key)
+            if value is None:
+                cells.append('-'.rjust(width))
+            else:
+                cells.append(format % value)
+        print(' '.join(cells))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+
+    parser.add_argument('--changes', type=int, default=10000)
+    parser.add_argument('--doc-size', type=int, default=1024)
+    parser.add_argument('--update-ratio', type=float, default=0.2)
+    parser.add_argument('--delete-ratio', type=float, default=0.05)
+    parser.add_argument('--heartbeat-every', type=int, default=0)
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--flush-interval', type=float, default=10)
+    parser.add_argument(
+        '--consumers',
+        default=','.join(CONSUMERS),
+        help='comma separated, from: %s' % ', '.join(CONSUMERS)
+    )
+    parser.add_argument(
+        '--processors',
+        default=','.join(PROCESSORS),
+        help='comma separated, from: %s' % ', '.join(PROCESSORS)
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='print the results as json lines'
+    )
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    if args.scenario:
+        consumer_name, processor_name = args.scenario.split(':')
+        result = run_scenario(consumer_name, processor_name, args)
+        print(json.dumps(result))
+        return
+
+    argv = sys.argv[1:] if argv is None else argv
+
+    results = []
+
+    for consumer_name in args.consumers.split(','):
+        for processor_name in args.processors.split(','):
+            process = subprocess.run(
+                [
+                    sys.executable,
+                    '-m',
+                    'benchmarks.e2e',
+                    '--scenario',
+                    '%s:%s' % (consumer_name, processor_name),
+                ] + argv,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+
+            if process.returncode:
+                # Report the failure and carry on with the other scenarios.
+                stderr_lines = process.stderr.decode('utf-8').splitlines()
+                result = {
+                    'consumer': consumer_name,
+                    'processor': processor_name,
+                    'error': stderr_lines[-1] if stderr_lines else '',
+                }
+            else:
+                result = json.loads(
+                    process.stdout.decode('utf-8').splitlines()[-1]
+                )
+
+            results.append(result)
+
+            if args.json:
+                print(json.dumps(result))
+                sys.stdout.flush()
+
+    if not args.json:
+        print_results(results)
+
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
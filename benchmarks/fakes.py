@@ -0,0 +1,334 @@
+"""Local stand-ins for couchdb, elasticsearch and s3, for benchmarking
+consumers and processors without any network services.
+
+A single `FakeServer` answers all of them on one port:
+
+- `HEAD /<source>` and `POST|GET /<source>/_changes`: a continuous
+  _changes feed of synthetic changes, closed after the last one.
+- `HEAD /<target>`, `POST /<target>/_all_docs` and
+  `POST /<target>/_bulk_docs`: an empty target database that accepts
+  every write.
+- `POST /_bulk` and `POST /<index>/_bulk`: an es bulk endpoint that
+  accepts every operation.
+- `PUT /<bucket>/<key>`: an s3 bucket that accepts every object.
+
+"""
+
+import hashlib
+import json
+import logging
+import random
+import threading
+import urllib.parse
+
+from http import server
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyntheticChanges(object):
+    """Generates a list of serialized change lines up front, so that
+    serving them costs as little as possible.
+
+    """
+
+    def __init__(
+        self,
+        change_count=10000,
+        doc_size=1024,
+        update_ratio=0.2,
+        delete_ratio=0.05,
+        heartbeat_every=0,
+        seed=0
+    ):
+        """
+
+        :param change_count: the number of changes in the feed.
+        :param doc_size: the approximate size, in bytes, of each document.
+        :param update_ratio: the fraction of changes that update an
+            existing document rather than create a new one.
+        :param delete_ratio: the fraction of changes that delete an
+            existing document.
+        :param heartbeat_every: if set, a heartbeat (empty line) is sent
+            after every this many changes.
+        :param seed: the seed of the random generator, so that runs with
+            the same arguments get the same feed.
+
+        """
+
+        self.change_count = change_count
+        self.heartbeat_every = heartbeat_every
+
+        rng = random.Random(seed)
+        # Maps the ids of live documents to their rev generations.
+        revs = {}
+        live_ids = []
+        lines = []
+
+        for seq in range(1, change_count + 1):
+            roll = rng.random()
+
+            if live_ids and roll < delete_ratio + update_ratio:
+                index = rng.randrange(len(live_ids))
+                doc_id = live_ids[index]
+                deleted = roll < delete_ratio
+                if deleted:
+                    live_ids[index] = live_ids[-1]
+                    live_ids.pop()
+            else:
+                doc_id = 'doc-%08d' % seq
+                deleted = False
+                live_ids.append(doc_id)
+
+            generation = revs.pop(doc_id, 0) + 1
+            rev = '%d-%s' % (
+                generation,
+                hashlib.md5(('%s%d' % (doc_id, seq)).encode()).hexdigest(),
+            )
+
+            if deleted:
+                doc = {
+                    '_id': doc_id,
+                    '_rev': rev,
+                    '_deleted': True,
+                }
+            else:
+                revs[doc_id] = generation
+                doc = self.get_doc(doc_id, rev, doc_size, rng)
+
+            change_line = {
+                'seq': seq,
+                'id': doc_id,
+                'changes': [{'rev': rev}],
+                'doc': doc,
+            }
+
+            if deleted:
+                change_line['deleted'] = True
+
+            lines.append(json.dumps(change_line).encode('utf-8') + b'\n')
+
+        self.lines = lines
+        self.byte_count = sum(len(line) for line in lines)
+
+    def get_doc(self, doc_id, rev, doc_size, rng):
+        doc = {
+            '_id': doc_id,
+            '_rev': rev,
+            'type': rng.choice(['user', 'order', 'product']),
+            'count': rng.randint(0, 1000),
+            'tags': ['tag-%d' % rng.randint(0, 50) for _ in range(3)],
+        }
+
+        padding = doc_size - len(json.dumps(doc))
+        if padding > 0:
+            doc['body'] = ''.join(
+                rng.choice('abcdefghijklmnopqrstuvwxyz ')
+                for _ in range(padding)
+            )
+
+        return doc
+
+    def iter_lines(self, since=0):
+        for seq, line in enumerate(self.lines[since:], since + 1):
+            yield line
+
+            if self.heartbeat_every and seq % self.heartbeat_every == 0:
+                yield b'\n'
+
+        yield (
+            json.dumps({'last_seq': self.change_count}).encode('utf-8') +
+            b'\n'
+        )
+
+
+class FakeServerHandler(server.BaseHTTPRequestHandler):
+
+    # Keeps connections alive, and answers `Expect: 100-continue` at once
+    # (boto3 waits a second for it otherwise).
+    protocol_version = 'HTTP/1.1'
+    # Headers and bodies are written separately; don't let Nagle's
+    # algorithm delay the bodies.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        # The es client refuses to talk to servers without it.
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def get_path(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [
+            urllib.parse.unquote(part) for part in url.path.split('/') if part
+        ]
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        return parts, query
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        parts, query = self.get_path()
+
+        if parts[-1:] == ['_changes']:
+            return self.serve_changes(query)
+
+        if not parts:
+            # The es client asks for the server info.
+            return self.send_json({
+                'version': {'number': '9.0.0'},
+                'tagline': 'You Know, for Search',
+            })
+
+        self.send_json({'error': 'not_found'}, status=404)
+
+    def do_POST(self):
+        parts, query = self.get_path()
+        body = self.read_body()
+
+        if parts[-1:] == ['_changes']:
+            return self.serve_changes(query)
+
+        if parts[-1:] == ['_bulk']:
+            return self.serve_es_bulk(body)
+
+        if parts[-1:] == ['_all_docs']:
+            keys = json.loads(body)['keys']
+            return self.send_json({
+                'rows': [{'key': key, 'error': 'not_found'} for key in keys],
+            })
+
+        if parts[-1:] == ['_bulk_docs']:
+            docs = json.loads(body)['docs']
+            self.server.count_persisted(len(docs))
+            return self.send_json([
+                {'ok': True, 'id': doc['_id'], 'rev': '1-0'} for doc in docs
+            ], status=201)
+
+        self.send_json({'error': 'not_found'}, status=404)
+
+    def do_PUT(self):
+        parts, query = self.get_path()
+        body = self.read_body()
+
+        if parts[-1:] == ['_bulk']:
+            # Newer es clients send bulk requests with PUT.
+            return self.serve_es_bulk(body)
+
+        # Anything else is an s3 upload.
+        self.server.count_persisted(1)
+
+        self.send_response(200)
+        self.send_header('ETag', '"%s"' % hashlib.md5(body).hexdigest())
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def serve_changes(self, query):
+        since = int(query.get('since') or 0)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        # The feed ends when the connection is closed.
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        for line in self.server.changes.iter_lines(since):
+            self.wfile.write(line)
+
+    def serve_es_bulk(self, body):
+        items = []
+
+        for line in body.splitlines():
+            if not line:
+                continue
+
+            action = json.loads(line)
+            if len(action) != 1:
+                # A document, following an index or update action.
+                continue
+
+            (op_type, op_data), = action.items()
+            if op_type not in ('index', 'create', 'update', 'delete'):
+                continue
+
+            items.append({
+                op_type: {
+                    '_id': op_data.get('_id'),
+                    '_index': op_data.get('_index'),
+                    'status': 200,
+                },
+            })
+
+        self.server.count_persisted(len(items))
+
+        self.send_json({
+            'took': 1,
+            'errors': False,
+            'items': items,
+        })
+
+
+class FakeServer(server.ThreadingHTTPServer):
+    """Serves the fake endpoints on localhost, in a daemon thread.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, changes, port=0):
+        """
+
+        :param changes: a `SyntheticChanges` instance to serve.
+        :param port: the port to listen on; a free one by default.
+
+        """
+
+        server.ThreadingHTTPServer.__init__(
+            self,
+            ('127.0.0.1', port),
+            FakeServerHandler
+        )
+
+        self.changes = changes
+        self._lock = threading.Lock()
+        self.persisted_count = 0
+
+    def count_persisted(self, count):
+        """Counts documents written to any of the stand-ins.
+
+        """
+
+        with self._lock:
+            self.persisted_count += count
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
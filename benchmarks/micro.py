@@ -0,0 +1,397 @@
+"""Micro-benchmarks of the processors' per-document hot paths, compared
+against stored baselines.
+
+Each benchmark runs on batches of generated documents of several shapes,
+from small flat documents to deeply nested and multi-megabyte ones, and
+reports the best CPU time per document out of several runs. Nothing but
+the processors' own code is timed: requests to databases are stubbed out.
+
+With `--check`, a benchmark regresses when it is slower than its baseline
+by more than the threshold. Baselines depend on the machine and python
+version, so none are shipped; save them on the machine you compare on::
+
+    python -m benchmarks.micro --save     # record the baselines
+    python -m benchmarks.micro --check    # compare, exit 1 on regressions
+
+"""
+
+import argparse
+import collections
+import gc
+import json
+import logging
+import os
+import sys
+import time
+
+from unittest import mock
+
+import cchain
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'baselines.json'
+)
+
+# Maps shape names to (batch size, document factory) tuples.
+SHAPES = collections.OrderedDict()
+
+
+def shape(name, batch_size):
+    def register(make_doc):
+        SHAPES[name] = (batch_size, make_doc, )
+        return make_doc
+    return register
+
+
+@shape('flat-small', 1000)
+def make_flat_small_doc(i):
+    return {
+        'type': 'user',
+        'name': 'user %d' % i,
+        'email': 'user%d@example.com' % i,
+        'age': i % 90,
+        'active': i % 2 == 0,
+    }
+
+
+@shape('flat-wide', 200)
+def make_flat_wide_doc(i):
+    return dict(
+        ('field_%03d' % field, 'value %d %d' % (i, field))
+        for field in range(200)
+    )
+
+
+@shape('nested-deep', 200)
+def make_nested_deep_doc(i):
+    doc = {'leaf': i}
+    for depth in range(20):
+        doc = {
+            'level': depth,
+            'items': [depth, 'x' * 10, {'n': i}],
+            'child': doc,
+        }
+    return doc
+
+
+@shape('large-2mb', 3)
+def make_large_doc(i):
+    return {
+        'type': 'attachment-like',
+        'rows': [
+            {'id': row, 'text': 'lorem ipsum dolor sit amet ' * 4}
+            for row in range(16000)
+        ],
+    }
+
+
+def make_changes(shape_name):
+    """Returns a batch of change lines with documents of the given shape.
+
+    """
+
+    batch_size, make_doc = SHAPES[shape_name]
+
+    changes = []
+
+    for i in range(batch_size):
+        doc_id = 'doc-%08d' % i
+        rev = '1-%032x' % i
+
+        doc = make_doc(i)
+        doc.update({
+            '_id': doc_id,
+            '_rev': rev,
+        })
+
+        changes.append({
+            'seq': i + 1,
+            'id': doc_id,
+            'changes': [{'rev': rev}],
+            'doc': doc,
+        })
+
+    return changes
+
+
+def benchmark_process_changes(changes):
+    processor = cchain.processors.base.BaseChangesProcessor()
+    return lambda: processor.process_changes(changes)
+
+
+def benchmark_process_change_line(changes):
+    processor = cchain.processors.base.BaseDocChangesProcessor()
+
+    def run():
+        for change_line in changes:
+            processor.process_change_line(change_line)
+
+    return run
+
+
+def benchmark_es_get_ops_for_bulk(changes):
+    processor = cchain.processors.es.SimpleESChangesProcessor(
+        ['http://127.0.0.1:9200'],
+        'benchmark',
+        'doc'
+    )
+    docs = [doc for (doc, rev, seq, ) in processor.process_changes(
+        changes
+    )[0]]
+
+    def run():
+        for doc in docs:
+            processor.get_ops_for_bulk(doc)
+
+    return run
+
+
+def benchmark_couchdb_merge_changes(changes):
+    """The target database answers `_all_docs` from memory, so that only
+    the merging is timed, not the request.
+
+    """
+
+    with mock.patch('pycouchdb.Server'):
+        processor = cchain.processors.couchdb.SimpleCouchdbChangesProcessor(
+            'http://127.0.0.1:5984',
+            'target'
+        )
+
+    processed_changes, last_seq = processor.process_changes(changes)
+
+    existing_results = [
+        {
+            'id': doc['_id'],
+            'key': doc['_id'],
+            'value': {'rev': doc['_rev']},
+        }
+        for (doc, rev, seq, ) in processed_changes
+    ]
+
+    processor._target_couchdb = mock.NonCallableMock(name='target')
+    processor._target_couchdb.all = lambda keys: existing_results
+
+    return lambda: processor.merge_changes(processed_changes)
+
+
+def benchmark_s3_serialize(changes):
+    """The serialization done for every document by
+    `SimpleS3ChangesProcessor._store_doc`.
+
+    """
+
+    docs = [change_line['doc'] for change_line in changes]
+
+    def run():
+        for doc in docs:
+            json.dumps(doc)
+
+    return run
+
+
+BENCHMARKS = collections.OrderedDict([
+    ('process_changes', benchmark_process_changes),
+    ('process_change_line', benchmark_process_change_line),
+    ('es_get_ops_for_bulk', benchmark_es_get_ops_for_bulk),
+    ('couchdb_merge_changes', benchmark_couchdb_merge_changes),
+    ('s3_serialize', benchmark_s3_serialize),
+])
+
+
+def time_per_doc(run, doc_count, repeat, min_seconds):
+    """Returns the best time per document, in microseconds, out of
+    `repeat` runs of at least `min_seconds` each.
+
+    """
+
+    # Warm up.
+    run()
+
+    # Like timeit, keep garbage collection from adding noise to the runs.
+    gc.collect()
+    gc_enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        return min(
+            time_run(run, doc_count, min_seconds) for _ in range(repeat)
+        )
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def time_run(run, doc_count, min_seconds):
+    # CPU time rather than wall time, so that other processes on the
+    # machine add less noise.
+    loops = 0
+    start = time.process_time()
+
+    while True:
+        run()
+        loops += 1
+        elapsed = time.process_time() - start
+        if elapsed >= min_seconds:
+            break
+
+    return elapsed / (loops * doc_count) * 1e6
+
+
+def run_benchmarks(names, shape_names, repeat, min_seconds):
+    """Runs the benchmarks.
+
+    :returns: a dict mapping `<benchmark>/<shape>` to microseconds per
+        document.
+
+    """
+
+    results = collections.OrderedDict()
+
+    for shape_name in shape_names:
+        changes = make_changes(shape_name)
+
+        for name in names:
+            run = BENCHMARKS[name](changes)
+            results['%s/%s' % (name, shape_name)] = time_per_doc(
+                run,
+                len(changes),
+                repeat,
+                min_seconds
+            )
+
+    return results
+
+
+def compare(results, baselines, threshold):
+    """Prints the results next to the baselines.
+
+    :returns: the list of regressed benchmarks.
+
+    """
+
+    regressions = []
+
+    print('%-40s %12s %12s %8s' % (
+        'benchmark',
+        'us/doc',
+        'baseline',
+        'change',
+    ))
+
+    for key, value in results.items():
+        baseline = baselines.get(key)
+
+        if baseline is None:
+            print('%-40s %12.2f %12s %8s' % (key, value, '-', '-'))
+            continue
+
+        change = value / baseline - 1
+        regressed = change > threshold
+
+        if regressed:
+            regressions.append(key)
+
+        print('%-40s %12.2f %12.2f %+7.1f%%%s' % (
+            key,
+            value,
+            baseline,
+            change * 100,
+            ' REGRESSED' if regressed else '',
+        ))
+
+    return regressions
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+
+    parser.add_argument(
+        '--benchmarks',
+        default=','.join(BENCHMARKS),
+        help='comma separated, from: %s' % ', '.join(BENCHMARKS)
+    )
+    parser.add_argument(
+        '--shapes',
+        default=','.join(SHAPES),
+        help='comma separated, from: %s' % ', '.join(SHAPES)
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--min-seconds',
+        type=float,
+        default=0.2,
+        help='the minimum duration of each run'
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.2,
+        help='the allowed slowdown against the baseline, e.g. 0.2 for 20%%'
+    )
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument(
+        '--save',
+        action='store_true',
+        help='save the results as the new baselines'
+    )
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help='exit with 1 if any benchmark regressed against the baselines'
+    )
+
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = run_benchmarks(
+        args.benchmarks.split(','),
+        args.shapes.split(','),
+        args.repeat,
+        args.min_seconds
+    )
+
+    baselines = {}
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+    elif args.check:
+        print(
+            'No baselines at %s; record them first with: '
+            'python -m benchmarks.micro --save' % args.baseline
+        )
+        return 2
+
+    regressions = compare(results, baselines, args.threshold)
+
+    if args.save:
+        baselines.update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=4, sort_keys=True)
+            baseline_file.write('\n')
+        print('Baselines saved to %s' % args.baseline)
+        return 0
+
+    if regressions and args.check:
+        print('%d benchmarks regressed by more than %d%%.' % (
+            len(regressions),
+            args.threshold * 100,
+        ))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,12 @@
 from . import consumers
+from . import metrics
 from . import processors
 from . import seqtrackers
 
 
 __all__ = [
     'consumers',
+    'metrics',
     'processors',
     'seqtrackers',
 ]
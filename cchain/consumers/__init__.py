@@ -1,8 +1,14 @@
+from . import aio
 from . import base
+from . import fanout
 from . import mp
+from . import pipelined
 
 
 __all__ = [
+    'aio',
     'base',
+    'fanout',
     'mp',
+    'pipelined',
 ]
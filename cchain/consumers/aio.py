@@ -0,0 +1,348 @@
+import asyncio
+import datetime
+import json
+import logging
+
+from cchain.processors import exceptions as processors_exceptions
+from cchain.seqtrackers import watermark
+
+from . import base
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncChangesConsumer(object):
+    """A changes consumer that streams the _changes feed over a non-blocking
+    http client and persists up to `max_in_flight` batches concurrently
+    on a single event loop.
+
+    Processors should implement `process_changes_async` and
+    `persist_changes_async` (see `cchain.processors.aio`); blocking
+    processors are run in the event loop's default executor.
+
+    """
+
+    def __init__(
+        self,
+        couchdb_uri,
+        couchdb_name,
+        feed_kwargs=None,
+        limit=1000,
+        flush_interval=10,
+        processor=None,
+        seqtracker=None,
+        max_in_flight=4
+    ):
+        """Initialises the consumer.
+
+        :param couchdb_uri: the uri of your couchdb server.
+        :param couchdb_name: the name of the database you want changes from.
+        :param feed_kwargs: the arguments to be passed to the feed url.
+        :param limit: maximum number of changes to be processed in a batch.
+        :param flush_interval: the maximum time, in seconds, to wait before
+            processing a batch of changes.
+        :param processor: a subclass of
+            `cchain.processors.base.BaseChangesProcessor`.
+        :param seqtracker: a subclass of
+            `cchain.seqtrackers.base.BaseSeqTracker`.
+        :param max_in_flight: the maximum number of batches being processed
+            and persisted at the same time.
+
+        """
+
+        self._changes_url = '%s/%s/_changes' % (
+            couchdb_uri.rstrip('/'),
+            couchdb_name,
+        )
+        self._limit = limit
+        self._flush_interval = datetime.timedelta(seconds=flush_interval)
+        self._processor = processor
+        self._seqtracker = seqtracker
+        self._max_in_flight = max_in_flight
+
+        default_feed_kwargs = {
+            'include_docs': 'true',
+        }
+
+        feed_kwargs = feed_kwargs or {}
+
+        default_feed_kwargs.update(feed_kwargs)
+
+        feed_filter = None
+        get_feed_filter = getattr(processor, 'get_feed_filter', None)
+        if get_feed_filter is not None:
+            feed_filter = get_feed_filter()
+
+        self._feed_kwargs = base.merge_feed_filter(
+            default_feed_kwargs,
+            feed_filter
+        )
+
+        self._buffer = []
+        self._last_flush_time = datetime.datetime.now()
+
+    async def _handle_batch(self, changes_buffer, dependencies):
+        """Processes and persists a batch of changes, after the batches it
+        depends on have been persisted.
+
+        """
+
+        for dependency in dependencies:
+            # Raises if an earlier batch failed, so that changes to the
+            # same documents are never persisted out of order.
+            await asyncio.shield(dependency)
+
+        processor = self._processor
+
+        process_changes_async = getattr(
+            processor,
+            'process_changes_async',
+            None
+        )
+
+        if process_changes_async is not None:
+            processed_changes, last_seq = await process_changes_async(
+                changes_buffer
+            )
+        else:
+            processed_changes, last_seq = processor.process_changes(
+                changes_buffer
+            )
+
+        if processed_changes:
+            persist_changes_async = getattr(
+                processor,
+                'persist_changes_async',
+                None
+            )
+            if persist_changes_async is not None:
+                await persist_changes_async(processed_changes)
+            else:
+                await asyncio.get_running_loop().run_in_executor(
+                    None,
+                    processor.persist_changes,
+                    processed_changes
+                )
+
+        return last_seq
+
+    def _on_batch_done(self, batch_number, doc_ids, task):
+        self._in_flight.release()
+        self._tasks.discard(task)
+
+        for doc_id in doc_ids:
+            if self._doc_tasks.get(doc_id) is task:
+                del self._doc_tasks[doc_id]
+
+        error = task.exception()
+
+        if error is not None:
+            logger.error(
+                'Error while persisting batch %d: %r',
+                batch_number,
+                error
+            )
+            if self._error is None:
+                self._error = error
+            return
+
+        if self._error is not None:
+            # Don't move the watermark past a failed batch.
+            return
+
+        self._watermark.complete_batch(batch_number)
+
+    async def flush_buffer(self):
+        if self._error is not None:
+            raise processors_exceptions.ProcessingError
+
+        if not self._buffer:
+            return
+
+        changes_buffer = self._buffer
+        self._buffer = []
+        self._last_flush_time = datetime.datetime.now()
+
+        doc_ids = set(
+            change_line.get('id') for change_line in changes_buffer
+        )
+
+        await self._in_flight.acquire()
+
+        batch_number = self._watermark.start_batch(
+            changes_buffer[-1]['seq'],
+            len(changes_buffer)
+        )
+
+        dependencies = set()
+        for doc_id in doc_ids:
+            dependency = self._doc_tasks.get(doc_id)
+            if dependency is not None:
+                dependencies.add(dependency)
+
+        task = asyncio.ensure_future(
+            self._handle_batch(changes_buffer, dependencies)
+        )
+
+        self._tasks.add(task)
+        for doc_id in doc_ids:
+            self._doc_tasks[doc_id] = task
+
+        task.add_done_callback(
+            lambda t: self._on_batch_done(batch_number, doc_ids, t)
+        )
+
+    async def flush_if_needed(self):
+        now = datetime.datetime.now()
+
+        waiting_time = now - self._last_flush_time
+
+        waits_too_long = waiting_time > self._flush_interval
+
+        if (len(self._buffer) >= self._limit) or waits_too_long:
+            logger.debug(
+                'Flushing %d changes, waited %s',
+                len(self._buffer),
+                waiting_time
+            )
+            await self.flush_buffer()
+
+    async def process_change_line(self, change_line):
+        change = change_line.get('changes')
+
+        if change is None:
+            logger.debug('Skipping change line: %s', change_line)
+        else:
+            self._buffer.append(change_line)
+            logger.debug('Change added to buffer: %s', change_line)
+
+        await self.flush_if_needed()
+
+    async def read_changes(self, session, feed_kwargs):
+        """Streams the _changes feed and buffers the changes. A `data` item
+        in the feed arguments is posted as the json body of the request.
+
+        """
+
+        params = {
+            key: str(value) for key, value in feed_kwargs.items()
+            if key != 'data'
+        }
+        params.setdefault('feed', 'continuous')
+
+        flush_timeout = self._flush_interval.total_seconds()
+
+        data = feed_kwargs.get('data')
+
+        if data is None:
+            request = session.get(
+                self._changes_url,
+                params=params,
+                timeout=aiohttp.ClientTimeout(total=None)
+            )
+        else:
+            request = session.post(
+                self._changes_url,
+                params=params,
+                json=data,
+                timeout=aiohttp.ClientTimeout(total=None)
+            )
+
+        async with request as response:
+            response.raise_for_status()
+
+            read_task = None
+
+            while True:
+                # Don't cancel reads on timeout, or partially read lines
+                # would be lost.
+                if read_task is None:
+                    read_task = asyncio.ensure_future(
+                        response.content.readline()
+                    )
+
+                done, _ = await asyncio.wait(
+                    [read_task],
+                    timeout=flush_timeout
+                )
+
+                if not done:
+                    # Nothing arrived for a while, so treat it as
+                    # a heartbeat.
+                    await self.flush_if_needed()
+                    continue
+
+                line = read_task.result()
+                read_task = None
+
+                if not line:
+                    logger.info('The _changes feed was closed.')
+                    break
+
+                line = line.strip()
+
+                if not line:
+                    logger.debug('Heartbeat received.')
+                    await self.flush_if_needed()
+                else:
+                    await self.process_change_line(json.loads(line))
+
+    async def consume_async(self):
+        """Processes the changes stream.
+
+        """
+
+        if aiohttp is None:
+            raise ImportError(
+                'aiohttp is required for the async consumer. '
+                'Install couch-chain[async].'
+            )
+
+        self._in_flight = asyncio.Semaphore(self._max_in_flight)
+        self._watermark = watermark.LowWatermark(self._seqtracker)
+        self._tasks = set()
+        # Maps document ids to the task of the last batch touching them.
+        self._doc_tasks = {}
+        self._error = None
+
+        last_seq = self._seqtracker.get_seq()
+
+        feed_kwargs = self._feed_kwargs
+
+        if last_seq:
+            feed_kwargs.update({
+                'since': last_seq,
+            })
+
+        async with aiohttp.ClientSession() as session:
+            try:
+                await self.read_changes(session, feed_kwargs)
+            except:
+                logger.exception(
+                    'Exception while processing changes! Exiting...'
+                )
+
+        try:
+            await self.flush_buffer()
+        finally:
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+
+            cleanup_async = getattr(self._processor, 'cleanup_async', None)
+            if cleanup_async is not None:
+                await cleanup_async()
+
+            self._seqtracker.cleanup()
+
+    def consume(self):
+        """Runs `consume_async` in a new event loop.
+
+        """
+
+        asyncio.run(self.consume_async())
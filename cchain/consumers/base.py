@@ -1,13 +1,45 @@
 import datetime
 import logging
 import pycouchdb
+import time
 
+from concurrent import futures
+
+from cchain.metrics import base as metrics_base
 from cchain.processors import exceptions as processors_exceptions
 
 
 logger = logging.getLogger(__name__)
 
 
+def merge_feed_filter(feed_kwargs, feed_filter):
+    """Adds a filter declared by a processor to the feed arguments, unless
+    they already have a filter.
+
+    :param feed_kwargs: the arguments to be passed to the feed url.
+    :param feed_filter: the value returned by the processor's
+        `get_feed_filter` method.
+
+    :returns: the merged feed arguments.
+
+    """
+
+    if not feed_filter:
+        return feed_kwargs
+
+    if 'filter' in feed_kwargs or 'data' in feed_kwargs:
+        logger.info(
+            'Not applying the filter declared by the processor, '
+            'the feed is filtered already.'
+        )
+        return feed_kwargs
+
+    merged_feed_kwargs = dict(feed_kwargs)
+    merged_feed_kwargs.update(feed_filter)
+
+    return merged_feed_kwargs
+
+
 class ChangesFeedReader(pycouchdb.feedreader.BaseFeedReader):
 
     def __init__(
@@ -15,13 +47,15 @@ class ChangesFeedReader(pycouchdb.feedreader.BaseFeedReader):
         limit=1000,
         flush_interval=10,
         processor=None,
-        seqtracker=None
+        seqtracker=None,
+        metrics=None
     ):
 
         self._limit = limit
         self._flush_interval = flush_interval
         self._processor = processor
         self._seqtracker = seqtracker
+        self._metrics = metrics or metrics_base.BaseMetricsSink()
         self._last_flush_time = datetime.datetime.now()
 
         self._buffer = []
@@ -73,21 +107,36 @@ class ChangesFeedReader(pycouchdb.feedreader.BaseFeedReader):
         if not self._buffer:
             return
 
+        metrics = self._metrics
+
+        metrics.timing(
+            'feed_wait',
+            (datetime.datetime.now() - self._last_flush_time).total_seconds()
+        )
+
+        start = time.perf_counter()
+
         try:
-            processed_changes, last_seq = self._processor.process_changes(
-                self._buffer
-            )
+            with metrics.timer('process_changes'):
+                processed_changes, last_seq = self._processor.process_changes(
+                    self._buffer
+                )
 
             if processed_changes:
-                self._processor.persist_changes(processed_changes)
+                with metrics.timer('persist_changes'):
+                    self._processor.persist_changes(processed_changes)
         except processors_exceptions.ProcessingError:
             raise pycouchdb.exceptions.FeedReaderExited
 
+        metrics.record_batch(len(self._buffer), time.perf_counter() - start)
+
         self._last_flush_time = datetime.datetime.now()
         # Only save the last sequence if all the changes have been
         # successfully processed.
         if last_seq is not None:
-            self._seqtracker.put_seq(last_seq)
+            self._seqtracker.record_changes(len(self._buffer))
+            with metrics.timer('put_seq'):
+                self._seqtracker.put_seq(last_seq)
 
         self._buffer = []
 
@@ -107,7 +156,12 @@ class BaseChangesConsumer(object):
         limit=1000,
         flush_interval=10,
         processor=None,
-        seqtracker=None
+        seqtracker=None,
+        metrics=None,
+        backfill=False,
+        backfill_workers=4,
+        backfill_page_size=1000,
+        backfill_boundaries=None
     ):
         """Initialises the consumer.
 
@@ -121,6 +175,20 @@ class BaseChangesConsumer(object):
             `cchain.processors.base.BaseChangesProcessor`.
         :param seqtracker: a subclass of
             `cchain.seqtrackers.base.BaseSeqTracker`.
+        :param metrics: a subclass of `cchain.metrics.base.BaseMetricsSink`
+            to record the time spent in each stage in.
+        :param backfill: if True and there is no seq yet, the current
+            documents are read from `_all_docs` first, and the _changes
+            stream is only consumed from the seq the database was at
+            when the backfill started. Much faster than processing the
+            whole history of a large database.
+        :param backfill_workers: the number of id ranges read and processed
+            at the same time.
+        :param backfill_page_size: the number of documents fetched and
+            processed at a time in each range.
+        :param backfill_boundaries: the ids to split the database into
+            ranges at. By default, the first hex digit is split evenly
+            into `backfill_workers` ranges, which suits uuid ids.
 
         """
 
@@ -130,6 +198,11 @@ class BaseChangesConsumer(object):
         self._flush_interval = datetime.timedelta(seconds=flush_interval)
         self._processor = processor
         self._seqtracker = seqtracker
+        self._metrics = metrics
+        self._backfill = backfill
+        self._backfill_workers = backfill_workers
+        self._backfill_page_size = backfill_page_size
+        self._backfill_boundaries = backfill_boundaries
 
         default_feed_kwargs = {
             'include_docs': 'true',
@@ -139,18 +212,199 @@ class BaseChangesConsumer(object):
 
         default_feed_kwargs.update(feed_kwargs)
 
-        self._feed_kwargs = default_feed_kwargs
+        self._feed_kwargs = merge_feed_filter(
+            default_feed_kwargs,
+            self.get_feed_filter()
+        )
 
         self._buffer = []
 
         self._feed_reader = self.feed_reader_class(
-            limit=self._limit,
-            flush_interval=self._flush_interval,
-            processor=self._processor,
-            seqtracker=self._seqtracker
+            **self.get_feed_reader_kwargs()
+        )
+
+    def get_feed_filter(self):
+        """Returns the filter declared by the processor, if any.
+
+        """
+
+        get_feed_filter = getattr(self._processor, 'get_feed_filter', None)
+
+        if get_feed_filter is None:
+            return None
+
+        return get_feed_filter()
+
+    def get_feed_reader_kwargs(self):
+        """Returns the keyword arguments to instantiate the feed reader with.
+        Override this if your feed reader class needs more arguments.
+
+        """
+
+        return {
+            'limit': self._limit,
+            'flush_interval': self._flush_interval,
+            'processor': self._processor,
+            'seqtracker': self._seqtracker,
+            'metrics': self._metrics,
+        }
+
+    def get_backfill_processors(self):
+        """Returns the processors to backfill documents with.
+
+        """
+
+        return [self._processor]
+
+    def get_backfill_ranges(self):
+        """Returns a list of (start_id, end_id) tuples, covering all the
+        ids in the database. The end ids are excluded from the ranges, and
+        None stands for the beginning or the end of the database.
+
+        """
+
+        boundaries = self._backfill_boundaries
+
+        if boundaries is None:
+            hex_digits = '0123456789abcdef'
+            boundaries = [
+                hex_digits[len(hex_digits) * i // self._backfill_workers]
+                for i in range(1, self._backfill_workers)
+            ]
+
+        boundaries = sorted(set(boundaries))
+
+        return list(zip([None] + boundaries, boundaries + [None]))
+
+    def get_backfill_seq(self, update_seq, doc_id):
+        """Returns the seq to give the change line of a backfilled document,
+        which has no change seq of its own.
 
+        It is made of the numeric part of the update seq the backfill
+        started at, so that it orders before the changes read from the feed
+        afterwards, e.g. as an es version, and of the document id, so that
+        batches of backfilled documents can be told apart, e.g. in the keys
+        of s3 batch archives.
+
+        :param update_seq: the update seq of the database when the backfill
+            started.
+        :param doc_id: the id of the backfilled document.
+
+        """
+
+        return '%s-backfill-%s' % (
+            str(update_seq).split('-', 1)[0],
+            doc_id,
         )
 
+    def backfill_range(self, start_id, end_id, update_seq):
+        """Reads the documents in an id range from `_all_docs` in pages and
+        persists them with the backfill processors.
+
+        :param update_seq: the update seq of the database when the backfill
+            started.
+
+        :returns: the number of documents backfilled.
+
+        """
+
+        processors = self.get_backfill_processors()
+        page_size = self._backfill_page_size
+
+        params = {
+            'limit': page_size,
+            'inclusive_end': 'false',
+        }
+
+        if start_id is not None:
+            params['startkey'] = start_id
+
+        if end_id is not None:
+            params['endkey'] = end_id
+
+        doc_count = 0
+
+        while True:
+            rows = self._couchdb.all(as_list=True, **params)
+
+            # Turn the rows into change lines. Their seqs are never saved,
+            # the update seq is once the whole backfill is done.
+            changes_buffer = [
+                {
+                    'id': row['id'],
+                    'seq': self.get_backfill_seq(update_seq, row['id']),
+                    'changes': [{'rev': row['value']['rev']}],
+                    'doc': row['doc'],
+                }
+                for row in rows
+            ]
+
+            if changes_buffer:
+                for processor in processors:
+                    processed_changes, last_seq = processor.process_changes(
+                        changes_buffer
+                    )
+
+                    if processed_changes:
+                        processor.persist_changes(processed_changes)
+
+                doc_count += len(changes_buffer)
+
+            if len(rows) < page_size:
+                break
+
+            params.update({
+                'startkey': rows[-1]['id'],
+                'skip': 1,
+            })
+
+        logger.info(
+            'Backfilled %d documents from %s to %s.',
+            doc_count,
+            start_id,
+            end_id
+        )
+
+        return doc_count
+
+    def backfill(self):
+        """Persists all the current documents by reading id ranges of
+        `_all_docs` in parallel.
+
+        :returns: the update seq of the database when the backfill started,
+            which is saved in the seq tracker once all the ranges are done.
+
+        """
+
+        update_seq = self._couchdb.config()['update_seq']
+
+        logger.info('Backfilling up to seq: %s', update_seq)
+
+        ranges = self.get_backfill_ranges()
+
+        with futures.ThreadPoolExecutor(
+            max_workers=self._backfill_workers
+        ) as executor:
+            range_futures = [
+                executor.submit(
+                    self.backfill_range,
+                    start_id,
+                    end_id,
+                    update_seq
+                )
+                for (start_id, end_id, ) in ranges
+            ]
+
+            doc_count = sum(
+                range_future.result() for range_future in range_futures
+            )
+
+        logger.info('Backfilled %d documents.', doc_count)
+
+        self._seqtracker.put_seq(update_seq)
+
+        return update_seq
+
     def consume(self):
         """Processes the changes stream.
 
@@ -158,6 +412,16 @@ class BaseChangesConsumer(object):
 
         last_seq = self._seqtracker.get_seq()
 
+        if self._backfill and not last_seq:
+            try:
+                last_seq = self.backfill()
+            except:
+                logger.exception('Exception while backfilling! Exiting...')
+
+                self._feed_reader.cleanup()
+                self._seqtracker.cleanup()
+                return
+
         feed_kwargs = self._feed_kwargs
 
         if last_seq:
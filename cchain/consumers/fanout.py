@@ -0,0 +1,306 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+
+import pycouchdb
+
+from cchain.seqtrackers import base as seqtrackers_base
+
+from . import base
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_seq_number(seq):
+    """Returns the numeric part of a change seq, e.g. 12 for '12-g1AAA...'
+    or 12, or None if the seq is empty or has no numeric part.
+
+    """
+
+    try:
+        return int(str(seq).split('-', 1)[0])
+    except ValueError:
+        return None
+
+
+class FanOutSeqTracker(seqtrackers_base.BaseSeqTracker):
+    """Stands in for the seq trackers of the sinks of a fan-out consumer,
+    which track their own seqs. The feed is read from the seq of the sink
+    that is furthest behind.
+
+    """
+
+    def __init__(self, seqtrackers):
+        self._seqtrackers = seqtrackers
+
+    def put_seq(self, seq):
+        """Saves the seq for all the sinks, e.g. after a backfill. While
+        consuming changes, each sink saves its own seq instead.
+
+        """
+
+        for seqtracker in self._seqtrackers:
+            seqtracker.put_seq(seq)
+
+    def get_seq(self):
+        """Returns the seq of the sink that is furthest behind, or '' if any
+        of the sinks hasn't got a seq yet.
+
+        Seqs are compared by their numeric part; in couchdb 2 and later it
+        is only approximate, so sinks further ahead may get a few of the
+        changes they have persisted already again.
+
+        """
+
+        start_seq = None
+        start_number = None
+
+        for seqtracker in self._seqtrackers:
+            seq = seqtracker.get_seq()
+            seq_number = get_seq_number(seq)
+
+            if not seq or seq_number is None:
+                return ''
+
+            if start_number is None or seq_number < start_number:
+                start_seq = seq
+                start_number = seq_number
+
+        return start_seq if start_seq is not None else ''
+
+    def cleanup(self):
+        for seqtracker in self._seqtrackers:
+            seqtracker.cleanup()
+
+
+class FanOutFeedReader(base.ChangesFeedReader):
+    """A feed reader that hands every batch of changes to several
+    processors, each persisting them in its own thread and saving its
+    progress in its own seq tracker.
+
+    A sink may fall up to `max_lag` batches behind the reader. Once a sink
+    is that far behind, reading the feed waits for it, so a slow sink
+    holds the others back only when its lag is exhausted.
+
+    The change lines are shared by all the sinks, so processors must not
+    modify them in place (`BaseDocChangesProcessor` copies documents
+    before they are processed).
+
+    Every sink records its own timings and batches in the metrics sink, so
+    the `batches` and `changes` counters grow once per sink.
+
+    """
+
+    def __init__(self, sinks=None, max_lag=4, **kwargs):
+        """
+
+        :param sinks: a list of (processor, seqtracker) tuples.
+        :param max_lag: the maximum number of batches a sink may be behind
+            the reader.
+
+        """
+
+        super(
+            FanOutFeedReader,
+            self
+        ).__init__(**kwargs)
+
+        self._sinks = sinks or []
+        self._error = None
+        self._sink_queues = []
+        self._sink_threads = []
+
+        for sink_number, (processor, seqtracker, ) in enumerate(self._sinks):
+            sink_queue = queue.Queue(maxsize=max_lag)
+
+            sink_thread = threading.Thread(
+                target=self._persist_sink,
+                args=(sink_number, processor, seqtracker, sink_queue)
+            )
+            sink_thread.daemon = True
+            sink_thread.start()
+
+            self._sink_queues.append(sink_queue)
+            self._sink_threads.append(sink_thread)
+
+    def _persist_sink(self, sink_number, processor, seqtracker, sink_queue):
+        """Runs in a sink thread. Processes and persists the batches from
+        the queue, in order, and saves their seqs.
+
+        """
+
+        metrics = self._metrics
+        failed = False
+
+        while True:
+            changes_buffer = sink_queue.get()
+
+            if changes_buffer is None:
+                logger.info('Terminating sink %d.', sink_number)
+                break
+
+            if failed:
+                # Later changes must not be persisted past a failed one,
+                # but keep draining the queue so the reader doesn't block.
+                continue
+
+            start = time.perf_counter()
+
+            try:
+                with metrics.timer('process_changes'):
+                    processed_changes, last_seq = processor.process_changes(
+                        changes_buffer
+                    )
+
+                if processed_changes:
+                    with metrics.timer('persist_changes'):
+                        processor.persist_changes(processed_changes)
+
+                metrics.record_batch(
+                    len(changes_buffer),
+                    time.perf_counter() - start
+                )
+
+                if last_seq is not None:
+                    seqtracker.record_changes(len(changes_buffer))
+                    with metrics.timer('put_seq'):
+                        seqtracker.put_seq(last_seq)
+            except Exception as e:
+                logger.exception(
+                    'Error persisting changes in sink %d!',
+                    sink_number
+                )
+                failed = True
+                if self._error is None:
+                    self._error = e
+
+    def get_lags(self):
+        """Returns the number of batches waiting for each sink.
+
+        """
+
+        return [sink_queue.qsize() for sink_queue in self._sink_queues]
+
+    def flush_buffer(self):
+        if self._error is not None:
+            raise pycouchdb.exceptions.FeedReaderExited
+
+        if not self._buffer:
+            return
+
+        now = datetime.datetime.now()
+
+        self._metrics.timing(
+            'feed_wait',
+            (now - self._last_flush_time).total_seconds()
+        )
+
+        changes_buffer = self._buffer
+        self._buffer = []
+        self._last_flush_time = now
+
+        for sink_queue in self._sink_queues:
+            # Blocks if the sink is `max_lag` batches behind.
+            sink_queue.put(changes_buffer)
+
+        logger.debug(
+            'Batch with %d changes sent to %d sinks, lags: %s',
+            len(changes_buffer),
+            len(self._sink_queues),
+            self.get_lags()
+        )
+
+    def cleanup(self):
+        try:
+            super(
+                FanOutFeedReader,
+                self
+            ).cleanup()
+        finally:
+            for sink_queue in self._sink_queues:
+                sink_queue.put(None)
+
+            for sink_thread in self._sink_threads:
+                sink_thread.join()
+
+
+class FanOutChangesConsumer(base.BaseChangesConsumer):
+    """A changes consumer that reads the _changes stream once and persists
+    the changes with several processors, e.g. to index documents in es and
+    back them up to s3 at the same time.
+
+    """
+
+    feed_reader_class = FanOutFeedReader
+
+    def __init__(self, couchdb_uri, couchdb_name, sinks, **kwargs):
+        """Initialises the consumer.
+
+        :param sinks: a list of (processor, seqtracker) tuples. Each
+            processor gets every batch and saves its progress in its seq
+            tracker.
+        :param max_lag: the maximum number of batches a sink may be behind
+            the reader, before reading waits for it.
+
+        See `cchain.consumers.base.BaseChangesConsumer` for the remaining
+        arguments.
+
+        """
+
+        self._sinks = sinks
+        self._max_lag = kwargs.pop('max_lag', 4)
+
+        kwargs['seqtracker'] = FanOutSeqTracker([
+            seqtracker for (processor, seqtracker, ) in sinks
+        ])
+
+        super(
+            FanOutChangesConsumer,
+            self
+        ).__init__(couchdb_uri, couchdb_name, **kwargs)
+
+    def get_backfill_processors(self):
+        return [processor for (processor, seqtracker, ) in self._sinks]
+
+    def get_feed_filter(self):
+        """The feed is shared, so it can only be filtered if all the
+        processors declare the same filter.
+
+        """
+
+        feed_filters = []
+
+        for (processor, seqtracker, ) in self._sinks:
+            get_feed_filter = getattr(processor, 'get_feed_filter', None)
+
+            if get_feed_filter is None:
+                feed_filters.append(None)
+            else:
+                feed_filters.append(get_feed_filter())
+
+        if not feed_filters or feed_filters.count(feed_filters[0]) != len(
+            feed_filters
+        ):
+            logger.info(
+                'The processors declare different filters, '
+                'not filtering the feed.'
+            )
+            return None
+
+        return feed_filters[0]
+
+    def get_feed_reader_kwargs(self):
+        feed_reader_kwargs = super(
+            FanOutChangesConsumer,
+            self
+        ).get_feed_reader_kwargs()
+
+        feed_reader_kwargs.update({
+            'sinks': self._sinks,
+            'max_lag': self._max_lag,
+        })
+
+        return feed_reader_kwargs
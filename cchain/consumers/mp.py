@@ -4,9 +4,13 @@ import queue
 import logging
 import multiprocessing
 import pycouchdb
+import threading
+import zlib
 
 from concurrent import futures
 
+from cchain.seqtrackers import watermark
+
 from . import base
 
 
@@ -49,7 +53,11 @@ class MPFeedReader(base.ChangesFeedReader):
         while True:
 
             logger.debug('Waiting for data to persist...')
-            (processed_changes, last_seq) = self._persist_queue.get()
+            (
+                processed_changes,
+                last_seq,
+                change_count,
+            ) = self._persist_queue.get()
 
             if processed_changes is None:
                 logger.info('Terminating sequence tracker.')
@@ -60,31 +68,48 @@ class MPFeedReader(base.ChangesFeedReader):
             # If this succeeds, go on and save the sequence to the file,
             # otherwise break spectacularly.
             if processed_changes:
-                self._processor.persist_changes(processed_changes)
+                with self._metrics.timer('persist_changes'):
+                    self._processor.persist_changes(processed_changes)
 
             self._persist_queue.task_done()
 
+            self._metrics.increment('batches')
+            self._metrics.increment('changes', change_count)
+
             if last_seq is not None:
-                self._seqtracker.put_seq(last_seq)
+                self._seqtracker.record_changes(change_count)
+                with self._metrics.timer('put_seq'):
+                    self._seqtracker.put_seq(last_seq)
 
     def flush_buffer(self):
         if not self._buffer:
             return
 
+        now = datetime.datetime.now()
+
+        self._metrics.timing(
+            'feed_wait',
+            (now - self._last_flush_time).total_seconds()
+        )
+
         try:
-            processed_changes, last_seq = self._processor.process_changes(
-                self._buffer
-            )
+            with self._metrics.timer('process_changes'):
+                processed_changes, last_seq = (
+                    self._processor.process_changes(self._buffer)
+                )
 
+            change_count = len(self._buffer)
             self._buffer = []
-            self._last_flush_time = datetime.datetime.now()
+            self._last_flush_time = now
 
             logger.info(
                 'Putting processed data in the queue, last_seq: %s',
                 last_seq
             )
 
-            self._persist_queue.put((processed_changes, last_seq))
+            self._persist_queue.put(
+                (processed_changes, last_seq, change_count, )
+            )
 
         except:
             logger.exception('Error while processing changes!')
@@ -130,7 +155,25 @@ class MPFeedReader(base.ChangesFeedReader):
         # Write a termination sequence to the queue, so that the sequence
         # tracker can exit.
         logger.debug('Writing termination sequence to persist queue...')
-        self._persist_queue.put((None, None))
+        self._persist_queue.put((None, None, None, ))
+
+        # The process exits as soon as this returns, without waiting for
+        # other threads, so let the tracker persist what is queued first.
+        self._persist_executor.shutdown(wait=True)
+
+        error = self._seq_tracking_future.exception()
+        if error is not None:
+            logger.error('Error while persisting changes: %r', error)
+
+        # Seqs are only put in this process, and the seq tracker is cleaned
+        # up in the main one, so save any seq held back here, e.g. by
+        # `DebouncedSeqTracker`.
+        flush_seq = getattr(self._seqtracker, 'flush', None)
+        if flush_seq is not None:
+            try:
+                flush_seq()
+            except:
+                logger.exception('Error saving the last seq!')
 
     def read_changes(self):
         """Reads changes from self._changes_out and processes them as normal.
@@ -172,3 +215,266 @@ class MPChangesConsumer(base.BaseChangesConsumer):
     """
 
     feed_reader_class = MPFeedReader
+
+
+class PartitionedMPFeedReader(base.ChangesFeedReader):
+    """A feed reader that splits each batch of changes into partitions by
+    document id and hands the partitions to separate processes, which
+    process and persist them with their own copy of the processor.
+
+    Changes to a given document always go to the same process, so they are
+    persisted in order. The seq tracker is only updated when all the
+    partitions of a batch, and of all the batches before it, are persisted.
+
+    """
+
+    task_queue_length = 10
+    # How long to wait for room in a task queue before checking that its
+    # persister process is still alive, in seconds.
+    put_timeout = 1
+
+    def __init__(self, partitions=4, **kwargs):
+
+        super(
+            PartitionedMPFeedReader,
+            self
+        ).__init__(**kwargs)
+
+        self._partitions = partitions
+        self._watermark = watermark.LowWatermark(self._seqtracker)
+        self._lock = threading.Lock()
+        # Maps batch numbers to the number of partitions not persisted yet.
+        self._pending_partitions = {}
+        self._error = None
+
+        self._result_queue = multiprocessing.Queue()
+        self._task_queues = []
+        self._persister_processes = []
+
+        for partition in range(partitions):
+            task_queue = multiprocessing.Queue(
+                maxsize=self.task_queue_length
+            )
+            persister_process = multiprocessing.Process(
+                target=self._persist_partition,
+                args=(partition, task_queue)
+            )
+            persister_process.start()
+
+            self._task_queues.append(task_queue)
+            self._persister_processes.append(persister_process)
+
+        self._result_thread = threading.Thread(target=self._track_seq)
+        self._result_thread.daemon = True
+        self._result_thread.start()
+
+    def get_partition(self, change_line):
+        """Returns the partition that the change will be persisted in.
+        Uses crc32 rather than `hash`, which is randomised per process.
+
+        :param change_line: a change fetched from the _changes stream.
+
+        """
+
+        doc_id = change_line.get('id') or ''
+
+        return zlib.crc32(doc_id.encode('utf-8')) % self._partitions
+
+    def put_task(self, partition, task):
+        """Puts a task on the queue of a persister process. Gives up if the
+        process has died, so that a full queue nobody reads from can't
+        block the reader forever.
+
+        :param partition: the number of the persister process.
+        :param task: a (batch_number, changes_buffer) tuple.
+
+        """
+
+        task_queue = self._task_queues[partition]
+        persister_process = self._persister_processes[partition]
+
+        while True:
+            try:
+                task_queue.put(task, timeout=self.put_timeout)
+                return
+            except queue.Full:
+                if not persister_process.is_alive():
+                    logger.error(
+                        'Persister %d exited with code %s!',
+                        partition,
+                        persister_process.exitcode
+                    )
+                    raise pycouchdb.exceptions.FeedReaderExited
+
+    def _persist_partition(self, partition, task_queue):
+        """Runs in a persister process. Processes and persists the
+        partitions of batches from the task queue, in order.
+
+        """
+
+        failed = False
+
+        while True:
+            (batch_number, changes_buffer) = task_queue.get()
+
+            if batch_number is None:
+                logger.info('Terminating persister %d.', partition)
+                break
+
+            if failed:
+                # Later changes must not be persisted past a failed one,
+                # but keep draining the queue so the reader doesn't block.
+                continue
+
+            error = None
+
+            try:
+                processed_changes, last_seq = (
+                    self._processor.process_changes(changes_buffer)
+                )
+
+                if processed_changes:
+                    self._processor.persist_changes(processed_changes)
+            except Exception as e:
+                logger.exception(
+                    'Error persisting batch %d in partition %d!',
+                    batch_number,
+                    partition
+                )
+                error = repr(e)
+
+            self._result_queue.put((batch_number, partition, error))
+
+            failed = error is not None
+
+    def _track_seq(self):
+        """Reads persistence confirmations from the persister processes
+        and moves the watermark once all the partitions of a batch are
+        persisted.
+
+        """
+
+        while True:
+            (batch_number, partition, error) = self._result_queue.get()
+
+            if batch_number is None:
+                logger.info('Terminating sequence tracker.')
+                break
+
+            with self._lock:
+                if error is not None:
+                    logger.error(
+                        'Partition %d failed to persist batch %d: %s',
+                        partition,
+                        batch_number,
+                        error
+                    )
+                    if self._error is None:
+                        self._error = error
+                    continue
+
+                if self._error is not None:
+                    # Don't move the watermark past a failed batch.
+                    continue
+
+                self._pending_partitions[batch_number] -= 1
+
+                if self._pending_partitions[batch_number]:
+                    continue
+
+                del self._pending_partitions[batch_number]
+
+            with self._metrics.timer('put_seq'):
+                self._watermark.complete_batch(batch_number)
+
+    def flush_buffer(self):
+        if self._error is not None:
+            raise pycouchdb.exceptions.FeedReaderExited
+
+        if not self._buffer:
+            return
+
+        self._metrics.timing(
+            'feed_wait',
+            (datetime.datetime.now() - self._last_flush_time).total_seconds()
+        )
+
+        partitioned_buffers = {}
+
+        for change_line in self._buffer:
+            partition = self.get_partition(change_line)
+            partitioned_buffers.setdefault(partition, []).append(change_line)
+
+        with self._lock:
+            batch_number = self._watermark.start_batch(
+                self._buffer[-1]['seq'],
+                len(self._buffer)
+            )
+            self._pending_partitions[batch_number] = len(partitioned_buffers)
+
+        logger.debug(
+            'Sending batch %d to %d partitions.',
+            batch_number,
+            len(partitioned_buffers)
+        )
+
+        for partition, changes_buffer in partitioned_buffers.items():
+            self.put_task(partition, (batch_number, changes_buffer))
+
+        self._buffer = []
+        self._last_flush_time = datetime.datetime.now()
+
+    def cleanup(self):
+        try:
+            super(
+                PartitionedMPFeedReader,
+                self
+            ).cleanup()
+        finally:
+            for partition in range(self._partitions):
+                try:
+                    self.put_task(partition, (None, None))
+                except pycouchdb.exceptions.FeedReaderExited:
+                    pass
+
+            for persister_process in self._persister_processes:
+                persister_process.join()
+
+            self._result_queue.put((None, None, None))
+            self._result_thread.join()
+
+
+class PartitionedMPChangesConsumer(base.BaseChangesConsumer):
+    """A changes consumer that persists changes in several processes,
+    partitioned by document id.
+
+    """
+
+    feed_reader_class = PartitionedMPFeedReader
+
+    def __init__(self, *args, **kwargs):
+        """Initialises the consumer.
+
+        :param partitions: the number of persister processes to run.
+
+        See `cchain.consumers.base.BaseChangesConsumer` for the remaining
+        arguments.
+
+        """
+
+        self._partitions = kwargs.pop('partitions', 4)
+
+        super(
+            PartitionedMPChangesConsumer,
+            self
+        ).__init__(*args, **kwargs)
+
+    def get_feed_reader_kwargs(self):
+        feed_reader_kwargs = super(
+            PartitionedMPChangesConsumer,
+            self
+        ).get_feed_reader_kwargs()
+
+        feed_reader_kwargs['partitions'] = self._partitions
+
+        return feed_reader_kwargs
@@ -0,0 +1,212 @@
+import datetime
+import logging
+import threading
+import time
+
+import pycouchdb
+
+from concurrent import futures
+
+from cchain.seqtrackers import watermark
+
+from . import base
+
+
+logger = logging.getLogger(__name__)
+
+
+class PipelinedFeedReader(base.ChangesFeedReader):
+    """A feed reader that keeps reading the _changes stream while earlier
+    batches are being processed and persisted.
+
+    Up to `max_in_flight` batches are handled concurrently on a thread pool.
+    Batches touching the same documents are persisted in the order they were
+    read. The seq tracker only receives the last seq of the highest batch
+    for which all the earlier batches have been persisted (the low
+    watermark).
+
+    """
+
+    def __init__(self, max_in_flight=4, **kwargs):
+
+        super(
+            PipelinedFeedReader,
+            self
+        ).__init__(**kwargs)
+
+        self._max_in_flight = max_in_flight
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=max_in_flight
+        )
+        # Blocks reading the feed when too many batches are in flight.
+        self._in_flight = threading.Semaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._watermark = watermark.LowWatermark(self._seqtracker)
+        # Maps document ids to the future of the last batch touching them.
+        self._doc_futures = {}
+        self._error = None
+
+    def _handle_batch(self, changes_buffer, dependencies):
+        """Processes and persists a batch of changes, after the batches it
+        depends on have been persisted.
+
+        :param changes_buffer: the list of changes to process.
+        :param dependencies: futures of earlier batches sharing documents
+            with this one.
+
+        :returns: the last seq of the batch.
+
+        """
+
+        for dependency in dependencies:
+            # Raises if an earlier batch failed, so that changes to the
+            # same documents are never persisted out of order.
+            dependency.result()
+
+        metrics = self._metrics
+
+        start = time.perf_counter()
+
+        with metrics.timer('process_changes'):
+            processed_changes, last_seq = self._processor.process_changes(
+                changes_buffer
+            )
+
+        if processed_changes:
+            with metrics.timer('persist_changes'):
+                self._processor.persist_changes(processed_changes)
+
+        metrics.record_batch(len(changes_buffer), time.perf_counter() - start)
+
+        return last_seq
+
+    def _on_batch_done(self, batch_number, doc_ids, future):
+        """Updates the low watermark when a batch is done and saves it in
+        the seq tracker.
+
+        """
+
+        self._in_flight.release()
+
+        with self._lock:
+            for doc_id in doc_ids:
+                if self._doc_futures.get(doc_id) is future:
+                    del self._doc_futures[doc_id]
+
+            error = future.exception()
+
+            if error is not None:
+                logger.error(
+                    'Error while persisting batch %d: %r',
+                    batch_number,
+                    error
+                )
+                if self._error is None:
+                    self._error = error
+                return
+
+            if self._error is not None:
+                # Don't move the watermark past a failed batch.
+                return
+
+            with self._metrics.timer('put_seq'):
+                self._watermark.complete_batch(batch_number)
+
+    def flush_buffer(self):
+        if self._error is not None:
+            raise pycouchdb.exceptions.FeedReaderExited
+
+        if not self._buffer:
+            return
+
+        now = datetime.datetime.now()
+
+        self._metrics.timing(
+            'feed_wait',
+            (now - self._last_flush_time).total_seconds()
+        )
+
+        changes_buffer = self._buffer
+        self._buffer = []
+        self._last_flush_time = now
+
+        doc_ids = set(
+            change_line.get('id') for change_line in changes_buffer
+        )
+
+        self._in_flight.acquire()
+
+        with self._lock:
+            batch_number = self._watermark.start_batch(
+                changes_buffer[-1]['seq'],
+                len(changes_buffer)
+            )
+
+            dependencies = set()
+            for doc_id in doc_ids:
+                dependency = self._doc_futures.get(doc_id)
+                if dependency is not None:
+                    dependencies.add(dependency)
+
+            future = self._executor.submit(
+                self._handle_batch,
+                changes_buffer,
+                dependencies
+            )
+
+            for doc_id in doc_ids:
+                self._doc_futures[doc_id] = future
+
+        logger.debug(
+            'Batch %d with %d changes submitted.',
+            batch_number,
+            len(changes_buffer)
+        )
+
+        future.add_done_callback(
+            lambda f: self._on_batch_done(batch_number, doc_ids, f)
+        )
+
+    def cleanup(self):
+        try:
+            self.flush_buffer()
+        finally:
+            # Wait for all the batches in flight.
+            self._executor.shutdown(wait=True)
+
+
+class PipelinedChangesConsumer(base.BaseChangesConsumer):
+    """A changes consumer that reads, processes and persists changes
+    at the same time, keeping a bounded number of batches in flight.
+
+    """
+
+    feed_reader_class = PipelinedFeedReader
+
+    def __init__(self, *args, **kwargs):
+        """Initialises the consumer.
+
+        :param max_in_flight: the maximum number of batches being processed
+            and persisted at the same time.
+
+        See `cchain.consumers.base.BaseChangesConsumer` for the remaining
+        arguments.
+
+        """
+
+        self._max_in_flight = kwargs.pop('max_in_flight', 4)
+
+        super(
+            PipelinedChangesConsumer,
+            self
+        ).__init__(*args, **kwargs)
+
+    def get_feed_reader_kwargs(self):
+        feed_reader_kwargs = super(
+            PipelinedChangesConsumer,
+            self
+        ).get_feed_reader_kwargs()
+
+        feed_reader_kwargs['max_in_flight'] = self._max_in_flight
+
+        return feed_reader_kwargs
@@ -0,0 +1,10 @@
+from . import base
+from . import prometheus
+from . import statsd
+
+
+__all__ = [
+    'base',
+    'prometheus',
+    'statsd',
+]
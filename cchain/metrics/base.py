@@ -0,0 +1,69 @@
+import contextlib
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseMetricsSink(object):
+    """Receives metrics from feed readers and processors. This base sink
+    discards them, so that instrumented code costs next to nothing when
+    no sink is configured.
+
+    Metric names are short, dot-free identifiers, e.g. `persist_changes`;
+    sinks add their own prefixes and units.
+
+    """
+
+    def timing(self, name, seconds):
+        """Records the duration of an operation.
+
+        :param name: the name of the metric.
+        :param seconds: the duration, in seconds.
+
+        """
+
+    def increment(self, name, value=1):
+        """Adds to a counter.
+
+        :param name: the name of the metric.
+        :param value: the amount to add.
+
+        """
+
+    def gauge(self, name, value):
+        """Sets the current value of a metric.
+
+        :param name: the name of the metric.
+        :param value: the value.
+
+        """
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Records the time spent in the block as `name`.
+
+        """
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start)
+
+    def record_batch(self, change_count, seconds):
+        """Records the size and throughput of a batch.
+
+        :param change_count: the number of changes in the batch.
+        :param seconds: the time it took to process and persist the batch.
+
+        """
+
+        self.increment('batches')
+        self.increment('changes', change_count)
+        self.gauge('batch_size', change_count)
+
+        if seconds > 0:
+            self.gauge('changes_per_second', change_count / seconds)
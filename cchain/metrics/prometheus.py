@@ -0,0 +1,108 @@
+import logging
+import threading
+
+from http import server
+
+from . import base
+
+
+logger = logging.getLogger(__name__)
+
+
+class PrometheusMetricsSink(base.BaseMetricsSink):
+    """Keeps metrics in memory and renders them in the Prometheus text
+    exposition format.
+
+    Counters are exported as `<prefix>_<name>_total`, timings as summaries
+    without quantiles (`<prefix>_<name>_seconds_sum` and `_count`) and
+    gauges as `<prefix>_<name>`.
+
+    """
+
+    def __init__(self, prefix='cchain'):
+        """
+
+        :param prefix: the prefix of all the metric names.
+
+        """
+
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._gauges = {}
+
+    def timing(self, name, seconds):
+        with self._lock:
+            (total, count, ) = self._timings.get(name, (0.0, 0, ))
+            self._timings[name] = (total + seconds, count + 1, )
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def render(self):
+        """Returns all the metrics in the Prometheus text format.
+
+        """
+
+        prefix = self._prefix
+        lines = []
+
+        with self._lock:
+            for name, value in sorted(self._counters.items()):
+                metric = '%s_%s_total' % (prefix, name, )
+                lines.append('# TYPE %s counter' % metric)
+                lines.append('%s %s' % (metric, value, ))
+
+            for name, (total, count, ) in sorted(self._timings.items()):
+                metric = '%s_%s_seconds' % (prefix, name, )
+                lines.append('# TYPE %s summary' % metric)
+                lines.append('%s_sum %s' % (metric, total, ))
+                lines.append('%s_count %s' % (metric, count, ))
+
+            for name, value in sorted(self._gauges.items()):
+                metric = '%s_%s' % (prefix, name, )
+                lines.append('# TYPE %s gauge' % metric)
+                lines.append('%s %s' % (metric, value, ))
+
+        return '\n'.join(lines) + '\n'
+
+    def start_http_server(self, port, host=''):
+        """Serves the metrics over http in a daemon thread, for Prometheus
+        to scrape.
+
+        :returns: the http server; call `shutdown` on it to stop serving.
+
+        """
+
+        sink = self
+
+        class MetricsHandler(server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = sink.render().encode('utf-8')
+
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type',
+                    'text/plain; version=0.0.4; charset=utf-8'
+                )
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        http_server = server.HTTPServer((host, port), MetricsHandler)
+
+        thread = threading.Thread(target=http_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return http_server
@@ -0,0 +1,50 @@
+import logging
+import socket
+
+from . import base
+
+
+logger = logging.getLogger(__name__)
+
+
+class StatsdMetricsSink(base.BaseMetricsSink):
+    """Sends metrics as statsd lines over udp. Sending never blocks and
+    errors are only logged, so a missing statsd server does not stop the
+    consumer.
+
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='cchain'):
+        """
+
+        :param host: the host name of the statsd server.
+        :param port: the udp port of the statsd server.
+        :param prefix: the prefix of all the metric names.
+
+        """
+
+        self._address = (host, port, )
+        self._prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def format_line(self, name, value, metric_type):
+        return '%s.%s:%s|%s' % (self._prefix, name, value, metric_type, )
+
+    def send(self, line):
+        try:
+            self._socket.sendto(line.encode('utf-8'), self._address)
+        except OSError:
+            logger.debug('Failed to send metric: %s', line)
+
+    def timing(self, name, seconds):
+        self.send(self.format_line(name, round(seconds * 1000, 3), 'ms'))
+
+    def increment(self, name, value=1):
+        self.send(self.format_line(name, value, 'c'))
+
+    def gauge(self, name, value):
+        self.send(self.format_line(name, value, 'g'))
+
+    def close(self):
+        self._socket.close()
@@ -1,3 +1,4 @@
+from . import aio
 from . import base
 from . import couchdb
 from . import entity
@@ -6,6 +7,7 @@ from . import s3
 
 
 __all__ = [
+    'aio',
     'base',
     'couchdb',
     'es',
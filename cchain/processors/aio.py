@@ -0,0 +1,500 @@
+import asyncio
+import gzip
+import itertools
+import logging
+
+from cchain.processors import couchdb
+from cchain.processors import es
+from cchain.processors import exceptions
+from cchain.processors import s3
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncChangesProcessorMixin(object):
+    """Adds coroutine versions of `process_changes` and `persist_changes`
+    to a processor, for use with
+    `cchain.consumers.aio.AsyncChangesConsumer`.
+
+    By default, `persist_changes_async` runs the blocking `persist_changes`
+    in the event loop's default executor. Override it to persist changes
+    with a non-blocking client.
+
+    """
+
+    async def process_changes_async(self, changes_buffer):
+        """Processing changes is CPU bound, so it runs on the event loop.
+
+        """
+
+        return self.process_changes(changes_buffer)
+
+    async def persist_changes_async(self, processed_changes):
+        loop = asyncio.get_running_loop()
+
+        await loop.run_in_executor(
+            None,
+            self.persist_changes,
+            processed_changes
+        )
+
+    async def cleanup_async(self):
+        """Close sessions, connections, etc. here.
+
+        """
+
+
+class AsyncHTTPProcessorMixin(AsyncChangesProcessorMixin):
+    """Keeps an `aiohttp` session, which can only be created once the event
+    loop is running.
+
+    """
+
+    _session = None
+
+    def get_session(self):
+        if aiohttp is None:
+            raise ImportError(
+                'aiohttp is required for async processors. '
+                'Install couch-chain[async].'
+            )
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+
+        return self._session
+
+    async def cleanup_async(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncSimpleESChangesProcessor(
+    AsyncHTTPProcessorMixin,
+    es.SimpleESChangesProcessor
+):
+    """Stores documents in elasticsearch without blocking the event loop.
+    Bulk requests are sent to the configured nodes in turn.
+
+    """
+
+    def __init__(self, es_urls, es_index, es_type, **kwargs):
+
+        super(
+            AsyncSimpleESChangesProcessor,
+            self
+        ).__init__(es_urls, es_index, es_type, **kwargs)
+
+        self._es_nodes = itertools.cycle([
+            es_url.rstrip('/') for es_url in es_urls
+        ])
+
+    async def persist_changes_async(
+        self,
+        processed_changes,
+        exit_on_fail=False
+    ):
+        """Stores the processed changes in es.
+
+        :param processed_changes: a list of (doc, rev, seq) tuples.
+        :param exit_on_fail: a boolean to determine if an exception should
+            be raised if ElasticSearch index errors occur.
+
+        """
+
+        for bulk_body, changes in self.iter_bulk_bodies(processed_changes):
+            await self.execute_bulk_async(
+                bulk_body,
+                changes,
+                exit_on_fail=exit_on_fail
+            )
+
+    async def execute_bulk_async(
+        self,
+        bulk_body,
+        processed_changes,
+        exit_on_fail=False
+    ):
+        """See `execute_bulk`.
+
+        """
+
+        error = False
+
+        try:
+            return_value = await self.post_bulk_async(bulk_body)
+        except:
+            logger.exception('Failed to index documents!')
+            error = True
+        else:
+            if return_value.get('errors') and self.has_errors(return_value):
+                if self._max_retries:
+                    return await self.retry_failed_items_async(
+                        return_value, processed_changes
+                    )
+
+                if self._auto_open and exit_on_fail is False:
+                    return await self.force_into_closed_async(
+                        return_value, processed_changes
+                    )
+
+                logger.debug('ES response: %s', return_value)
+                logger.error('Errors executing bulk!')
+                error = True
+
+        if error:
+            raise exceptions.ProcessingError
+
+    async def post_bulk_async(self, bulk_body):
+        """Sends a serialized bulk request to the next es node.
+
+        :returns: the decoded response.
+
+        """
+
+        headers = {
+            'Content-Type': 'application/x-ndjson',
+        }
+
+        if self._http_compress:
+            bulk_body = gzip.compress(bulk_body)
+            headers['Content-Encoding'] = 'gzip'
+
+        session = self.get_session()
+
+        async with session.post(
+            '%s/_bulk' % next(self._es_nodes),
+            params={'timeout': self._bulk_timeout},
+            data=bulk_body,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=self._request_timeout)
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def open_index_async(self, index):
+        session = self.get_session()
+
+        async with session.post(
+            '%s/%s/_open' % (next(self._es_nodes), index)
+        ) as response:
+            response.raise_for_status()
+
+    async def retry_failed_items_async(self, return_value, processed_changes):
+        """See `retry_failed_items`.
+
+        """
+
+        failed_changes = []
+        attempt = 0
+
+        while True:
+            retryable, failed, closed_indices = self.split_failed_changes(
+                return_value,
+                processed_changes
+            )
+            failed_changes += failed
+
+            if not retryable:
+                break
+
+            if attempt >= self._max_retries:
+                logger.error(
+                    'Giving up on %d changes after %d retries.',
+                    len(retryable),
+                    attempt
+                )
+                failed_changes += retryable
+                break
+
+            for index in closed_indices:
+                logger.debug('Opening index: %s', index)
+                await self.open_index_async(index)
+
+            delay = self.get_retry_delay(attempt)
+            attempt += 1
+
+            logger.info(
+                'Retrying %d changes in %.1fs (attempt %d).',
+                len(retryable),
+                delay,
+                attempt
+            )
+            await asyncio.sleep(delay)
+
+            processed_changes = [change for (change, error, ) in retryable]
+
+            # The changes come from a single body, so they fit in one.
+            bulk_body = b''.join(
+                body for (body, changes, ) in self.iter_bulk_bodies(
+                    processed_changes
+                )
+            )
+
+            try:
+                return_value = await self.post_bulk_async(bulk_body)
+            except:
+                logger.exception('Failed to index documents!')
+                raise exceptions.ProcessingError
+
+            if not return_value.get('errors'):
+                break
+
+        if failed_changes:
+            self.handle_failed_changes(failed_changes)
+
+    async def force_into_closed_async(self, return_value, processed_changes):
+        """See `force_into_closed`.
+
+        """
+
+        closed_indices, changes_to_reprocess = self.get_closed_indices(
+            return_value,
+            processed_changes
+        )
+
+        logger.debug('Opening indices: %s', closed_indices)
+        for index in closed_indices:
+            await self.open_index_async(index)
+
+        return await self.persist_changes_async(
+            changes_to_reprocess,
+            exit_on_fail=True
+        )
+
+
+class AsyncSimpleCouchdbChangesProcessor(
+    AsyncHTTPProcessorMixin,
+    couchdb.SimpleCouchdbChangesProcessor
+):
+    """Replicates documents into another database without blocking the
+    event loop.
+
+    """
+
+    def __init__(
+        self,
+        target_couchdb_uri,
+        target_couchdb_name,
+        **kwargs
+    ):
+
+        super(
+            AsyncSimpleCouchdbChangesProcessor,
+            self
+        ).__init__(target_couchdb_uri, target_couchdb_name, **kwargs)
+
+        self._target_couchdb_url = '%s/%s' % (
+            target_couchdb_uri.rstrip('/'),
+            target_couchdb_name,
+        )
+
+        if not self._new_edits:
+            self._source_couchdb_url = '%s/%s' % (
+                kwargs['source_couchdb_uri'].rstrip('/'),
+                kwargs['source_couchdb_name'],
+            )
+
+    async def merge_changes_async(self, processed_changes):
+        """See `merge_changes`.
+
+        """
+
+        processed_docs = [
+            doc for (doc, rev, seq, ) in processed_changes
+        ]
+
+        uncached_docs = self.merge_cached_revs(processed_docs)
+
+        if uncached_docs:
+            await self.merge_existing_revs_async(uncached_docs)
+
+        return processed_docs
+
+    async def merge_existing_revs_async(self, processed_docs):
+        """Fetches the revisions of the target documents and sets them on
+        the processed documents.
+
+        """
+
+        session = self.get_session()
+
+        async with session.post(
+            '%s/_all_docs' % self._target_couchdb_url,
+            json={'keys': [doc['_id'] for doc in processed_docs]}
+        ) as response:
+            response.raise_for_status()
+            existing_results = (await response.json())['rows']
+
+        self.merge_existing_results(processed_docs, existing_results)
+
+    async def retry_conflicted_docs_async(self, conflicted_docs, bulk_results):
+        """See `retry_conflicted_docs`.
+
+        """
+
+        logger.info(
+            'Retrying %d documents that conflicted.',
+            len(conflicted_docs)
+        )
+
+        await self.merge_existing_revs_async(conflicted_docs)
+
+        return self.get_unconflicted_results(bulk_results) + (
+            await self.save_docs_async(
+                conflicted_docs,
+                {'docs': conflicted_docs}
+            )
+        )
+
+    async def save_docs_async(self, processed_docs, bulk_body):
+        """See `save_docs`.
+
+        """
+
+        session = self.get_session()
+
+        async with session.post(
+            '%s/_bulk_docs' % self._target_couchdb_url,
+            json=bulk_body
+        ) as response:
+            response.raise_for_status()
+            bulk_results = await response.json()
+
+        self.update_rev_cache(processed_docs, bulk_results)
+
+        return bulk_results
+
+    async def get_revisions_async(self, processed_docs):
+        """See `get_revisions`.
+
+        """
+
+        session = self.get_session()
+
+        try:
+            async with session.post(
+                '%s/_bulk_get' % self._source_couchdb_url,
+                params={'revs': 'true'},
+                json=self.get_bulk_get_body(processed_docs)
+            ) as response:
+                response.raise_for_status()
+                bulk_get_results = await response.json()
+        except:
+            logger.exception('Failed to fetch revision history')
+            raise exceptions.ProcessingError
+
+        return self.get_revisions_from_results(bulk_get_results)
+
+    async def persist_changes_async(self, processed_changes):
+        """Saves the processed changes in bulk.
+
+        :param processed_changes: a list of (doc, rev, seq) tuples.
+
+        """
+
+        error = False
+
+        processed_docs = [
+            doc for (doc, rev, seq, ) in processed_changes
+        ]
+
+        if self._new_edits:
+            bulk_body = {
+                'docs': processed_docs,
+            }
+        else:
+            bulk_body = self.get_replication_body(
+                processed_docs,
+                await self.get_revisions_async(processed_docs)
+            )
+
+        try:
+            if self._new_edits:
+                await self.merge_changes_async(processed_changes)
+
+            bulk_results = await self.save_docs_async(
+                processed_docs,
+                bulk_body
+            )
+
+            # Only failures are reported when new_edits is false, and
+            # there are no conflicts.
+            if self._new_edits:
+                conflicted_docs = self.get_conflicted_docs(
+                    processed_docs,
+                    bulk_results
+                )
+
+                if conflicted_docs:
+                    bulk_results = await self.retry_conflicted_docs_async(
+                        conflicted_docs,
+                        bulk_results
+                    )
+        except:
+            logger.exception('Failed to insert documents')
+            self.update_rev_cache(processed_docs)
+            error = True
+        else:
+            error = self.has_bulk_errors(bulk_results)
+
+        if error:
+            raise exceptions.ProcessingError
+
+
+class AsyncSimpleS3ChangesProcessor(
+    AsyncChangesProcessorMixin,
+    s3.SimpleS3ChangesProcessor
+):
+    """Stores documents in an s3 bucket from a coroutine.
+
+    boto3 has no non-blocking client, so the uploads still run on the
+    processor's executor; the event loop is free while they are in progress.
+
+    With `max_bytes_in_flight`, uploads are submitted from a thread of the
+    loop's default executor, as waiting for the budget blocks.
+
+    """
+
+    async def persist_changes_async(self, processed_changes):
+        loop = asyncio.get_running_loop()
+
+        if self._archive_batches:
+            await loop.run_in_executor(
+                self._executor,
+                self.persist_changes,
+                processed_changes
+            )
+            return
+
+        if self._upload_budget is not None:
+            # Not on the processor's executor: the uploads are submitted
+            # to it, and must not wait for a worker held by this call.
+            await loop.run_in_executor(
+                None,
+                self.persist_changes,
+                processed_changes
+            )
+            return
+
+        logger.debug(
+            'Starting %d tasks to store documents...',
+            len(processed_changes)
+        )
+
+        key_names = await asyncio.gather(*[
+            loop.run_in_executor(self._executor, self._store_doc, doc_info)
+            for doc_info in processed_changes
+        ])
+
+        logger.debug('Done.')
+
+        for key_name in key_names:
+            logger.debug('Key created in s3: %s', key_name)
@@ -7,12 +7,111 @@ import pycouchdb
 
 from concurrent import futures
 
+from cchain.metrics import base as metrics_base
+
 
 logger = logging.getLogger(__name__)
 
 
 class BaseChangesProcessor(object):
 
+    # Defaults for subclasses whose `__init__` doesn't call this one.
+    _coalesce = False
+    _metrics = metrics_base.BaseMetricsSink()
+    _selector = None
+    _doc_ids = None
+    _changes_filter = None
+    _filter_params = {}
+
+    def __init__(
+        self,
+        coalesce=False,
+        metrics=None,
+        selector=None,
+        doc_ids=None,
+        changes_filter=None,
+        filter_params=None
+    ):
+        """
+
+        :param coalesce: if True, only the latest change to each document
+            in a batch is processed.
+        :param metrics: a subclass of `cchain.metrics.base.BaseMetricsSink`
+            to record request times and sizes in.
+        :param selector: a Mango selector; only changes to documents
+            matching it, and deletions, are sent by couchdb (2.0 or later).
+        :param doc_ids: a list of document ids; only changes to these
+            documents are sent by couchdb.
+        :param changes_filter: the name of a filter function to apply to
+            the _changes stream, e.g. 'my_ddoc/my_filter'.
+        :param filter_params: extra query parameters for `changes_filter`.
+
+        Only one of `selector`, `doc_ids` and `changes_filter` can be set.
+        The filters are applied by couchdb, so changes the processor would
+        drop never come over the wire. They don't apply to backfills from
+        `_all_docs`, so keep dropping unwanted documents in
+        `process_change_line` if you backfill.
+
+        """
+
+        filters = [
+            value for value in (selector, doc_ids, changes_filter, )
+            if value is not None
+        ]
+
+        if len(filters) > 1:
+            raise ValueError(
+                'Only one of selector, doc_ids and changes_filter can be set.'
+            )
+
+        self._coalesce = coalesce
+        self._metrics = metrics or metrics_base.BaseMetricsSink()
+        self._selector = selector
+        self._doc_ids = doc_ids
+        self._changes_filter = changes_filter
+        self._filter_params = filter_params or {}
+
+    def get_feed_filter(self):
+        """Returns the arguments that make couchdb filter the _changes
+        stream for this processor, or None to get all the changes.
+        Override this to build the filter dynamically.
+
+        A `data` item is sent as the json body of the _changes request.
+
+        Deletions always pass the selector: a tombstone only keeps `_id`,
+        `_rev` and `_deleted`, so it would not match a selector on the
+        document's fields and the deletion would never be processed.
+
+        """
+
+        if self._selector is not None:
+            return {
+                'filter': '_selector',
+                'data': {
+                    'selector': {
+                        '$or': [
+                            self._selector,
+                            {'_deleted': True},
+                        ],
+                    },
+                },
+            }
+
+        if self._doc_ids is not None:
+            return {
+                'filter': '_doc_ids',
+                'data': {
+                    'doc_ids': list(self._doc_ids),
+                },
+            }
+
+        if self._changes_filter is not None:
+            feed_filter = dict(self._filter_params)
+            feed_filter['filter'] = self._changes_filter
+            return feed_filter
+
+        return None
+
     def persist_changes(self, processed_changes):
         """Override this with code that persists your processed changes.
         This should either succeed or raise an exception.
@@ -40,7 +139,14 @@ class BaseChangesProcessor(object):
 
         seq = None
 
-        for change_line in changes_buffer:
+        if self._coalesce:
+            # The last change in the buffer is never superseded, so the
+            # last seq of the batch is still reported.
+            change_lines = self.coalesce_changes(changes_buffer)
+        else:
+            change_lines = changes_buffer
+
+        for change_line in change_lines:
             item, rev, seq = self.process_change_line(change_line)
 
             if item is not None:
@@ -50,6 +156,28 @@ class BaseChangesProcessor(object):
 
         return (processed_items, seq, )
 
+    def coalesce_changes(self, changes_buffer):
+        """Drops changes superseded by later changes to the same document
+        in the buffer.
+
+        :param changes_buffer: the list of changes fetched from the _changes
+            stream.
+
+        :returns: a list with the latest change to each document, in the
+            order of the latest changes.
+
+        """
+
+        latest_changes = {}
+
+        for change_line in changes_buffer:
+            doc_id = change_line.get('id')
+            # Re-insert, so the dict is ordered by the latest change.
+            latest_changes.pop(doc_id, None)
+            latest_changes[doc_id] = change_line
+
+        return list(latest_changes.values())
+
     def process_change_line(self, change_line):
         """Override this to proces your changes.
 
@@ -78,9 +206,48 @@ class BaseDocChangesProcessor(BaseChangesProcessor):
 
     """
 
-    def __init__(self, seq_property='_seq'):
+    _seq_property = '_seq'
+    _deep_copy = False
+
+    def __init__(self, seq_property='_seq', deep_copy=False, **kwargs):
+        """
+
+        :param seq_property: the name of the property that will be added
+            to the document to store the relevant change sequence. If `None`,
+            it won't be added at all.
+        :param deep_copy: if True, documents are deep copied before being
+            processed. By default, only the top level of a document is
+            copied, and nested values are shared with the change line. Set
+            this if your processor modifies nested values in place.
+        :param coalesce: if True, only the latest change to each document
+            in a batch is processed.
+
+        """
+
+        super(
+            BaseDocChangesProcessor,
+            self
+        ).__init__(**kwargs)
 
         self._seq_property = seq_property
+        self._deep_copy = deep_copy
+
+    def copy_doc(self, doc):
+        """Returns a copy of the document that can be modified without
+        affecting the original.
+
+        Copying the top level only is enough for setting and popping
+        properties, and avoids copying large nested structures for every
+        change. Nested values are only copied if `deep_copy` was set.
+
+        :param doc: the document to copy.
+
+        """
+
+        if self._deep_copy:
+            return copy.deepcopy(doc)
+
+        return dict(doc)
 
     def process_change_line(self, change_line):
         """Processes a single change line. Override this to modify how each
@@ -114,7 +281,7 @@ class BaseDocChangesProcessor(BaseChangesProcessor):
                 logger.info('Skipping change line: %s', change_line)
                 return
         else:
-            doc = copy.deepcopy(original_doc)
+            doc = self.copy_doc(original_doc)
 
         seq_property = self._seq_property
 
@@ -133,6 +300,7 @@ class BaseESChangesProcessor(BaseDocChangesProcessor):
         es_index,
         bulk_timeout='60s',
         request_timeout=60,
+        http_compress=False,
         **kwargs
     ):
         """
@@ -141,6 +309,9 @@ class BaseESChangesProcessor(BaseDocChangesProcessor):
         :param es_index: the name of the index to store documents in.
         :param bulk_timeout: The timeout for bulk requests to the target
             database (in seconds).
+        :param http_compress: if True, request bodies are gzipped. The
+            elasticsearch==1.4.0 client pinned in requirements.txt ignores
+            it, so only the async processor compresses with that client.
 
         """
 
@@ -151,7 +322,18 @@ class BaseESChangesProcessor(BaseDocChangesProcessor):
 
         self._bulk_timeout = bulk_timeout
         self._request_timeout = request_timeout
-        self._es = elasticsearch.Elasticsearch(es_urls)
+        self._http_compress = http_compress
+
+        es_kwargs = {}
+        if http_compress:
+            es_kwargs['http_compress'] = True
+
+        # elasticsearch-py 8.0 and later take transport options, like the
+        # request timeout, when the client is created rather than per call.
+        if hasattr(elasticsearch.Elasticsearch, 'options'):
+            es_kwargs['request_timeout'] = request_timeout
+
+        self._es = elasticsearch.Elasticsearch(es_urls, **es_kwargs)
         self._es_index = es_index
 
 
@@ -1,4 +1,9 @@
+import collections
+import json
 import logging
+import threading
+
+import pycouchdb
 
 from cchain.processors import base
 from cchain.processors import exceptions
@@ -7,6 +12,39 @@ from cchain.processors import exceptions
 logger = logging.getLogger(__name__)
 
 
+class RevisionCache(object):
+    """A bounded LRU cache of document ids to revisions.
+
+    """
+
+    def __init__(self, max_size):
+
+        self._max_size = max_size
+        self._revs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, doc_id):
+        with self._lock:
+            rev = self._revs.get(doc_id)
+            if rev is not None:
+                self._revs.move_to_end(doc_id)
+            return rev
+
+    def set(self, doc_id, rev):
+        with self._lock:
+            self._revs[doc_id] = rev
+            self._revs.move_to_end(doc_id)
+            while len(self._revs) > self._max_size:
+                self._revs.popitem(last=False)
+
+    def discard(self, doc_id):
+        with self._lock:
+            self._revs.pop(doc_id, None)
+
+    def __len__(self):
+        return len(self._revs)
+
+
 class SimpleCouchdbChangesProcessor(base.BaseCouchdbChangesProcessor):
     """Allows to replicate documents into another database, trasnforming
     them first if necessary.
@@ -27,14 +65,45 @@ class SimpleCouchdbChangesProcessor(base.BaseCouchdbChangesProcessor):
         :param seq_property: the name of the property that will be added
             to the document to store the relevant change sequence. If `None`,
             it won't be added at all.
+        :param rev_cache_size: if set, the revisions of up to this many
+            target documents are cached, so that they only need to be
+            fetched from the target on cache misses or conflicts.
+        :param new_edits: if False, documents are saved with their source
+            revisions and revision history, like replication does. Use this
+            for mirroring documents (transformed or not) while keeping their
+            revision history; target revisions are then never fetched.
+        :param source_couchdb_uri: the uri of the couchdb server the changes
+            come from. Required if `new_edits` is False, to fetch the
+            revision history of the documents.
+        :param source_couchdb_name: the name of the source database.
 
         """
 
+        rev_cache_size = kwargs.pop('rev_cache_size', None)
+        self._new_edits = kwargs.pop('new_edits', True)
+        source_couchdb_uri = kwargs.pop('source_couchdb_uri', None)
+        source_couchdb_name = kwargs.pop('source_couchdb_name', None)
+
         super(
             SimpleCouchdbChangesProcessor,
             self
         ).__init__(target_couchdb_uri, target_couchdb_name, **kwargs)
 
+        if not self._new_edits:
+            if source_couchdb_uri is None or source_couchdb_name is None:
+                raise ValueError(
+                    'new_edits=False requires source_couchdb_uri and '
+                    'source_couchdb_name.'
+                )
+
+            source_server = pycouchdb.Server(source_couchdb_uri)
+            self._source_couchdb = source_server.database(source_couchdb_name)
+
+        if rev_cache_size:
+            self._rev_cache = RevisionCache(rev_cache_size)
+        else:
+            self._rev_cache = None
+
     def process_changes(self, changes_buffer):
         """Saves processed documents in the target couchdb.
 
@@ -59,17 +128,97 @@ class SimpleCouchdbChangesProcessor(base.BaseCouchdbChangesProcessor):
 
         """
 
-        doc_ids = []
-        processed_docs = []
+        processed_docs = [
+            doc for (doc, rev, seq, ) in processed_changes
+        ]
+
+        uncached_docs = self.merge_cached_revs(processed_docs)
 
-        for (doc, rev, seq, ) in processed_changes:
-            doc_ids.append(doc['_id'])
-            processed_docs.append(doc)
+        if uncached_docs:
+            with self._metrics.timer('couchdb_all_docs'):
+                existing_results = self._target_couchdb.all(
+                    keys=[doc['_id'] for doc in uncached_docs]
+                )
 
-        existing_results = self._target_couchdb.all(
-            keys=doc_ids
+            self.merge_existing_results(uncached_docs, existing_results)
+
+        return processed_docs
+
+    def merge_cached_revs(self, processed_docs):
+        """Sets the cached revisions of target documents on the processed
+        documents.
+
+        :param processed_docs: a list of documents to store in couch.
+
+        :returns: the list of documents whose target revisions are not
+            cached.
+
+        """
+
+        rev_cache = self._rev_cache
+
+        if rev_cache is None:
+            return processed_docs
+
+        uncached_docs = []
+
+        for processed_doc in processed_docs:
+            rev = rev_cache.get(processed_doc['_id'])
+            if rev is None:
+                uncached_docs.append(processed_doc)
+            else:
+                processed_doc['_rev'] = rev
+
+        logger.debug(
+            'Revisions of %d out of %d documents cached.',
+            len(processed_docs) - len(uncached_docs),
+            len(processed_docs)
         )
 
+        return uncached_docs
+
+    def update_rev_cache(self, processed_docs, bulk_results=None):
+        """Caches the target revisions returned from a bulk request.
+        Documents that failed to save, e.g. because of a conflict, are
+        dropped from the cache so they are fetched again.
+
+        :param processed_docs: the documents sent in the bulk request.
+        :param bulk_results: the results of the bulk request, or None if
+            the request failed.
+
+        """
+
+        rev_cache = self._rev_cache
+
+        if rev_cache is None:
+            return
+
+        if bulk_results is None:
+            for processed_doc in processed_docs:
+                rev_cache.discard(processed_doc['_id'])
+            return
+
+        for processed_doc, bulk_result in zip(processed_docs, bulk_results):
+            doc_id = processed_doc['_id']
+            rev = bulk_result.get('rev') or bulk_result.get('_rev')
+
+            if bulk_result.get('error') or rev is None:
+                rev_cache.discard(doc_id)
+            else:
+                rev_cache.set(doc_id, rev)
+
+    def merge_existing_results(self, processed_docs, existing_results):
+        """Sets the revisions of existing target documents on the processed
+        documents.
+
+        :param processed_docs: a list of documents to store in couch.
+        :param existing_results: the rows returned from `_all_docs` for
+            the ids of the processed documents.
+
+        :returns: the list of documents to store in couch.
+
+        """
+
         for existing_result, processed_doc in zip(
             existing_results, processed_docs
         ):
@@ -80,27 +229,248 @@ class SimpleCouchdbChangesProcessor(base.BaseCouchdbChangesProcessor):
         return processed_docs
 
     def persist_changes(self, processed_changes):
-        """Saves the processed changes in bulk.
+        """Saves the processed changes in bulk. Documents that conflict are
+        saved once more with their target revisions fetched again.
 
         :param processed_changes: a list of (doc, rev, seq) tuples.
 
         """
 
+        if not self._new_edits:
+            return self.replicate_changes(processed_changes)
+
         processed_docs = self.merge_changes(processed_changes)
 
         error = False
 
         try:
+            bulk_results = self.save_docs(processed_docs)
+
+            conflicted_docs = self.get_conflicted_docs(
+                processed_docs,
+                bulk_results
+            )
+
+            if conflicted_docs:
+                bulk_results = self.retry_conflicted_docs(
+                    conflicted_docs,
+                    bulk_results
+                )
+        except:
+            logger.exception('Failed to insert documents')
+            self.update_rev_cache(processed_docs)
+            error = True
+        else:
+            error = self.has_bulk_errors(bulk_results)
+
+        if error:
+            raise exceptions.ProcessingError
+
+    def save_docs(self, processed_docs):
+        """Saves the documents in bulk and caches their new revisions.
+
+        :returns: the results of the bulk request.
+
+        """
+
+        with self._metrics.timer('couchdb_bulk_docs'):
             bulk_results = self._target_couchdb.save_bulk(processed_docs)
+
+        self.update_rev_cache(processed_docs, bulk_results)
+
+        return bulk_results
+
+    def retry_conflicted_docs(self, conflicted_docs, bulk_results):
+        """Saves the documents that conflicted once more, with the
+        revisions fetched again from the target. A conflict usually means
+        the cached revision was stale, or the target document was updated
+        since its revision was fetched.
+
+        :param conflicted_docs: the documents that failed with a conflict.
+        :param bulk_results: the results of the first bulk request.
+
+        :returns: the results of the first bulk request that didn't
+            conflict, followed by the results of the retry.
+
+        """
+
+        logger.info(
+            'Retrying %d documents that conflicted.',
+            len(conflicted_docs)
+        )
+
+        with self._metrics.timer('couchdb_all_docs'):
+            existing_results = self._target_couchdb.all(
+                keys=[doc['_id'] for doc in conflicted_docs]
+            )
+
+        self.merge_existing_results(conflicted_docs, existing_results)
+
+        return self.get_unconflicted_results(bulk_results) + (
+            self.save_docs(conflicted_docs)
+        )
+
+    def get_conflicted_docs(self, processed_docs, bulk_results):
+        """Returns the documents that failed to save because of a
+        conflict.
+
+        :param processed_docs: the documents sent in the bulk request.
+        :param bulk_results: the results of the bulk request.
+
+        """
+
+        return [
+            processed_doc
+            for processed_doc, bulk_result in zip(
+                processed_docs,
+                bulk_results
+            )
+            if bulk_result.get('error') == 'conflict'
+        ]
+
+    def get_unconflicted_results(self, bulk_results):
+        """Returns the bulk results of the documents that didn't fail with
+        a conflict.
+
+        """
+
+        return [
+            bulk_result for bulk_result in bulk_results
+            if bulk_result.get('error') != 'conflict'
+        ]
+
+    def replicate_changes(self, processed_changes):
+        """Saves the processed changes with their source revisions and
+        revision history, the way replication does (`new_edits=false`).
+        There is no need to fetch target revisions first, and no conflicts
+        can occur.
+
+        :param processed_changes: a list of (doc, rev, seq) tuples.
+
+        """
+
+        processed_docs = [
+            doc for (doc, rev, seq, ) in processed_changes
+        ]
+
+        revisions = self.get_revisions(processed_docs)
+
+        error = False
+
+        try:
+            (response, bulk_results) = self._target_couchdb.resource.post(
+                '_bulk_docs',
+                data=json.dumps(
+                    self.get_replication_body(processed_docs, revisions)
+                )
+            )
         except:
             logger.exception('Failed to insert documents')
             error = True
         else:
-            for bulk_result in bulk_results:
-                if bulk_result.get('error'):
-                    logger.error('Errors executing bulk!')
-                    error = True
-                    break
+            # Only failures are reported when new_edits is false.
+            error = self.has_bulk_errors(bulk_results or [])
 
         if error:
             raise exceptions.ProcessingError
+
+    def get_revisions(self, processed_docs):
+        """Fetches the revision history of the documents from the source
+        database, with `_bulk_get` (couchdb 2.0 or later).
+
+        :param processed_docs: a list of documents to store in couch.
+
+        :returns: the `_revisions` of each document, in the same order.
+
+        """
+
+        try:
+            with self._metrics.timer('couchdb_bulk_get'):
+                (response, bulk_get_results) = (
+                    self._source_couchdb.resource.post(
+                        '_bulk_get',
+                        params={'revs': 'true'},
+                        data=json.dumps(self.get_bulk_get_body(processed_docs))
+                    )
+                )
+        except:
+            logger.exception('Failed to fetch revision history')
+            raise exceptions.ProcessingError
+
+        return self.get_revisions_from_results(bulk_get_results)
+
+    def get_bulk_get_body(self, processed_docs):
+        """Returns the `_bulk_get` request body that fetches the source
+        revisions of the documents.
+
+        """
+
+        return {
+            'docs': [
+                {'id': doc['_id'], 'rev': doc['_rev']}
+                for doc in processed_docs
+            ],
+        }
+
+    def get_revisions_from_results(self, bulk_get_results):
+        """Extracts the revision history of each document from
+        a `_bulk_get?revs=true` response.
+
+        :returns: a list of `_revisions` dicts.
+
+        """
+
+        revisions = []
+
+        for result in bulk_get_results['results']:
+            doc_result = result['docs'][0]
+
+            if 'ok' not in doc_result:
+                logger.error(
+                    'Failed to fetch the history of %s: %s',
+                    result.get('id'),
+                    doc_result.get('error')
+                )
+                raise exceptions.ProcessingError
+
+            revisions.append(doc_result['ok']['_revisions'])
+
+        return revisions
+
+    def get_replication_body(self, processed_docs, revisions):
+        """Returns the `_bulk_docs` request body that stores the documents
+        with their source revisions and history.
+
+        :param processed_docs: a list of documents to store in couch.
+        :param revisions: the `_revisions` of each document, as returned
+            from `get_revisions`.
+
+        """
+
+        docs = []
+
+        for processed_doc, doc_revisions in zip(processed_docs, revisions):
+            doc = dict(processed_doc)
+            doc['_revisions'] = doc_revisions
+            docs.append(doc)
+
+        return {
+            'docs': docs,
+            'new_edits': False,
+        }
+
+    def has_bulk_errors(self, bulk_results):
+        """Checks the results of a bulk request for errors.
+
+        :param bulk_results: the results returned from `_bulk_docs`.
+
+        :returns: True if any of the documents failed to save.
+
+        """
+
+        for bulk_result in bulk_results:
+            if bulk_result.get('error'):
+                logger.error('Errors executing bulk!')
+                return True
+
+        return False
@@ -1,4 +1,5 @@
 import datetime
+import json
 import logging
 import redis
 import time
@@ -9,6 +10,20 @@ from cchain.processors import base
 logger = logging.getLogger(__name__)
 
 
+# Adds the members of a chunk to the target set, keeping the lowest score
+# of each member. Used with servers that don't support `ZADD LT`.
+ZADD_MIN_SCRIPT = """
+local timestamp = tonumber(ARGV[1])
+for i = 2, #ARGV do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if (not score) or (tonumber(score) > timestamp) then
+        redis.call('ZADD', KEYS[1], timestamp, ARGV[i])
+    end
+end
+return #ARGV - 1
+"""
+
+
 class RedisEntityProcessor(base.BaseChangesProcessor):
     """Intended for processing changes coming from multiple sources.
     Assumes that the only information passed with each change is the
@@ -16,30 +31,62 @@ class RedisEntityProcessor(base.BaseChangesProcessor):
 
     """
 
+    merge_modes = ('lt', 'nx', 'lua', )
+
     def __init__(
         self,
         source_set_name,
         target_set_name,
         redis_host='localhost',
         redis_port=6379,
-        redis_db=0
+        redis_db=0,
+        merge_mode='lt',
+        chunk_size=1000,
+        **kwargs
     ):
         """
 
         :param redis_host: the host name of the redis server to use.
         :param redis_port: the port name of the redis server to use.
-        :param source_set: the set to add the batches.
-        :param target_set: the set to merge the source set with.
+        :param source_set: no longer used, the entities are merged into
+            the target set directly. Kept for backwards compatibility.
+        :param target_set: the set to merge the entities into, keeping the
+            earliest timestamp of each entity.
+        :param merge_mode: how the earliest timestamp is kept: 'lt' uses
+            `ZADD ... LT` (redis >= 6.2), 'nx' uses `ZADD ... NX` (only
+            correct if the timestamps of all writers never decrease) and
+            'lua' uses a script, for older servers.
+        :param chunk_size: the maximum number of entities sent in a single
+            command.
+        :param coalesce: if True, each entity is only added once per batch.
 
         """
+
+        super(
+            RedisEntityProcessor,
+            self
+        ).__init__(**kwargs)
+
+        if merge_mode not in self.merge_modes:
+            raise ValueError(
+                'merge_mode must be one of: %s' % ', '.join(self.merge_modes)
+            )
+
         self._source_set_name = source_set_name
         self._target_set_name = target_set_name
+        self._merge_mode = merge_mode
+        self._chunk_size = chunk_size
         self._redis_server = redis.StrictRedis(
             host=redis_host,
             port=redis_port,
             db=redis_db
         )
 
+        if merge_mode == 'lua':
+            self._zadd_min = self._redis_server.register_script(
+                ZADD_MIN_SCRIPT
+            )
+
     def process_change_line(self, change_line):
         """Returns the id of the document affected by the change.
 
@@ -54,26 +101,59 @@ class RedisEntityProcessor(base.BaseChangesProcessor):
 
         return (doc_id, rev, seq, )
 
+    def get_chunks(self, entity_ids):
+        """Splits the entity ids into lists of at most `chunk_size`.
+
+        """
+
+        chunk_size = self._chunk_size
+
+        for start in range(0, len(entity_ids), chunk_size):
+            yield entity_ids[start:start + chunk_size]
+
+    def add_chunk(self, pipeline, timestamp, entity_ids):
+        """Queues the command merging a chunk of entities into the target
+        set.
+
+        """
+
+        target_set_name = self._target_set_name
+
+        if self._merge_mode == 'lua':
+            self._zadd_min(
+                keys=[target_set_name],
+                args=[timestamp] + entity_ids,
+                client=pipeline
+            )
+        else:
+            pipeline.zadd(
+                target_set_name,
+                dict.fromkeys(entity_ids, timestamp),
+                nx=self._merge_mode == 'nx',
+                lt=self._merge_mode == 'lt'
+            )
+
     def persist_changes(self, processed_changes):
+        """Merges the entities into the target set in a single transaction,
+        sent in one round trip.
+
+        :param processed_changes: a list of (entity_id, rev, seq) tuples.
+
+        """
+
         now = datetime.datetime.now()
         timestamp = time.mktime(now.timetuple())
 
-        set_elements = []
-        for (entity_id, rev, seq, ) in processed_changes:
-            set_elements += [
-                timestamp,
-                entity_id,
-            ]
-
-        redis_server = self._redis_server
-        source_set_name = self._source_set_name
-        redis_server.zadd(source_set_name, *set_elements)
-        redis_server.zunionstore(
-            self._target_set_name,
-            [source_set_name],
-            aggregate='MIN'
-        )
-        redis_server.delete([source_set_name])
+        entity_ids = [
+            entity_id for (entity_id, rev, seq, ) in processed_changes
+        ]
+
+        pipeline = self._redis_server.pipeline(transaction=True)
+
+        for chunk in self.get_chunks(entity_ids):
+            self.add_chunk(pipeline, timestamp, chunk)
+
+        pipeline.execute()
 
     def process_changes(self, changes_buffer):
 
@@ -83,3 +163,111 @@ class RedisEntityProcessor(base.BaseChangesProcessor):
         ).process_changes(changes_buffer)
 
         return processed_changes, last_seq
+
+
+class RedisStreamProcessor(base.BaseChangesProcessor):
+    """Appends changes to a redis stream, so that they can be consumed by
+    any number of downstream workers with consumer groups.
+
+    Each entry has the `id`, `rev` and `seq` of the change, `deleted` set
+    to '1' for deletions and, if `include_docs` is set, the document
+    serialized as json in `doc`.
+
+    Streams need redis 5.0 or later on the server, and `xadd` needs
+    redis-py 3.0 or later (the pinned 4.x client has it).
+
+    """
+
+    def __init__(
+        self,
+        stream_name,
+        redis_host='localhost',
+        redis_port=6379,
+        redis_db=0,
+        max_len=None,
+        approximate=True,
+        include_docs=False,
+        chunk_size=1000,
+        **kwargs
+    ):
+        """
+
+        :param stream_name: the name of the stream to add the changes to.
+        :param redis_host: the host name of the redis server to use.
+        :param redis_port: the port name of the redis server to use.
+        :param max_len: if set, the stream is trimmed to about this many
+            entries when changes are added.
+        :param approximate: if True, the stream is trimmed with `MAXLEN ~`,
+            which is much cheaper for the server, but may keep a few more
+            entries than `max_len`.
+        :param include_docs: if True, the documents fetched with the changes
+            are added to the entries.
+        :param chunk_size: the maximum number of entries sent in a single
+            round trip.
+        :param coalesce: if True, each document is only added once per batch.
+
+        """
+
+        super(
+            RedisStreamProcessor,
+            self
+        ).__init__(**kwargs)
+
+        self._stream_name = stream_name
+        self._max_len = max_len
+        self._approximate = approximate
+        self._include_docs = include_docs
+        self._chunk_size = chunk_size
+        self._redis_server = redis.StrictRedis(
+            host=redis_host,
+            port=redis_port,
+            db=redis_db
+        )
+
+    def process_change_line(self, change_line):
+        """Returns the fields of the stream entry for the change.
+
+        """
+
+        (change_line, rev, seq, ) = super(
+            RedisStreamProcessor,
+            self
+        ).process_change_line(change_line)
+
+        fields = {
+            'id': change_line['id'],
+            'rev': rev,
+            'seq': str(seq),
+        }
+
+        if change_line.get('deleted'):
+            fields['deleted'] = '1'
+
+        if self._include_docs:
+            doc = change_line.get('doc')
+            if doc is not None:
+                fields['doc'] = json.dumps(doc)
+
+        return (fields, rev, seq, )
+
+    def persist_changes(self, processed_changes):
+        """Adds the entries to the stream in pipelined chunks.
+
+        :param processed_changes: a list of (fields, rev, seq) tuples.
+
+        """
+
+        pipeline = self._redis_server.pipeline(transaction=False)
+
+        for i, (fields, rev, seq, ) in enumerate(processed_changes, 1):
+            pipeline.xadd(
+                self._stream_name,
+                fields,
+                maxlen=self._max_len,
+                approximate=self._approximate
+            )
+
+            if i % self._chunk_size == 0:
+                pipeline.execute()
+
+        pipeline.execute()
@@ -1,5 +1,10 @@
-import copy
+import io
+import json
 import logging
+import time
+import zlib
+
+from concurrent import futures
 
 from cchain.processors import base
 from cchain.processors import exceptions
@@ -8,6 +13,80 @@ from cchain.processors import exceptions
 logger = logging.getLogger(__name__)
 
 
+class BulkBodyBuilder(object):
+    """Serializes bulk operations as NDJSON and splits them into request
+    bodies of at most `max_bytes` bytes.
+
+    A builder can be shared by threads: each call to `iter_bodies` writes
+    into a buffer of its own.
+
+    """
+
+    def __init__(self, max_bytes=None):
+        """
+
+        :param max_bytes: the maximum size of a request body. A single
+            document bigger than that is sent in a request of its own.
+            If None, all the operations go into one body.
+
+        """
+
+        self._max_bytes = max_bytes
+
+    def serialize(self, ops):
+        """Returns the NDJSON lines for the given operations.
+
+        """
+
+        return b''.join(
+            json.dumps(op, separators=(',', ':')).encode('utf-8') + b'\n'
+            for op in ops
+        )
+
+    def iter_bodies(self, ops_and_items):
+        """Yields request bodies along with the items whose operations
+        they contain.
+
+        :param ops_and_items: an iterable of (ops, item) tuples, where ops
+            is a list of bulk operations for the item.
+
+        :returns: a generator of (body, items) tuples.
+
+        """
+
+        # The generator is suspended while its bodies are sent, so the
+        # buffer mustn't be shared with other calls.
+        buffer = io.BytesIO()
+        max_bytes = self._max_bytes
+        items = []
+
+        for ops, item in ops_and_items:
+            data = self.serialize(ops)
+
+            if (
+                max_bytes is not None and
+                items and
+                buffer.tell() + len(data) > max_bytes
+            ):
+                yield buffer.getvalue(), items
+                buffer.seek(0)
+                buffer.truncate()
+                items = []
+
+            if max_bytes is not None and len(data) > max_bytes:
+                logger.warning(
+                    'Bulk operations of %d bytes exceed the limit of %d.',
+                    len(data),
+                    max_bytes
+                )
+
+            buffer.write(data)
+            items.append(item)
+
+        if items:
+            yield buffer.getvalue(), items
+
+
 class SimpleESChangesProcessor(base.BaseESChangesProcessor):
     """Stores documents in elasticsearch.
 
@@ -22,18 +101,66 @@ class SimpleESChangesProcessor(base.BaseESChangesProcessor):
         :param seq_property: the name of the property that will be added
             to the document to store the relevant change sequence. If `None`,
             it won't be added at all.
+        :param max_bulk_bytes: if set, changes are serialized to NDJSON
+            and sent in bulk requests of at most this many bytes.
+        :param max_retries: how many times items rejected by es (e.g. 429,
+            version conflicts or closed indices, if `auto_open` is set) are
+            resubmitted before giving up on them. If 0, any error fails
+            the whole batch.
+        :param retry_backoff: the delay before the first retry, in seconds.
+            It doubles with every retry.
+        :param max_retry_backoff: the maximum delay between retries.
+        :param bulk_concurrency: if greater than 1, each batch is split into
+            up to this many groups by document id, which are sent at the
+            same time. The es client spreads them over its connection pool
+            for `es_urls`.
+        :param versioning: if set to 'rev' or 'seq', documents are indexed
+            whole with an external version taken from the generation of
+            their revision or from their change seq, instead of being
+            upserted. Replayed changes then come back as version conflicts,
+            which are ignored.
+        :param version_type: the es version type to use with `versioning`,
+            'external' by default.
 
         """
 
         self._retry_on_conflict = kwargs.pop('retry_on_conflict', 3)
         self._auto_open = kwargs.pop('auto_open', False)
+        self._max_bulk_bytes = kwargs.pop('max_bulk_bytes', None)
+        self._max_retries = kwargs.pop('max_retries', 0)
+        self._retry_backoff = kwargs.pop('retry_backoff', 0.5)
+        self._max_retry_backoff = kwargs.pop('max_retry_backoff', 30)
+        self._bulk_concurrency = kwargs.pop('bulk_concurrency', 1)
+        self._versioning = kwargs.pop('versioning', None)
+        self._version_type = kwargs.pop(
+            'version_type',
+            'external' if self._versioning is not None else None
+        )
 
         super(
             SimpleESChangesProcessor,
             self
         ).__init__(es_urls, es_index, **kwargs)
 
+        if self._versioning not in (None, 'rev', 'seq'):
+            raise ValueError(
+                'versioning must be one of None, "rev" or "seq".'
+            )
+
+        if self._versioning == 'seq' and self._seq_property is None:
+            raise ValueError('versioning by seq requires a seq_property.')
+
         self._es_type = es_type
+        self._bulk_body_builder = BulkBodyBuilder(self._max_bulk_bytes)
+
+        if self._bulk_concurrency > 1:
+            self._bulk_executor = futures.ThreadPoolExecutor(
+                max_workers=self._bulk_concurrency
+            )
+
+    def cleanup(self):
+        if self._bulk_concurrency > 1:
+            self._bulk_executor.shutdown()
 
     def get_index(self, doc):
         """Override this to send documents do various indices, depending
@@ -81,35 +208,206 @@ class SimpleESChangesProcessor(base.BaseESChangesProcessor):
         :param exit_on_fail: a boolean to determine if an exception should be raised
             if ElasticSearch index errors occur.
         """
-        bulk_ops = []
 
-        for (doc, rev, seq, ) in processed_changes:
-            doc_ops = self.get_ops_for_bulk(doc)
-            bulk_ops += doc_ops
+        if self._bulk_concurrency > 1:
+            return self.execute_concurrent_bulks(
+                processed_changes,
+                exit_on_fail=exit_on_fail
+            )
 
-        error = False
+        return self.execute_bulks(processed_changes, exit_on_fail=exit_on_fail)
 
-        try:
-            return_value = self._es.bulk(
+    def execute_bulks(self, processed_changes, exit_on_fail=False):
+        """Sends the processed changes in a single bulk request, or in
+        requests of at most `max_bulk_bytes`, one after the other.
+
+        :param processed_changes: a list of (doc, rev, seq) tuples.
+        :param exit_on_fail: a boolean to determine if an exception should
+            be raised if ElasticSearch index errors occur.
+
+        """
+
+        if self._max_bulk_bytes is None:
+            bulk_ops = self.get_bulk_ops(processed_changes)
+            return self.execute_bulk(
                 bulk_ops,
-                timeout=self._bulk_timeout,
-                request_timeout=self._request_timeout
+                processed_changes,
+                exit_on_fail=exit_on_fail
             )
+
+        for bulk_body, changes in self.iter_bulk_bodies(processed_changes):
+            self.execute_bulk(bulk_body, changes, exit_on_fail=exit_on_fail)
+
+    def iter_bulk_bodies(self, processed_changes):
+        """Serializes the processed changes into NDJSON bulk request bodies
+        no bigger than `max_bulk_bytes`.
+
+        :param processed_changes: a list of (doc, rev, seq) tuples.
+
+        :returns: a generator of (body, changes) tuples, where changes are
+            the processed changes included in the body.
+
+        """
+
+        return self._bulk_body_builder.iter_bodies(
+            (self.get_ops_for_bulk(change[0]), change)
+            for change in processed_changes
+        )
+
+    def execute_bulk(self, bulk_body, processed_changes, exit_on_fail=False):
+        """Sends a bulk request to es and checks the results.
+
+        :param bulk_body: a list of bulk operations, or a serialized
+            request body.
+        :param processed_changes: the processed changes included in the
+            request, in the same order.
+        :param exit_on_fail: a boolean to determine if an exception should
+            be raised if ElasticSearch index errors occur.
+
+        """
+
+        if isinstance(bulk_body, bytes):
+            self._metrics.increment('es_bulk_bytes', len(bulk_body))
+
+        try:
+            with self._metrics.timer('es_bulk'):
+                return_value = self.send_bulk(bulk_body)
         except:
             logger.exception('Failed to index documents!')
-            error = True
-        else:
-            if return_value.get('errors'):
-                if self._auto_open and exit_on_fail is False:
-                    return self.force_into_closed(
-                        return_value, processed_changes
-                    )
+            raise exceptions.ProcessingError
+
+        return self.check_bulk_result(
+            return_value,
+            processed_changes,
+            exit_on_fail=exit_on_fail
+        )
+
+    def execute_concurrent_bulks(self, processed_changes, exit_on_fail=False):
+        """Splits the processed changes into groups by document id and
+        sends the groups to es at the same time. All the changes to
+        a document are in the same group, in order, so they are applied
+        in the order of the feed.
+
+        :param processed_changes: a list of (doc, rev, seq) tuples.
+        :param exit_on_fail: a boolean to determine if an exception should
+            be raised if ElasticSearch index errors occur.
+
+        """
+
+        sub_bulk_futures = [
+            self._bulk_executor.submit(
+                self.execute_bulks,
+                changes,
+                exit_on_fail=exit_on_fail
+            )
+            for changes in self.get_sub_bulks(processed_changes)
+        ]
+
+        # Wait for all the requests, so none is in flight if this fails.
+        errors = [future.exception() for future in sub_bulk_futures]
+
+        for error in errors:
+            if error is not None:
+                raise exceptions.ProcessingError
+
+    def get_sub_bulk(self, doc):
+        """Returns the number of the sub-bulk the document's operations go
+        into. Uses crc32 rather than `hash`, which is randomised per
+        process.
+
+        :param doc: the document to be indexed.
+
+        """
+
+        return zlib.crc32(doc['_id'].encode('utf-8')) % self._bulk_concurrency
+
+    def get_sub_bulks(self, processed_changes):
+        """Splits the processed changes into up to `bulk_concurrency`
+        groups to send concurrently, keeping all the changes to a document
+        in the same group and in order.
+
+        :param processed_changes: a list of (doc, rev, seq) tuples.
+
+        :returns: a list of lists of processed changes.
+
+        """
+
+        sub_bulks = [[] for i in range(self._bulk_concurrency)]
+
+        for change in processed_changes:
+            sub_bulks[self.get_sub_bulk(change[0])].append(change)
+
+        return [changes for changes in sub_bulks if changes]
+
+    def has_errors(self, return_value):
+        """Checks a bulk response for errors other than stale versions.
+
+        """
+
+        if self._versioning is None:
+            return True
+
+        for item in return_value.get('items', []):
+            result = self.get_item_result(item)
+            if result.get('error') and not self.is_stale_version(result):
+                return True
+
+        return False
+
+    def send_bulk(self, bulk_body):
+        """Sends a single bulk request to es.
+
+        :param bulk_body: a list of bulk operations, or a serialized
+            request body.
+
+        :returns: the bulk api response.
+
+        """
+
+        bulk_kwargs = {
+            'timeout': self._bulk_timeout,
+        }
+
+        # Newer clients got the request timeout when they were created.
+        if not hasattr(self._es, 'options'):
+            bulk_kwargs['request_timeout'] = self._request_timeout
+
+        # Newer clients reject positional arguments, and wrap the decoded
+        # response in an object with a `body`.
+        response = self._es.bulk(body=bulk_body, **bulk_kwargs)
+
+        return getattr(response, 'body', response)
 
-                logger.debug('ES response: %s', return_value)
-                logger.error('Errors executing bulk!')
-                error = True
+    def check_bulk_result(
+        self,
+        return_value,
+        processed_changes,
+        exit_on_fail=False
+    ):
+        """Checks the response of a bulk request for errors, retrying or
+        reopening closed indices if configured to.
 
-        if error:
+        :param return_value: The value returned from the bulk call.
+        :param processed_changes: changes submitted in the bulk call, in the
+            same order.
+        :param exit_on_fail: a boolean to determine if an exception should
+            be raised if ElasticSearch index errors occur.
+
+        """
+
+        if return_value.get('errors') and self.has_errors(return_value):
+            if self._max_retries:
+                return self.retry_failed_items(
+                    return_value, processed_changes
+                )
+
+            if self._auto_open and exit_on_fail is False:
+                return self.force_into_closed(
+                    return_value, processed_changes
+                )
+
+            logger.debug('ES response: %s', return_value)
+            logger.error('Errors executing bulk!')
             raise exceptions.ProcessingError
 
     def force_into_closed(self, return_value, processed_changes):
@@ -122,15 +420,43 @@ class SimpleESChangesProcessor(base.BaseESChangesProcessor):
 
         """
 
+        closed_indices, changes_to_reprocess = self.get_closed_indices(
+            return_value,
+            processed_changes
+        )
+
+        logger.debug('Opening indices: %s', closed_indices)
+        for index in closed_indices:
+            self._es.indices.open(index=index)
+
+        # Don't go through persist_changes, as this may run on the
+        # executor of concurrent bulks already.
+        return self.execute_bulks(
+            changes_to_reprocess,
+            exit_on_fail=True
+        )
+
+    def get_closed_indices(self, return_value, processed_changes):
+        """Finds the indices that were closed when executing a bulk request,
+        and the changes that need to be reprocessed.
+
+        :param return_value: The value returned from the bulk call.
+        :param processed_changes: changes submitted for processing.
+
+        :returns: a tuple comprising the set of closed indices and the
+            list of changes to reprocess.
+
+        """
+
         items = return_value['items']
         closed_indices = set([])
         changes_to_reprocess = []
 
         for item, change in zip(items, processed_changes):
-            result = item.get('update') or item.get('delete')
+            result = self.get_item_result(item)
             error = result.get('error')
 
-            if not error:
+            if not error or self.is_stale_version(result):
                 continue
 
             if error['reason'] == 'closed':
@@ -138,18 +464,217 @@ class SimpleESChangesProcessor(base.BaseESChangesProcessor):
 
             changes_to_reprocess.append(change)
 
-        logger.debug('Opening indices: %s', closed_indices)
-        for index in closed_indices:
-            self._es.indices.open(index)
+        return closed_indices, changes_to_reprocess
 
-        return self.persist_changes(
-            changes_to_reprocess,
-            exit_on_fail=True
+    def is_stale_version(self, result):
+        """Tells whether an operation failed only because es already has
+        the same or a newer version of the document, which is expected
+        when changes are replayed with `versioning` set.
+
+        """
+
+        return self._versioning is not None and result.get('status') == 409
+
+    def get_item_result(self, item):
+        """Returns the result of an operation from a bulk response item,
+        whatever the type of the operation.
+
+        """
+
+        return next(iter(item.values()))
+
+    def is_retryable(self, result):
+        """Tells whether a failed bulk item is worth resubmitting.
+        Override this to retry other kinds of errors.
+
+        :param result: the result of a failed bulk operation.
+
+        """
+
+        return result.get('status') in (409, 429, 503)
+
+    def get_closed_index(self, result):
+        """Returns the name of the closed index that caused the operation
+        to fail, if any.
+
+        """
+
+        error = result.get('error')
+
+        if not isinstance(error, dict):
+            return None
+
+        if (
+            error.get('reason') == 'closed' or
+            error.get('type') == 'index_closed_exception'
+        ):
+            return error.get('index')
+
+        return None
+
+    def split_failed_changes(self, return_value, processed_changes):
+        """Sorts the changes that failed in a bulk request into the ones
+        that can be retried and the ones that failed for good.
+
+        :param return_value: The value returned from the bulk call.
+        :param processed_changes: changes submitted in the bulk call.
+
+        :returns: a tuple comprising the list of (change, error) tuples to
+            retry, the list of (change, error) tuples that failed for good
+            and the set of closed indices to open before retrying.
+
+        """
+
+        retryable = []
+        failed = []
+        closed_indices = set([])
+
+        for item, change in zip(return_value['items'], processed_changes):
+            result = self.get_item_result(item)
+            error = result.get('error')
+
+            if not error or self.is_stale_version(result):
+                continue
+
+            closed_index = self.get_closed_index(result)
+
+            if closed_index is not None and self._auto_open:
+                closed_indices.add(closed_index)
+                retryable.append((change, error))
+            elif self.is_retryable(result):
+                retryable.append((change, error))
+            else:
+                failed.append((change, error))
+
+        return retryable, failed, closed_indices
+
+    def get_retry_delay(self, attempt):
+        """Returns the time to wait before the given retry, in seconds.
+
+        """
+
+        return min(
+            self._retry_backoff * (2 ** attempt),
+            self._max_retry_backoff
         )
 
+    def retry_failed_items(self, return_value, processed_changes):
+        """Resubmits the items that failed in a bulk request, with
+        exponential backoff, until they succeed or `max_retries` is
+        exhausted.
+
+        :param return_value: The value returned from the initial bulk call.
+        :param processed_changes: changes originally submitted for processing.
+
+        """
+
+        failed_changes = []
+        attempt = 0
+
+        while True:
+            retryable, failed, closed_indices = self.split_failed_changes(
+                return_value,
+                processed_changes
+            )
+            failed_changes += failed
+
+            if not retryable:
+                break
+
+            if attempt >= self._max_retries:
+                logger.error(
+                    'Giving up on %d changes after %d retries.',
+                    len(retryable),
+                    attempt
+                )
+                failed_changes += retryable
+                break
+
+            for index in closed_indices:
+                logger.debug('Opening index: %s', index)
+                self._es.indices.open(index=index)
+
+            delay = self.get_retry_delay(attempt)
+            attempt += 1
+
+            logger.info(
+                'Retrying %d changes in %.1fs (attempt %d).',
+                len(retryable),
+                delay,
+                attempt
+            )
+            time.sleep(delay)
+
+            processed_changes = [change for (change, error, ) in retryable]
+
+            try:
+                return_value = self.send_bulk(
+                    self.get_bulk_ops(processed_changes)
+                )
+            except:
+                logger.exception('Failed to index documents!')
+                raise exceptions.ProcessingError
+
+            if not return_value.get('errors'):
+                break
+
+        if failed_changes:
+            self.handle_failed_changes(failed_changes)
+
+    def handle_failed_changes(self, failed_changes):
+        """Called with the changes that could not be stored in es even
+        after retrying. Override this to report them somewhere else (e.g.
+        a dead letter queue) and carry on. By default, the whole batch
+        fails.
+
+        :param failed_changes: a list of (change, error) tuples, where
+            change is a (doc, rev, seq) tuple.
+
+        """
+
+        for (change, error, ) in failed_changes:
+            logger.error('Failed to index %s: %s', change[0].get('_id'), error)
+
+        raise exceptions.ProcessingError
+
+    def get_bulk_ops(self, processed_changes):
+        """Returns the operations to pass to the bulk api for all
+        the processed changes.
+
+        :param processed_changes: a list of (doc, rev, seq) tuples.
+
+        """
+
+        bulk_ops = []
+
+        for (doc, rev, seq, ) in processed_changes:
+            doc_ops = self.get_ops_for_bulk(doc)
+            bulk_ops += doc_ops
+
+        return bulk_ops
+
+    def get_version(self, doc):
+        """Returns the external version of the document, derived from the
+        generation of its revision or from its change seq, depending on
+        `versioning`.
+
+        :param doc: Document to be processed.
+
+        """
+
+        if self._versioning == 'seq':
+            version = doc[self._seq_property]
+        else:
+            version = doc['_rev']
+
+        # Both "123" and "123-g1AAAA..." start with the number we need.
+        return int(str(version).split('-', 1)[0])
+
     def get_ops_for_bulk(self, doc):
         """Returns a list of operations to be performed in elasticsearch
         for the given document. By default, the document is "upserted".
+        With `versioning` set, the whole document is indexed with an
+        external version instead.
         Override this if you need to merge your documents in a fancier way.
 
         :param doc: Document to be processed.
@@ -161,7 +686,7 @@ class SimpleESChangesProcessor(base.BaseESChangesProcessor):
 
         ops = []
 
-        doc_to_index = copy.deepcopy(doc)
+        doc_to_index = self.copy_doc(doc)
 
         # TODO: Probably should pop other "meta" properties here...
         doc_id = doc_to_index.pop('_id')
@@ -172,11 +697,23 @@ class SimpleESChangesProcessor(base.BaseESChangesProcessor):
             '_index': self.get_index(doc),
         }
 
+        if self._versioning is not None:
+            op_data.update({
+                '_version': self.get_version(doc),
+                '_version_type': self._version_type,
+            })
+
         if doc.get('_deleted'):
             op_dict = {
                 'delete': op_data,
             }
             ops.append(op_dict)
+        elif self._versioning is not None:
+            op_dict = {
+                'index': op_data,
+            }
+            ops.append(op_dict)
+            ops.append(doc_to_index)
         else:
             op_data.update({
                 '_retry_on_conflict': self._retry_on_conflict
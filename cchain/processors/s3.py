@@ -1,6 +1,12 @@
+import dbm
+import gzip
+import hashlib
 import io
 import json
 import logging
+import threading
+
+import botocore.exceptions
 
 from cchain.processors import base
 
@@ -8,11 +14,145 @@ from cchain.processors import base
 logger = logging.getLogger(__name__)
 
 
+class ContentHashIndex(object):
+    """A persistent, local index of the content hashes and ETags of the
+    objects uploaded to s3, keyed by their s3 keys.
+
+    """
+
+    def __init__(self, file_path):
+
+        self._db = dbm.open(file_path, 'c')
+        self._lock = threading.Lock()
+
+    def get(self, key_name):
+        """Returns a (content_hash, etag) tuple for the key, or None.
+
+        """
+
+        with self._lock:
+            value = self._db.get(key_name.encode('utf-8'))
+
+        if value is None:
+            return None
+
+        content_hash, etag = value.decode('utf-8').split(' ', 1)
+
+        return content_hash, etag
+
+    def set(self, key_name, content_hash, etag):
+        with self._lock:
+            self._db[key_name.encode('utf-8')] = (
+                '%s %s' % (content_hash, etag or '')
+            ).encode('utf-8')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ByteBudget(object):
+    """Limits the number of bytes in flight. A single item bigger than
+    the budget is let through when nothing else is in flight.
+
+    """
+
+    def __init__(self, max_bytes):
+
+        self._max_bytes = max_bytes
+        self._bytes_in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        """Blocks until `size` bytes fit in the budget.
+
+        """
+
+        with self._condition:
+            while (
+                self._bytes_in_flight and
+                self._bytes_in_flight + size > self._max_bytes
+            ):
+                self._condition.wait()
+
+            self._bytes_in_flight += size
+
+    def release(self, size):
+        with self._condition:
+            self._bytes_in_flight -= size
+            self._condition.notify_all()
+
+    @property
+    def bytes_in_flight(self):
+        return self._bytes_in_flight
+
+
 class SimpleS3ChangesProcessor(base.BaseS3ChangesProcessor):
     """Stores documents in an s3 bucket.
 
     """
 
+    def __init__(
+        self,
+        bucket_name,
+        archive_batches=False,
+        hash_index_path=None,
+        verify_etags=False,
+        max_bytes_in_flight=None,
+        **kwargs
+    ):
+        """
+
+        :param bucket_name: the name of the s3 bucket to upload documents to.
+        :param archive_batches: if True, each batch is stored as a single
+            object of gzipped JSON lines, along with an index of the byte
+            ranges of the documents in it, instead of one object per
+            document.
+        :param hash_index_path: if set, the content hashes of uploaded
+            documents are kept in a local index at this path, and documents
+            whose content was already uploaded under the same key are
+            skipped. The seq property is left out of the hash. Doesn't
+            apply to batch archives.
+        :param verify_etags: if True, the ETag of an object is checked with
+            a HEAD request before skipping its upload.
+        :param max_bytes_in_flight: if set, limits the size of the documents
+            being uploaded at the same time, across batches. Use it with
+            `cchain.consumers.pipelined.PipelinedChangesConsumer`, so that
+            later batches start uploading while earlier ones finish, and
+            seqs are still saved in order.
+
+        See `cchain.processors.base.BaseS3ChangesProcessor` for the
+        remaining arguments.
+
+        """
+
+        super(
+            SimpleS3ChangesProcessor,
+            self
+        ).__init__(bucket_name, **kwargs)
+
+        self._archive_batches = archive_batches
+        self._verify_etags = verify_etags
+
+        if max_bytes_in_flight is not None:
+            self._upload_budget = ByteBudget(max_bytes_in_flight)
+        else:
+            self._upload_budget = None
+
+        if hash_index_path is not None:
+            self._hash_index = ContentHashIndex(hash_index_path)
+        else:
+            self._hash_index = None
+
+    def cleanup(self):
+        super(
+            SimpleS3ChangesProcessor,
+            self
+        ).cleanup()
+
+        if self._hash_index is not None:
+            self._hash_index.close()
+
     def get_s3_key_name(self, doc):
         """Returns the key to store the document in s3 under.
 
@@ -32,11 +172,12 @@ class SimpleS3ChangesProcessor(base.BaseS3ChangesProcessor):
 
         return key
 
-    def _store_doc(self, doc_info):
+    def _store_doc(self, doc_info, doc_body=None):
         """Stores the document in the s3 bucket.
 
         :param doc_info: a tuple comprising document to store, the revision
             "number" and the seq of the correnspoding change.
+        :param doc_body: the serialized document, if already available.
 
         :returns: the key that the document was stored under.
 
@@ -48,33 +189,259 @@ class SimpleS3ChangesProcessor(base.BaseS3ChangesProcessor):
 
         key = self._bucket.Object(key_name)
 
-        doc_body = json.dumps(doc)
+        hash_index = self._hash_index
+
+        if hash_index is not None:
+            content_hash = self.get_content_hash(doc)
+            if self.is_uploaded(key, content_hash):
+                logger.debug('Content already in s3, skipping: %s', key_name)
+                return key_name
+
+        if doc_body is None:
+            doc_body = json.dumps(doc)
+
+        with self._metrics.timer('s3_put'):
+            response = key.put(
+                Body=doc_body,
+                Metadata={
+                    'seq': str(seq)
+                }
+            )
+
+        self._metrics.increment('s3_bytes', len(doc_body))
+
+        if hash_index is not None:
+            hash_index.set(key_name, content_hash, response.get('ETag'))
+
+        return key_name
+
+    def get_content_hash(self, doc):
+        """Returns a hash of the content of the document, leaving out the
+        seq property, so that replayed changes hash the same.
+
+        :param doc: the document to store in s3.
+
+        """
+
+        seq_property = self._seq_property
+
+        if seq_property is not None and seq_property in doc:
+            doc = dict(doc)
+            del doc[seq_property]
+
+        return hashlib.sha1(
+            json.dumps(doc, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def is_uploaded(self, key, content_hash):
+        """Tells whether the content has already been uploaded under
+        the given key.
+
+        :param key: the s3 object to store the document in.
+        :param content_hash: the hash returned by `get_content_hash`.
+
+        """
 
-        key.put(
-            Body=doc_body,
+        entry = self._hash_index.get(key.key)
+
+        if entry is None:
+            return False
+
+        (uploaded_hash, etag, ) = entry
+
+        if uploaded_hash != content_hash:
+            return False
+
+        if not self._verify_etags:
+            return True
+
+        try:
+            key.load()
+        except botocore.exceptions.ClientError:
+            logger.info('Object missing from s3: %s', key.key)
+            return False
+
+        return key.e_tag == etag
+
+    def get_s3_archive_key_name(self, first_seq, last_seq):
+        """Returns the key to store a batch archive in s3 under.
+
+        :param first_seq: the seq of the first change in the batch.
+        :param last_seq: the seq of the last change in the batch.
+
+        """
+
+        return 'batches/%s-%s.jsonl.gz' % (
+            self.get_seq_key_part(first_seq),
+            self.get_seq_key_part(last_seq),
+        )
+
+    def get_seq_key_part(self, seq):
+        """Returns a short form of the seq to use in s3 keys. Couchdb 2.x
+        seqs can be hundreds of bytes long, so only their numeric part is
+        kept, along with a hash of the whole seq to tell them apart.
+
+        :param seq: a change seq, e.g. 12 or '12-g1AAAA...'.
+
+        """
+
+        seq = str(seq)
+        (number, separator, opaque_part, ) = seq.partition('-')
+
+        if not opaque_part:
+            return seq
+
+        return '%s-%s' % (
+            number,
+            hashlib.sha1(seq.encode('utf-8')).hexdigest()[:12],
+        )
+
+    def get_s3_index_key_name(self, archive_key_name):
+        """Returns the key to store the index of a batch archive under.
+
+        :param archive_key_name: the key of the batch archive.
+
+        """
+
+        return '%s.index.json' % archive_key_name
+
+    def _store_batch(self, processed_changes):
+        """Stores all the documents in a single object of gzipped JSON
+        lines. Each line is a separate gzip member, so any document can
+        be read on its own with a ranged GET. The offsets are stored in an
+        index next to the archive.
+
+        :param processed_changes: a list of (doc, rev, seq) tuples.
+
+        :returns: the key that the batch was stored under.
+
+        """
+
+        archive = io.BytesIO()
+        index = []
+
+        for (doc, rev, seq, ) in processed_changes:
+            data = gzip.compress(
+                json.dumps(doc).encode('utf-8') + b'\n'
+            )
+            index.append({
+                'id': doc['_id'],
+                'rev': rev,
+                'seq': seq,
+                'offset': archive.tell(),
+                'length': len(data),
+            })
+            archive.write(data)
+
+        first_seq = processed_changes[0][2]
+        last_seq = processed_changes[-1][2]
+
+        key_name = self.get_s3_archive_key_name(first_seq, last_seq)
+
+        self._bucket.Object(key_name).put(
+            Body=archive.getvalue(),
+            ContentType='application/gzip',
             Metadata={
-                'seq': str(seq)
+                'first_seq': str(first_seq),
+                'last_seq': str(last_seq),
             }
         )
 
+        # Store the index last, so that the archive exists if it does.
+        self._bucket.Object(self.get_s3_index_key_name(key_name)).put(
+            Body=json.dumps(index),
+            ContentType='application/json'
+        )
+
         return key_name
 
+    def get_archive_index(self, archive_key_name):
+        """Loads the index of a batch archive.
+
+        :returns: a list of dicts with the id, rev, seq, offset and length
+            of each document in the archive.
+
+        """
+
+        response = self._bucket.Object(
+            self.get_s3_index_key_name(archive_key_name)
+        ).get()
+
+        return json.loads(response['Body'].read())
+
+    def get_archived_doc(self, archive_key_name, index_entry):
+        """Reads a single document from a batch archive.
+
+        :param archive_key_name: the key of the batch archive.
+        :param index_entry: the entry for the document in the archive index.
+
+        """
+
+        offset = index_entry['offset']
+
+        response = self._bucket.Object(archive_key_name).get(
+            Range='bytes=%d-%d' % (
+                offset,
+                offset + index_entry['length'] - 1,
+            )
+        )
+
+        return json.loads(gzip.decompress(response['Body'].read()))
+
     def persist_changes(self, processed_changes):
+        if self._archive_batches:
+            if processed_changes:
+                key_name = self._store_batch(processed_changes)
+                logger.debug('Batch archive created in s3: %s', key_name)
+            return
+
         logger.debug(
             'Starting %d tasks to store documents...',
             len(processed_changes)
         )
 
-        key_names = self._executor.map(
-            self._store_doc,
-            processed_changes
-        )
+        if self._upload_budget is not None:
+            key_names = self._store_docs_within_budget(processed_changes)
+        else:
+            key_names = self._executor.map(
+                self._store_doc,
+                processed_changes
+            )
 
         logger.debug('Done.')
 
         for key_name in key_names:
             logger.debug('Key created in s3: %s', key_name)
 
+    def _store_docs_within_budget(self, processed_changes):
+        """Submits the uploads as soon as they fit within the bytes in
+        flight budget, which is shared with other batches being persisted
+        at the same time.
+
+        :returns: a generator of the keys the documents were stored under.
+
+        """
+
+        upload_budget = self._upload_budget
+        upload_futures = []
+
+        def store_doc(doc_info, doc_body):
+            try:
+                return self._store_doc(doc_info, doc_body)
+            finally:
+                upload_budget.release(len(doc_body))
+
+        for doc_info in processed_changes:
+            doc_body = json.dumps(doc_info[0])
+
+            upload_budget.acquire(len(doc_body))
+
+            upload_futures.append(
+                self._executor.submit(store_doc, doc_info, doc_body)
+            )
+
+        return (future.result() for future in upload_futures)
+
     def process_changes(self, changes_buffer):
 
         processed_changes, last_seq = super(
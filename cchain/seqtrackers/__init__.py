@@ -1,6 +1,10 @@
 from . import base
+from . import sqlite
+from . import watermark
 
 
 __all__ = [
     'base',
+    'sqlite',
+    'watermark',
 ]
@@ -1,5 +1,10 @@
+import json
 import logging
 import os
+import stat
+import tempfile
+import threading
+import time
 
 import pycouchdb
 
@@ -18,6 +23,14 @@ class BaseSeqTracker(object):
 
         raise NotImplementedError
 
+    def record_changes(self, change_count):
+        """Called with the number of changes in each persisted batch,
+        before its seq is put. Override this to keep statistics.
+
+        :param change_count: the number of changes in the batch.
+
+        """
+
     def get_seq(self):
         """Loads the last know change sequence.
 
@@ -36,39 +49,217 @@ class BaseSeqTracker(object):
 class FilebasedSeqTracker(BaseSeqTracker):
     """Keeps a change sequence in a file.
 
+    The seq is written to a temporary file, which is synced to disk and
+    then renamed over the seq file, so that a crash never leaves a
+    partially written seq behind.
+
     """
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, fsync=True):
+        """
+
+        :param file_path: the path of the file to keep the seq in.
+        :param fsync: if False, the seq is not synced to disk before the
+            rename. Faster, but the seq may be lost if the machine crashes.
+
+        """
+
+        self._file_path = file_path
+        self._fsync = fsync
 
         if not os.path.exists(file_path):
             open(file_path, 'wb').close()
-        self._seq_file = open(file_path, 'r+b')
 
     def put_seq(self, seq):
+        file_path = self._file_path
+        directory = os.path.dirname(os.path.abspath(file_path))
 
-        seq_file = self._seq_file
+        fd, temp_path = tempfile.mkstemp(
+            dir=directory,
+            prefix='.%s.' % os.path.basename(file_path)
+        )
 
-        seq_file.seek(0)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(str(seq).encode('utf-8'))
+                temp_file.flush()
+                if self._fsync:
+                    os.fsync(temp_file.fileno())
+
+            # mkstemp creates files readable by the owner only, so keep
+            # the mode of the seq file.
+            try:
+                mode = stat.S_IMODE(os.stat(file_path).st_mode)
+            except FileNotFoundError:
+                pass
+            else:
+                os.chmod(temp_path, mode)
+
+            os.replace(temp_path, file_path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+        if self._fsync:
+            # Make the rename itself durable.
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
 
-        seq_file.write(str(seq))
-        seq_file.truncate()
-        seq_file.flush()
         logger.info('Put seq: %s', seq)
 
     def get_seq(self):
-
-        seq_file = self._seq_file
-
-        seq_file.seek(0)
-        seq = seq_file.read()
+        with open(self._file_path, 'rb') as seq_file:
+            seq = seq_file.read().decode('utf-8')
 
         logger.info('Got seq: %s', seq)
 
         return seq
 
     def cleanup(self):
+        pass
+
+
+class DebouncedSeqTracker(BaseSeqTracker):
+    """Wraps another seq tracker and only saves the seq in it at most every
+    `interval` seconds or `batches` calls to `put_seq`, whichever comes
+    first. The last seq is always saved on `cleanup`.
+
+    With an `interval`, a timer saves the pending seq once the interval
+    has passed, even if no more seqs are put, e.g. on an idle feed.
+
+    If the consumer crashes, the changes received after the last saved seq
+    are processed again, so processors must be able to handle the same
+    changes more than once.
+
+    """
+
+    def __init__(self, seqtracker, interval=None, batches=None):
+        """
+
+        :param seqtracker: a subclass of
+            `cchain.seqtrackers.base.BaseSeqTracker` to save the seq in.
+        :param interval: the minimum time, in seconds, between saves.
+        :param batches: the maximum number of seqs put before the last one
+            is saved.
+
+        If neither `interval` nor `batches` are set, every seq is saved.
+
+        """
+
+        self._seqtracker = seqtracker
+        self._interval = interval
+        self._batches = batches
+        self._lock = threading.Lock()
+        self._pending_seq = None
+        self._pending_count = 0
+        self._last_save_time = time.monotonic()
+        self._timer = None
+
+    def is_due(self):
+        """Returns True if the pending seq should be saved now.
+
+        """
+
+        interval = self._interval
+        batches = self._batches
+
+        if interval is None and batches is None:
+            return True
+
+        if batches is not None and self._pending_count >= batches:
+            return True
+
+        if interval is not None:
+            return time.monotonic() - self._last_save_time >= interval
+
+        return False
+
+    def _start_timer(self):
+        """Schedules saving the pending seq when the interval is over.
+
+        """
+
+        if self._interval is None or self._timer is not None:
+            return
+
+        delay = max(
+            self._last_save_time + self._interval - time.monotonic(),
+            0
+        )
+
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+
+            if self._pending_seq is None:
+                return
+
+            if not self.is_due():
+                self._start_timer()
+                return
+
+            try:
+                self._flush()
+            except:
+                logger.exception('Failed to save seq: %s', self._pending_seq)
+
+    def _flush(self):
+        self._cancel_timer()
 
-        self._seq_file.close()
+        if self._pending_seq is None:
+            return
+
+        self._seqtracker.put_seq(self._pending_seq)
+
+        self._pending_seq = None
+        self._pending_count = 0
+        self._last_save_time = time.monotonic()
+
+    def record_changes(self, change_count):
+        self._seqtracker.record_changes(change_count)
+
+    def put_seq(self, seq):
+        with self._lock:
+            self._pending_seq = seq
+            self._pending_count += 1
+
+            if self.is_due():
+                self._flush()
+            else:
+                self._start_timer()
+
+    def flush(self):
+        """Saves the pending seq, if there is one.
+
+        """
+
+        with self._lock:
+            self._flush()
+
+    def get_seq(self):
+        with self._lock:
+            if self._pending_seq is not None:
+                return self._pending_seq
+
+        return self._seqtracker.get_seq()
+
+    def cleanup(self):
+        try:
+            self.flush()
+        finally:
+            self._seqtracker.cleanup()
 
 
 class CouchDBSeqTracker(BaseSeqTracker):
@@ -120,3 +311,86 @@ class CouchDBSeqTracker(BaseSeqTracker):
 
     def cleanup(self):
         pass
+
+
+class CouchDBLocalSeqTracker(CouchDBSeqTracker):
+    """Keeps the seq in a `_local` document. Local documents are not
+    replicated, do not appear in the _changes feed and keep no revision
+    history, so saving the seq after every batch does not grow the
+    database or trigger changes of its own.
+
+    """
+
+    def __init__(self, couchdb_uri, couchdb_name, seq_doc_id, max_retries=3):
+        """
+
+        :param seq_doc_id: the id of the local document, with or without
+            the `_local/` prefix.
+        :param max_retries: how many times saving the seq is retried after
+            an update conflict, e.g. when the document was changed by
+            another process.
+
+        """
+
+        if not seq_doc_id.startswith('_local/'):
+            seq_doc_id = '_local/%s' % seq_doc_id
+
+        self._max_retries = max_retries
+
+        super(
+            CouchDBLocalSeqTracker,
+            self
+        ).__init__(couchdb_uri, couchdb_name, seq_doc_id)
+
+    def get_seq_resource(self):
+        return self._couchdb.resource(*self._seq_doc['_id'].split('/', 1))
+
+    def get_current_rev(self):
+        """Fetches the current revision of the seq document.
+
+        """
+
+        try:
+            response, seq_doc = self.get_seq_resource().get()
+        except pycouchdb.exceptions.NotFound:
+            return None
+
+        return seq_doc.get('_rev')
+
+    def put_seq(self, seq):
+        """Writes the new seq to the database. On an update conflict, the
+        current revision is fetched and the write is retried.
+
+        """
+
+        seq_doc = dict(self._seq_doc, seq=seq)
+
+        attempt = 0
+
+        while True:
+            try:
+                response, result = self.get_seq_resource().put(
+                    data=json.dumps(seq_doc)
+                )
+            except pycouchdb.exceptions.Conflict:
+                if attempt >= self._max_retries:
+                    raise
+
+                attempt += 1
+                logger.warning(
+                    'Conflict saving seq, retrying (attempt %d).',
+                    attempt
+                )
+
+                rev = self.get_current_rev()
+                if rev is None:
+                    seq_doc.pop('_rev', None)
+                else:
+                    seq_doc['_rev'] = rev
+            else:
+                break
+
+        seq_doc['_rev'] = result['rev']
+        self._seq_doc = seq_doc
+
+        logger.info('Put seq: %s', seq)
@@ -0,0 +1,164 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from . import base
+
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteSeqTracker(base.BaseSeqTracker):
+    """Keeps the seqs of many pipelines in a single SQLite database, in
+    WAL mode, so that consumers in different threads and processes can
+    checkpoint into the same file without blocking readers.
+
+    Along with the seq, the number of checkpoints and changes and the time
+    of the last checkpoint are kept for each pipeline. Inspect them with
+    `get_stats` or straight from the `checkpoints` table.
+
+    """
+
+    def __init__(self, file_path, pipeline_name, commit_every=1, timeout=30):
+        """
+
+        :param file_path: the path of the database file, shared by all the
+            pipelines.
+        :param pipeline_name: the name to keep the seq of this pipeline
+            under.
+        :param commit_every: the number of seqs put before the last one is
+            written. The seqs in between are kept in memory, so the database
+            is only locked while writing. The last seq is always written on
+            `cleanup`; if the process crashes, the changes since the last
+            write are processed again.
+        :param timeout: how long, in seconds, to wait for other writers to
+            commit.
+
+        """
+
+        self._pipeline_name = pipeline_name
+        self._commit_every = commit_every
+        self._lock = threading.Lock()
+        # The seq and counts not written yet, when commit_every > 1.
+        self._pending_seq = None
+        self._uncommitted_count = 0
+        self._change_count = 0
+
+        # The seq may be put from the threads persisting batches.
+        self._connection = sqlite3.connect(
+            file_path,
+            timeout=timeout,
+            check_same_thread=False
+        )
+
+        connection = self._connection
+        connection.execute('PRAGMA journal_mode=WAL')
+        # Safe in WAL mode: a crash may lose the last commits, but never
+        # corrupts the database.
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoints ('
+            'pipeline TEXT PRIMARY KEY, '
+            'seq TEXT NOT NULL, '
+            'checkpoints INTEGER NOT NULL DEFAULT 0, '
+            'changes INTEGER NOT NULL DEFAULT 0, '
+            'updated_at REAL NOT NULL'
+            ')'
+        )
+        connection.commit()
+
+    def record_changes(self, change_count):
+        with self._lock:
+            self._change_count += change_count
+
+    def put_seq(self, seq):
+        with self._lock:
+            self._pending_seq = seq
+            self._uncommitted_count += 1
+
+            if self._uncommitted_count >= self._commit_every:
+                self._commit()
+
+        logger.info('Put seq: %s', seq)
+
+    def _commit(self):
+        """Writes the pending seq and counts in a short transaction. Nothing
+        is written between commits, so no lock is held on the database
+        while other pipelines checkpoint.
+
+        """
+
+        if self._pending_seq is None:
+            return
+
+        with self._connection:
+            self._connection.execute(
+                'INSERT INTO checkpoints '
+                '(pipeline, seq, checkpoints, changes, updated_at) '
+                'VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (pipeline) DO UPDATE SET '
+                'seq = excluded.seq, '
+                'checkpoints = checkpoints + excluded.checkpoints, '
+                'changes = changes + excluded.changes, '
+                'updated_at = excluded.updated_at',
+                (
+                    self._pipeline_name,
+                    json.dumps(self._pending_seq),
+                    self._uncommitted_count,
+                    self._change_count,
+                    time.time(),
+                )
+            )
+
+        self._pending_seq = None
+        self._uncommitted_count = 0
+        self._change_count = 0
+
+    def get_seq(self):
+        with self._lock:
+            if self._pending_seq is not None:
+                return self._pending_seq
+
+            row = self._connection.execute(
+                'SELECT seq FROM checkpoints WHERE pipeline = ?',
+                (self._pipeline_name, )
+            ).fetchone()
+
+        seq = '' if row is None else json.loads(row[0])
+
+        logger.info('Got seq: %s', seq)
+
+        return seq
+
+    def get_stats(self):
+        """Returns a dict with the seq, the number of checkpoints and
+        changes and the time of the last checkpoint of the pipeline, or
+        None if no seq was committed yet.
+
+        """
+
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT seq, checkpoints, changes, updated_at '
+                'FROM checkpoints WHERE pipeline = ?',
+                (self._pipeline_name, )
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        seq, checkpoints, changes, updated_at = row
+
+        return {
+            'seq': json.loads(seq),
+            'checkpoints': checkpoints,
+            'changes': changes,
+            'updated_at': updated_at,
+        }
+
+    def cleanup(self):
+        with self._lock:
+            self._commit()
+            self._connection.close()
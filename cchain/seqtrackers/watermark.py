@@ -0,0 +1,93 @@
+import collections
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class LowWatermark(object):
+    """Keeps track of batches of changes that may complete out of order.
+    Only the last seq of the highest batch for which all the earlier batches
+    have completed is saved in the seq tracker.
+
+    """
+
+    def __init__(self, seqtracker):
+        """
+
+        :param seqtracker: a subclass of
+            `cchain.seqtrackers.base.BaseSeqTracker` to save the watermark in.
+
+        """
+
+        self._seqtracker = seqtracker
+        self._lock = threading.Lock()
+        self._batch_counter = 0
+        # Maps batch numbers to their last seq and number of changes, in
+        # the order of starting.
+        self._pending_batches = collections.OrderedDict()
+        self._completed_batches = set()
+
+    def start_batch(self, last_seq, change_count=0):
+        """Registers a new batch.
+
+        :param last_seq: the seq of the last change in the batch.
+        :param change_count: the number of changes in the batch.
+
+        :returns: the number of the batch, to be passed to `complete_batch`.
+
+        """
+
+        with self._lock:
+            batch_number = self._batch_counter
+            self._batch_counter += 1
+            self._pending_batches[batch_number] = (last_seq, change_count, )
+
+        return batch_number
+
+    def complete_batch(self, batch_number):
+        """Marks the batch as complete and saves the new watermark, if it
+        has moved.
+
+        :param batch_number: the number returned by `start_batch`.
+
+        :returns: the seq that was saved, or None.
+
+        """
+
+        with self._lock:
+            self._completed_batches.add(batch_number)
+
+            watermark_seq = None
+            completed_changes = 0
+            pending_batches = self._pending_batches
+
+            while pending_batches:
+                first_batch = next(iter(pending_batches))
+                if first_batch not in self._completed_batches:
+                    break
+
+                self._completed_batches.remove(first_batch)
+                last_seq, change_count = pending_batches.pop(first_batch)
+                completed_changes += change_count
+                if last_seq is not None:
+                    watermark_seq = last_seq
+
+            if completed_changes:
+                self._seqtracker.record_changes(completed_changes)
+
+            if watermark_seq is not None:
+                logger.debug('Watermark moved to: %s', watermark_seq)
+                self._seqtracker.put_seq(watermark_seq)
+
+        return watermark_seq
+
+    def pending_count(self):
+        """Returns the number of batches that are not accounted for in the
+        watermark yet.
+
+        """
+
+        with self._lock:
+            return len(self._pending_batches)
@@ -25,8 +25,13 @@ setuptools.setup(
         'pycouchdb',
         'requests',
         'urllib3',
-        'redis',
+        'redis>=4.0',
     ],
+    extras_require={
+        'async': [
+            'aiohttp',
+        ],
+    },
     dependency_links=[
         (
             'git+https://github.com/krisb78/py-couchdb.git'
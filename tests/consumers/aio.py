@@ -0,0 +1,86 @@
+import asyncio
+import json
+import unittest
+
+import cchain
+import mock
+
+from ..processors import samples
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+
+@unittest.skipIf(web is None, 'aiohttp is not installed')
+class AsyncChangesConsumerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = cchain.processors.base.BaseChangesProcessor()
+        self.processor.persist_changes = mock.MagicMock(name='persist_changes')
+        self.seqtracker = mock.MagicMock(name='seqtracker')
+        self.seqtracker.get_seq.return_value = ''
+
+    async def _serve_changes(self, request):
+        if request.can_read_body:
+            self.request_body = await request.json()
+        self.request_query = dict(request.query)
+
+        response = web.StreamResponse()
+        await response.prepare(request)
+
+        for change_line in samples.CHANGES:
+            await response.write((json.dumps(change_line) + '\n').encode())
+
+        await response.write_eof()
+
+        return response
+
+    async def _consume(self):
+        app = web.Application()
+        app.router.add_get('/test_db/_changes', self._serve_changes)
+        app.router.add_post('/test_db/_changes', self._serve_changes)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+
+        try:
+            consumer = cchain.consumers.aio.AsyncChangesConsumer(
+                'http://127.0.0.1:%d' % port,
+                'test_db',
+                limit=2,
+                processor=self.processor,
+                seqtracker=self.seqtracker
+            )
+            await consumer.consume_async()
+        finally:
+            await runner.cleanup()
+
+    def test_consume(self):
+        asyncio.run(self._consume())
+
+        self.assertEqual(self.processor.persist_changes.call_count, 2)
+        self.seqtracker.put_seq.assert_called_with(samples.CHANGES[-1]['seq'])
+        self.seqtracker.cleanup.assert_called_once_with()
+
+    def test_consume_with_selector(self):
+        self.processor = cchain.processors.base.BaseChangesProcessor(
+            selector={'type': 'user'}
+        )
+        self.processor.persist_changes = mock.MagicMock(name='persist_changes')
+
+        asyncio.run(self._consume())
+
+        self.assertEqual(self.request_body, {
+            'selector': {
+                '$or': [{'type': 'user'}, {'_deleted': True}],
+            },
+        })
+        self.assertEqual(self.request_query['filter'], '_selector')
+        self.assertNotIn('data', self.request_query)
+        self.assertEqual(self.processor.persist_changes.call_count, 2)
@@ -0,0 +1,237 @@
+import unittest
+
+import cchain
+import mock
+
+from ..processors import s3 as s3_tests
+
+
+class BackfillChangesConsumerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('pycouchdb.Server')
+        server_class = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.couchdb = server_class.return_value.database.return_value
+        self.couchdb.config.return_value = {'update_seq': '42-abc'}
+        self.couchdb.all.side_effect = self.all_docs
+
+        self.doc_ids = sorted(
+            ['%x-doc' % i for i in range(16)] + ['_design/test', 'zzz']
+        )
+
+        self.processor = cchain.processors.base.BaseDocChangesProcessor()
+        self.processor.persist_changes = mock.MagicMock(
+            name='persist_changes'
+        )
+        self.seqtracker = mock.MagicMock(name='seqtracker')
+        self.seqtracker.get_seq.return_value = ''
+
+    def all_docs(
+        self,
+        as_list=False,
+        startkey=None,
+        endkey=None,
+        skip=0,
+        limit=None,
+        inclusive_end='true'
+    ):
+        rows = [
+            {
+                'id': doc_id,
+                'key': doc_id,
+                'value': {'rev': '1-abc'},
+                'doc': {'_id': doc_id, '_rev': '1-abc'},
+            }
+            for doc_id in self.doc_ids
+            if (startkey is None or doc_id >= startkey) and
+            (endkey is None or doc_id < endkey)
+        ]
+
+        return rows[skip:skip + limit]
+
+    def get_consumer(self, **kwargs):
+        return cchain.consumers.base.BaseChangesConsumer(
+            'http://localhost:5984',
+            'test_db',
+            processor=self.processor,
+            seqtracker=self.seqtracker,
+            backfill=True,
+            backfill_page_size=2,
+            **kwargs
+        )
+
+    def get_persisted_ids(self):
+        return sorted(
+            doc['_id']
+            for call in self.processor.persist_changes.call_args_list
+            for (doc, rev, seq, ) in call[0][0]
+        )
+
+    def test_get_backfill_ranges(self):
+        consumer = self.get_consumer()
+
+        self.assertEqual(
+            consumer.get_backfill_ranges(),
+            [(None, '4'), ('4', '8'), ('8', 'c'), ('c', None)]
+        )
+
+        consumer = self.get_consumer(backfill_boundaries=['m', 'a'])
+
+        self.assertEqual(
+            consumer.get_backfill_ranges(),
+            [(None, 'a'), ('a', 'm'), ('m', None)]
+        )
+
+    def test_backfill(self):
+        consumer = self.get_consumer()
+        consumer.consume()
+
+        self.assertEqual(self.get_persisted_ids(), self.doc_ids)
+        self.seqtracker.put_seq.assert_called_once_with('42-abc')
+
+        args, kwargs = self.couchdb.changes_feed.call_args
+        self.assertEqual(kwargs['since'], '42-abc')
+
+    def test_backfill_seqs(self):
+        consumer = self.get_consumer()
+        consumer.consume()
+
+        seqs = [
+            seq
+            for call in self.processor.persist_changes.call_args_list
+            for (doc, rev, seq, ) in call[0][0]
+        ]
+
+        self.assertEqual(
+            sorted(seqs),
+            sorted('42-backfill-%s' % doc_id for doc_id in self.doc_ids)
+        )
+
+    def test_backfill_s3_archives(self):
+        with mock.patch('boto3.resource'):
+            self.processor = cchain.processors.s3.SimpleS3ChangesProcessor(
+                'test_bucket',
+                archive_batches=True
+            )
+        self.addCleanup(self.processor.cleanup)
+        self.processor._bucket = s3_tests.FakeS3Bucket()
+        self.processor.persist_changes = mock.MagicMock(
+            name='persist_changes',
+            wraps=self.processor.persist_changes
+        )
+
+        consumer = self.get_consumer()
+        consumer.consume()
+
+        archive_keys = [
+            key for key in self.processor._bucket.objects
+            if key.endswith('.jsonl.gz')
+        ]
+
+        # Every page is archived under its own key.
+        self.assertEqual(
+            len(archive_keys),
+            self.processor.persist_changes.call_count
+        )
+        self.assertEqual(self.get_persisted_ids(), self.doc_ids)
+
+    def test_backfill_es_seq_versioning(self):
+        self.processor = cchain.processors.es.SimpleESChangesProcessor(
+            ['http://localhost:9200'],
+            'test_index',
+            'test_type',
+            versioning='seq'
+        )
+        self.processor._es.bulk = mock.MagicMock(
+            name='bulk',
+            return_value={'errors': False}
+        )
+
+        consumer = self.get_consumer()
+        consumer.consume()
+
+        versions = [
+            op['index']['_version']
+            for call in self.processor._es.bulk.call_args_list
+            for op in call[1]['body']
+            if 'index' in op
+        ]
+
+        self.assertEqual(versions, [42] * len(self.doc_ids))
+        self.seqtracker.put_seq.assert_called_once_with('42-abc')
+
+    def test_no_backfill_with_seq(self):
+        self.seqtracker.get_seq.return_value = '10-abc'
+
+        consumer = self.get_consumer()
+        consumer.consume()
+
+        self.assertFalse(self.couchdb.all.called)
+
+        args, kwargs = self.couchdb.changes_feed.call_args
+        self.assertEqual(kwargs['since'], '10-abc')
+
+    def test_backfill_error(self):
+        self.processor.persist_changes.side_effect = (
+            cchain.processors.exceptions.ProcessingError
+        )
+
+        consumer = self.get_consumer()
+        consumer.consume()
+
+        self.assertFalse(self.seqtracker.put_seq.called)
+        self.assertFalse(self.couchdb.changes_feed.called)
+        self.seqtracker.cleanup.assert_called_once_with()
+
+
+class FeedFilterChangesConsumerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('pycouchdb.Server')
+        server_class = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.couchdb = server_class.return_value.database.return_value
+
+        self.processor = cchain.processors.base.BaseChangesProcessor(
+            selector={'type': 'user'}
+        )
+        self.seqtracker = mock.MagicMock(name='seqtracker')
+        self.seqtracker.get_seq.return_value = '12-abc'
+
+    def get_consumer(self, **kwargs):
+        return cchain.consumers.base.BaseChangesConsumer(
+            'http://localhost:5984',
+            'test_db',
+            processor=self.processor,
+            seqtracker=self.seqtracker,
+            **kwargs
+        )
+
+    def test_feed_filter(self):
+        consumer = self.get_consumer()
+        consumer.consume()
+
+        feed_kwargs = self.couchdb.changes_feed.call_args[1]
+
+        self.assertEqual(feed_kwargs['filter'], '_selector')
+        self.assertEqual(feed_kwargs['data'], {
+            'selector': {
+                '$or': [{'type': 'user'}, {'_deleted': True}],
+            },
+        })
+        self.assertEqual(feed_kwargs['since'], '12-abc')
+        self.assertEqual(feed_kwargs['include_docs'], 'true')
+
+    def test_feed_kwargs_filter(self):
+        consumer = self.get_consumer(
+            feed_kwargs={'filter': 'app/by_type', 'type': 'user'}
+        )
+        consumer.consume()
+
+        feed_kwargs = self.couchdb.changes_feed.call_args[1]
+
+        self.assertEqual(feed_kwargs['filter'], 'app/by_type')
+        self.assertNotIn('data', feed_kwargs)
@@ -0,0 +1,209 @@
+import datetime
+import threading
+import unittest
+
+import cchain
+import mock
+import pycouchdb
+
+from ..processors import samples
+
+
+class FanOutFeedReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.processors = []
+        self.seqtrackers = []
+
+        for i in range(2):
+            processor = cchain.processors.base.BaseChangesProcessor()
+            processor.persist_changes = mock.MagicMock(name='persist_changes')
+            self.processors.append(processor)
+            self.seqtrackers.append(mock.MagicMock(name='seqtracker'))
+
+    def get_feed_reader(self, **kwargs):
+        return cchain.consumers.fanout.FanOutFeedReader(
+            limit=1,
+            flush_interval=datetime.timedelta(seconds=10),
+            sinks=list(zip(self.processors, self.seqtrackers)),
+            **kwargs
+        )
+
+    def test_fan_out(self):
+        feed_reader = self.get_feed_reader()
+
+        for change_line in samples.CHANGES:
+            feed_reader.on_message(change_line)
+
+        feed_reader.cleanup()
+
+        for processor, seqtracker in zip(self.processors, self.seqtrackers):
+            self.assertEqual(
+                processor.persist_changes.call_count,
+                len(samples.CHANGES)
+            )
+            seqtracker.put_seq.assert_called_with(samples.CHANGES[-1]['seq'])
+
+    def test_metrics(self):
+        metrics = mock.MagicMock(name='metrics')
+        feed_reader = self.get_feed_reader(metrics=metrics)
+
+        feed_reader.on_message(samples.CHANGES[0])
+        feed_reader.cleanup()
+
+        for sink_thread in feed_reader._sink_threads:
+            sink_thread.join(5)
+
+        timer_names = [
+            args[0] for (args, kwargs, ) in metrics.timer.call_args_list
+        ]
+        self.assertEqual(timer_names.count('process_changes'), 2)
+        self.assertEqual(timer_names.count('persist_changes'), 2)
+        self.assertEqual(metrics.record_batch.call_count, 2)
+        self.assertEqual(metrics.record_batch.call_args[0][0], 1)
+
+    def test_max_lag(self):
+        release_slow_sink = threading.Event()
+        slow_persist_changes = self.processors[1].persist_changes
+        slow_persist_changes.side_effect = (
+            lambda processed_changes: release_slow_sink.wait(5)
+        )
+
+        feed_reader = self.get_feed_reader(max_lag=1)
+
+        def read_changes():
+            for change_line in samples.CHANGES:
+                feed_reader.on_message(change_line)
+
+        reader_thread = threading.Thread(target=read_changes)
+        reader_thread.start()
+        reader_thread.join(0.5)
+
+        # The slow sink is persisting one batch and has one more waiting,
+        # so the reader waits for it.
+        self.assertTrue(reader_thread.is_alive())
+        self.assertFalse(self.seqtrackers[1].put_seq.called)
+
+        release_slow_sink.set()
+        reader_thread.join(5)
+        feed_reader.cleanup()
+
+        self.seqtrackers[1].put_seq.assert_called_with(
+            samples.CHANGES[-1]['seq']
+        )
+
+    def test_error(self):
+        self.processors[0].persist_changes.side_effect = (
+            cchain.processors.exceptions.ProcessingError
+        )
+
+        feed_reader = self.get_feed_reader()
+        feed_reader.on_message(samples.CHANGES[0])
+
+        # Wait for the failing sink to be done with the batch.
+        feed_reader._sink_queues[0].put(None)
+        feed_reader._sink_threads[0].join(5)
+
+        self.assertRaises(
+            pycouchdb.exceptions.FeedReaderExited,
+            feed_reader.on_message,
+            samples.CHANGES[1]
+        )
+        self.assertFalse(self.seqtrackers[0].put_seq.called)
+
+        self.assertRaises(
+            pycouchdb.exceptions.FeedReaderExited,
+            feed_reader.cleanup
+        )
+        self.seqtrackers[1].put_seq.assert_called_once_with(
+            samples.CHANGES[0]['seq']
+        )
+
+
+class FanOutChangesConsumerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('pycouchdb.Server')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.processors = [
+            cchain.processors.base.BaseChangesProcessor(
+                selector={'type': 'user'}
+            )
+            for i in range(2)
+        ]
+
+    def get_consumer(self):
+        return cchain.consumers.fanout.FanOutChangesConsumer(
+            'http://localhost:5984',
+            'test_db',
+            [
+                (processor, mock.MagicMock(name='seqtracker'))
+                for processor in self.processors
+            ]
+        )
+
+    def test_feed_filter(self):
+        consumer = self.get_consumer()
+
+        self.assertEqual(consumer.get_feed_filter(), {
+            'filter': '_selector',
+            'data': {
+                'selector': {
+                    '$or': [{'type': 'user'}, {'_deleted': True}],
+                },
+            },
+        })
+
+    def test_different_feed_filters(self):
+        self.processors[1]._selector = {'type': 'group'}
+
+        consumer = self.get_consumer()
+
+        self.assertIsNone(consumer.get_feed_filter())
+
+    def test_processor_without_feed_filter(self):
+        self.processors[1] = mock.NonCallableMock(
+            spec=['process_changes', 'persist_changes']
+        )
+
+        consumer = self.get_consumer()
+
+        self.assertIsNone(consumer.get_feed_filter())
+
+
+class FanOutSeqTrackerTestCase(unittest.TestCase):
+
+    def get_seqtracker(self, seqs):
+        seqtrackers = []
+
+        for seq in seqs:
+            seqtracker = mock.MagicMock(name='seqtracker')
+            seqtracker.get_seq.return_value = seq
+            seqtrackers.append(seqtracker)
+
+        return cchain.consumers.fanout.FanOutSeqTracker(seqtrackers)
+
+    def test_get_seq(self):
+        seqtracker = self.get_seqtracker(['12-abc', '9-def', '30-ghi'])
+
+        self.assertEqual(seqtracker.get_seq(), '9-def')
+
+    def test_get_seq_numeric(self):
+        seqtracker = self.get_seqtracker([12, 9])
+
+        self.assertEqual(seqtracker.get_seq(), 9)
+
+    def test_get_seq_missing(self):
+        seqtracker = self.get_seqtracker(['12-abc', ''])
+
+        self.assertEqual(seqtracker.get_seq(), '')
+
+    def test_put_seq(self):
+        seqtracker = self.get_seqtracker(['', '9-def'])
+
+        seqtracker.put_seq('42-abc')
+
+        for sink_seqtracker in seqtracker._seqtrackers:
+            sink_seqtracker.put_seq.assert_called_once_with('42-abc')
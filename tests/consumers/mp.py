@@ -0,0 +1,175 @@
+import collections
+import datetime
+import time
+import unittest
+import uuid
+
+import cchain
+import mock
+import pycouchdb
+
+from ..processors import samples
+
+
+class MPFeedReaderTestCase(unittest.TestCase):
+
+    @mock.patch('multiprocessing.Process')
+    def test_debounced_seq_saved(self, process_class):
+        seqtracker = mock.MagicMock(name='seqtracker')
+        feed_reader = cchain.consumers.mp.MPFeedReader(
+            limit=1,
+            flush_interval=datetime.timedelta(seconds=10),
+            processor=cchain.processors.base.BaseChangesProcessor(),
+            seqtracker=cchain.seqtrackers.base.DebouncedSeqTracker(
+                seqtracker,
+                batches=100
+            )
+        )
+
+        def read_changes():
+            for change_line in samples.CHANGES:
+                feed_reader.process_change_line(change_line)
+
+        feed_reader.read_changes = read_changes
+
+        # Runs what the reader process runs, in this one.
+        feed_reader.start_reading_changes()
+
+        seqtracker.put_seq.assert_called_with(samples.CHANGES[-1]['seq'])
+
+
+class PartitionedMPFeedReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.seqtracker = mock.MagicMock(name='seqtracker')
+        self.feed_reader = cchain.consumers.mp.PartitionedMPFeedReader(
+            limit=1,
+            flush_interval=datetime.timedelta(seconds=10),
+            processor=cchain.processors.base.BaseChangesProcessor(),
+            seqtracker=self.seqtracker,
+            partitions=2
+        )
+
+    def test_get_partition(self):
+        other_feed_reader = cchain.consumers.mp.PartitionedMPFeedReader(
+            limit=1,
+            flush_interval=datetime.timedelta(seconds=10),
+            processor=cchain.processors.base.BaseChangesProcessor(),
+            seqtracker=mock.MagicMock(name='seqtracker'),
+            partitions=2
+        )
+        other_feed_reader.cleanup()
+
+        # crc32 doesn't change between processes or runs.
+        self.assertEqual(
+            [
+                self.feed_reader.get_partition(change_line)
+                for change_line in samples.CHANGES
+            ],
+            [1, 0, 1]
+        )
+        self.assertEqual(
+            [
+                self.feed_reader.get_partition(change_line)
+                for change_line in samples.CHANGES
+            ],
+            [
+                other_feed_reader.get_partition(change_line)
+                for change_line in samples.CHANGES
+            ]
+        )
+
+        self.feed_reader.cleanup()
+
+    def test_partition_spread(self):
+        partition_counts = collections.Counter(
+            self.feed_reader.get_partition({'id': uuid.uuid4().hex})
+            for i in range(1000)
+        )
+
+        self.assertEqual(sorted(partition_counts), [0, 1])
+        self.assertGreater(min(partition_counts.values()), 400)
+
+        self.feed_reader.cleanup()
+
+    def test_watermark(self):
+        for change_line in samples.CHANGES:
+            self.feed_reader.on_message(change_line)
+
+        self.feed_reader.cleanup()
+
+        self.seqtracker.put_seq.assert_called_with(samples.CHANGES[-1]['seq'])
+        self.assertEqual(self.feed_reader._pending_partitions, {})
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_watermark_held_back(self):
+        self.feed_reader._limit = len(samples.CHANGES)
+
+        # Keep the tasks from the persisters, and report their results
+        # one partition at a time.
+        task_queues = self.feed_reader._task_queues
+        self.feed_reader._task_queues = [
+            mock.MagicMock(name='task_queue') for task_queue in task_queues
+        ]
+
+        for change_line in samples.CHANGES:
+            self.feed_reader.on_message(change_line)
+
+        self.assertEqual(self.feed_reader._pending_partitions, {0: 2})
+
+        self.feed_reader._result_queue.put((0, 1, None))
+        self.wait_for(lambda: self.feed_reader._pending_partitions == {0: 1})
+
+        self.assertFalse(self.seqtracker.put_seq.called)
+
+        self.feed_reader._result_queue.put((0, 0, None))
+        self.wait_for(lambda: self.seqtracker.put_seq.called)
+
+        self.seqtracker.put_seq.assert_called_once_with(
+            samples.CHANGES[-1]['seq']
+        )
+
+        self.feed_reader._task_queues = task_queues
+        self.feed_reader.cleanup()
+
+
+class DeadPersisterTestCase(unittest.TestCase):
+
+    @mock.patch.object(
+        cchain.consumers.mp.PartitionedMPFeedReader,
+        'put_timeout',
+        0.01
+    )
+    @mock.patch.object(
+        cchain.consumers.mp.PartitionedMPFeedReader,
+        'task_queue_length',
+        1
+    )
+    def test_dead_persister(self):
+        feed_reader = cchain.consumers.mp.PartitionedMPFeedReader(
+            limit=1,
+            flush_interval=datetime.timedelta(seconds=10),
+            processor=cchain.processors.base.BaseChangesProcessor(),
+            seqtracker=mock.MagicMock(name='seqtracker'),
+            partitions=2
+        )
+
+        persister_process = feed_reader._persister_processes[0]
+        persister_process.terminate()
+        persister_process.join()
+
+        feed_reader.put_task(0, (0, []))
+
+        self.assertRaises(
+            pycouchdb.exceptions.FeedReaderExited,
+            feed_reader.put_task,
+            0,
+            (1, [])
+        )
+
+        feed_reader.cleanup()
@@ -0,0 +1,66 @@
+import datetime
+import threading
+import unittest
+
+import cchain
+import mock
+import pycouchdb
+
+from ..processors import samples
+
+
+class PipelinedFeedReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = cchain.processors.base.BaseChangesProcessor()
+        self.seqtracker = mock.MagicMock(name='seqtracker')
+        self.feed_reader = cchain.consumers.pipelined.PipelinedFeedReader(
+            limit=1,
+            flush_interval=datetime.timedelta(seconds=10),
+            processor=self.processor,
+            seqtracker=self.seqtracker,
+            max_in_flight=2
+        )
+
+    def test_watermark(self):
+        first_batch_started = threading.Event()
+        release_first_batch = threading.Event()
+
+        persist_changes = self.processor.persist_changes
+
+        def slow_persist_changes(processed_changes):
+            if processed_changes[0][2] == samples.CHANGES[0]['seq']:
+                first_batch_started.set()
+                release_first_batch.wait(5)
+            persist_changes(processed_changes)
+
+        self.processor.persist_changes = slow_persist_changes
+
+        self.feed_reader.on_message(samples.CHANGES[0])
+        first_batch_started.wait(5)
+        self.feed_reader.on_message(samples.CHANGES[1])
+
+        # The first batch hasn't been persisted yet.
+        self.assertFalse(self.seqtracker.put_seq.called)
+
+        release_first_batch.set()
+        self.feed_reader.cleanup()
+
+        self.seqtracker.put_seq.assert_called_with(samples.CHANGES[1]['seq'])
+        # Both batches are accounted for once the watermark moves.
+        self.seqtracker.record_changes.assert_called_once_with(2)
+
+    def test_error_stops_watermark(self):
+        self.processor.persist_changes = mock.MagicMock(
+            side_effect=cchain.processors.exceptions.ProcessingError
+        )
+
+        self.feed_reader.on_message(samples.CHANGES[0])
+        self.feed_reader._executor.shutdown(wait=True)
+
+        self.assertRaises(
+            pycouchdb.exceptions.FeedReaderExited,
+            self.feed_reader.on_message,
+            samples.CHANGES[1]
+        )
+        self.assertFalse(self.seqtracker.put_seq.called)
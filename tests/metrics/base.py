@@ -0,0 +1,77 @@
+import datetime
+import unittest
+
+import cchain
+import mock
+
+from ..processors import samples
+
+
+class BaseMetricsSinkTestCase(unittest.TestCase):
+
+    def test_timer(self):
+        metrics = cchain.metrics.base.BaseMetricsSink()
+        metrics.timing = mock.MagicMock(name='timing')
+
+        with self.assertRaises(ValueError):
+            with metrics.timer('persist_changes'):
+                raise ValueError
+
+        (name, seconds, ), kwargs = metrics.timing.call_args
+
+        self.assertEqual(name, 'persist_changes')
+        self.assertGreaterEqual(seconds, 0)
+
+    def test_record_batch(self):
+        metrics = cchain.metrics.base.BaseMetricsSink()
+        metrics.increment = mock.MagicMock(name='increment')
+        metrics.gauge = mock.MagicMock(name='gauge')
+
+        metrics.record_batch(10, 0.5)
+
+        self.assertEqual(
+            metrics.increment.call_args_list,
+            [mock.call('batches'), mock.call('changes', 10)]
+        )
+        self.assertEqual(
+            metrics.gauge.call_args_list,
+            [
+                mock.call('batch_size', 10),
+                mock.call('changes_per_second', 20.0),
+            ]
+        )
+
+
+class InstrumentedFeedReaderTestCase(unittest.TestCase):
+
+    def test_flush_buffer(self):
+        metrics = cchain.metrics.prometheus.PrometheusMetricsSink()
+        seqtracker = mock.MagicMock(name='seqtracker')
+
+        feed_reader = cchain.consumers.base.ChangesFeedReader(
+            limit=len(samples.CHANGES),
+            flush_interval=datetime.timedelta(seconds=10),
+            processor=cchain.processors.base.BaseChangesProcessor(),
+            seqtracker=seqtracker,
+            metrics=metrics
+        )
+
+        for change_line in samples.CHANGES:
+            feed_reader.on_message(change_line)
+
+        seqtracker.put_seq.assert_called_once_with(samples.CHANGES[-1]['seq'])
+
+        rendered = metrics.render()
+
+        for metric in (
+            'feed_wait',
+            'process_changes',
+            'persist_changes',
+            'put_seq',
+        ):
+            self.assertIn('cchain_%s_seconds_count 1\n' % metric, rendered)
+
+        self.assertIn(
+            'cchain_changes_total %d\n' % len(samples.CHANGES),
+            rendered
+        )
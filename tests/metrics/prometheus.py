@@ -0,0 +1,46 @@
+import unittest
+import urllib.request
+
+import cchain
+
+
+class PrometheusMetricsSinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = cchain.metrics.prometheus.PrometheusMetricsSink()
+
+    def test_render(self):
+        metrics = self.metrics
+
+        metrics.increment('changes', 10)
+        metrics.increment('changes', 5)
+        metrics.timing('persist_changes', 0.25)
+        metrics.timing('persist_changes', 0.5)
+        metrics.gauge('batch_size', 5)
+
+        self.assertEqual(
+            metrics.render(),
+            '# TYPE cchain_changes_total counter\n'
+            'cchain_changes_total 15\n'
+            '# TYPE cchain_persist_changes_seconds summary\n'
+            'cchain_persist_changes_seconds_sum 0.75\n'
+            'cchain_persist_changes_seconds_count 2\n'
+            '# TYPE cchain_batch_size gauge\n'
+            'cchain_batch_size 5\n'
+        )
+
+    def test_http_server(self):
+        self.metrics.increment('batches')
+
+        http_server = self.metrics.start_http_server(0, host='127.0.0.1')
+        self.addCleanup(http_server.server_close)
+        self.addCleanup(http_server.shutdown)
+
+        response = urllib.request.urlopen(
+            'http://127.0.0.1:%d/metrics' % http_server.server_address[1]
+        )
+
+        self.assertEqual(
+            response.read().decode('utf-8'),
+            self.metrics.render()
+        )
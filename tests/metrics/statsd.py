@@ -0,0 +1,37 @@
+import socket
+import unittest
+
+import cchain
+
+
+class StatsdMetricsSinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+        self.addCleanup(self.server.close)
+
+        self.metrics = cchain.metrics.statsd.StatsdMetricsSink(
+            '127.0.0.1',
+            self.server.getsockname()[1]
+        )
+        self.addCleanup(self.metrics.close)
+
+    def receive(self):
+        return self.server.recv(1024).decode('utf-8')
+
+    def test_send(self):
+        self.metrics.increment('changes', 10)
+        self.metrics.timing('persist_changes', 0.25)
+        self.metrics.gauge('batch_size', 5)
+
+        self.assertEqual(self.receive(), 'cchain.changes:10|c')
+        self.assertEqual(self.receive(), 'cchain.persist_changes:250.0|ms')
+        self.assertEqual(self.receive(), 'cchain.batch_size:5|g')
+
+    def test_send_failure(self):
+        self.metrics.close()
+
+        # Doesn't raise.
+        self.metrics.increment('changes')
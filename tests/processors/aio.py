@@ -0,0 +1,383 @@
+import asyncio
+import json
+import unittest
+
+import cchain
+import mock
+
+from . import s3 as s3_tests
+from . import samples
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+
+class FakeServerMixin(object):
+    """Runs coroutines against a local aiohttp server that records the
+    requests it gets and replies with canned responses.
+
+    """
+
+    def setUp(self):
+        self.requests = []
+        self.responses = []
+
+    async def _handle(self, request):
+        self.requests.append((request.path, await request.read()))
+
+        status, body = self.responses.pop(0)
+
+        return web.json_response(body, status=status)
+
+    async def _run(self, routes, get_coroutine):
+        app = web.Application()
+        for route in routes:
+            app.router.add_post(route, self._handle)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+
+        try:
+            await get_coroutine('http://127.0.0.1:%d' % port)
+        finally:
+            await runner.cleanup()
+
+    def run_with_server(self, routes, get_coroutine):
+        asyncio.run(self._run(routes, get_coroutine))
+
+
+@unittest.skipIf(web is None, 'aiohttp is not installed')
+class AsyncSimpleESChangesProcessorTestCase(
+    FakeServerMixin,
+    unittest.TestCase
+):
+
+    def get_bulk_response(self, statuses):
+        items = []
+
+        for status in statuses:
+            result = {
+                'status': status,
+            }
+            if status >= 400:
+                result['error'] = {
+                    'type': 'error',
+                }
+            items.append({'update': result})
+
+        return (200, {
+            'errors': any(status >= 400 for status in statuses),
+            'items': items,
+        }, )
+
+    def persist(self, **kwargs):
+
+        async def persist(url):
+            processor = cchain.processors.aio.AsyncSimpleESChangesProcessor(
+                [url],
+                'test_index',
+                'test_type',
+                **kwargs
+            )
+            processed_changes, seq = processor.process_changes(
+                samples.CHANGES_DOCS
+            )
+            self.processed_changes = processed_changes
+            try:
+                await processor.persist_changes_async(processed_changes)
+            finally:
+                await processor.cleanup_async()
+
+        self.run_with_server(['/_bulk'], persist)
+
+    def get_bulk_ops(self, body):
+        return [json.loads(line) for line in body.splitlines()]
+
+    def test_persist_changes(self):
+        self.responses = [self.get_bulk_response([200, 200, 200])]
+
+        self.persist()
+
+        self.assertEqual(len(self.requests), 1)
+        path, body = self.requests[0]
+        self.assertEqual(
+            self.get_bulk_ops(body),
+            cchain.processors.es.SimpleESChangesProcessor(
+                ['http://localhost:9200'],
+                'test_index',
+                'test_type'
+            ).get_bulk_ops(self.processed_changes)
+        )
+
+    def test_max_bulk_bytes(self):
+        self.responses = [
+            self.get_bulk_response([200]),
+            self.get_bulk_response([200]),
+            self.get_bulk_response([200]),
+        ]
+
+        self.persist(max_bulk_bytes=1)
+
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(
+            [
+                next(iter(self.get_bulk_ops(body)[0].values()))['_id']
+                for (path, body, ) in self.requests
+            ],
+            [doc['_id'] for (doc, rev, seq, ) in self.processed_changes]
+        )
+
+    def test_retry_rejected_items(self):
+        self.responses = [
+            self.get_bulk_response([200, 429, 200]),
+            self.get_bulk_response([200]),
+        ]
+
+        self.persist(max_retries=2, retry_backoff=0)
+
+        self.assertEqual(len(self.requests), 2)
+        path, body = self.requests[1]
+        self.assertEqual(
+            next(iter(self.get_bulk_ops(body)[0].values()))['_id'],
+            self.processed_changes[1][0]['_id']
+        )
+
+    def test_errors(self):
+        self.responses = [self.get_bulk_response([200, 400, 200])]
+
+        self.assertRaises(
+            cchain.processors.exceptions.ProcessingError,
+            self.persist
+        )
+
+    def test_server_error(self):
+        self.responses = [(500, {'error': 'boom'}, )]
+
+        self.assertRaises(
+            cchain.processors.exceptions.ProcessingError,
+            self.persist
+        )
+
+
+@unittest.skipIf(web is None, 'aiohttp is not installed')
+class AsyncSimpleCouchdbChangesProcessorTestCase(
+    FakeServerMixin,
+    unittest.TestCase
+):
+
+    def persist(self, **kwargs):
+
+        async def persist(url):
+            if kwargs.get('new_edits') is False:
+                kwargs.update({
+                    'source_couchdb_uri': url,
+                    'source_couchdb_name': 'source_db',
+                })
+
+            with mock.patch('pycouchdb.Server'):
+                processor = (
+                    cchain.processors.aio.AsyncSimpleCouchdbChangesProcessor(
+                        url,
+                        'test_db',
+                        **kwargs
+                    )
+                )
+            processed_changes, seq = processor.process_changes(
+                samples.CHANGES_DOCS
+            )
+            self.processed_changes = processed_changes
+            try:
+                await processor.persist_changes_async(processed_changes)
+            finally:
+                await processor.cleanup_async()
+
+        self.run_with_server(
+            [
+                '/source_db/_bulk_get',
+                '/test_db/_all_docs',
+                '/test_db/_bulk_docs',
+            ],
+            persist
+        )
+
+    def test_persist_changes(self):
+        self.responses = [
+            (200, {'rows': [
+                {'key': samples.CHANGES_DOCS[0]['id'], 'error': 'not_found'},
+                {
+                    'key': samples.CHANGES_DOCS[1]['id'],
+                    'value': {'rev': '3-abc'},
+                },
+                {'key': samples.CHANGES_DOCS[2]['id'], 'error': 'not_found'},
+            ]}, ),
+            (201, [{'ok': True}, {'ok': True}, {'ok': True}], ),
+        ]
+
+        self.persist()
+
+        self.assertEqual(
+            [path for (path, body, ) in self.requests],
+            ['/test_db/_all_docs', '/test_db/_bulk_docs']
+        )
+        self.assertEqual(
+            json.loads(self.requests[0][1]),
+            {'keys': [sample['id'] for sample in samples.CHANGES_DOCS]}
+        )
+
+        docs = json.loads(self.requests[1][1])['docs']
+        self.assertEqual(docs[1]['_rev'], '3-abc')
+        self.assertEqual(
+            docs[0]['_rev'],
+            samples.CHANGES_DOCS[0]['doc']['_rev']
+        )
+
+    def test_conflict_retried(self):
+        doc_id = samples.CHANGES_DOCS[0]['id']
+        self.responses = [
+            (200, {'rows': []}, ),
+            (201, [{'error': 'conflict'}, {'ok': True}, {'ok': True}], ),
+            (200, {'rows': [{'key': doc_id, 'value': {'rev': '3-abc'}}]}, ),
+            (201, [{'ok': True}], ),
+        ]
+
+        self.persist()
+
+        self.assertEqual(
+            [path for (path, body, ) in self.requests],
+            [
+                '/test_db/_all_docs',
+                '/test_db/_bulk_docs',
+                '/test_db/_all_docs',
+                '/test_db/_bulk_docs',
+            ]
+        )
+        self.assertEqual(json.loads(self.requests[2][1]), {'keys': [doc_id]})
+
+        docs = json.loads(self.requests[3][1])['docs']
+        self.assertEqual([doc['_id'] for doc in docs], [doc_id])
+        self.assertEqual(docs[0]['_rev'], '3-abc')
+
+    def test_replicate_changes(self):
+        revisions = {'start': 2, 'ids': ['abc', 'def']}
+        self.responses = [
+            (200, {'results': [
+                {'id': sample['id'], 'docs': [{'ok': {
+                    '_id': sample['id'],
+                    '_revisions': revisions,
+                }}]}
+                for sample in samples.CHANGES_DOCS
+            ]}, ),
+            (201, [], ),
+        ]
+
+        self.persist(new_edits=False)
+
+        self.assertEqual(
+            [path for (path, body, ) in self.requests],
+            ['/source_db/_bulk_get', '/test_db/_bulk_docs']
+        )
+
+        body = json.loads(self.requests[1][1])
+        self.assertFalse(body['new_edits'])
+        self.assertEqual(
+            [doc['_revisions'] for doc in body['docs']],
+            [revisions] * len(samples.CHANGES_DOCS)
+        )
+
+    def test_errors(self):
+        self.responses = [
+            (200, {'rows': []}, ),
+            (201, [{'error': 'conflict'}], ),
+        ]
+
+        self.assertRaises(
+            cchain.processors.exceptions.ProcessingError,
+            self.persist
+        )
+
+    def test_server_error(self):
+        self.responses = [
+            (200, {'rows': []}, ),
+            (500, {'error': 'boom'}, ),
+        ]
+
+        self.assertRaises(
+            cchain.processors.exceptions.ProcessingError,
+            self.persist
+        )
+
+
+class AsyncSimpleS3ChangesProcessorTestCase(unittest.TestCase):
+
+    def get_processor(self, **kwargs):
+        with mock.patch('boto3.resource'):
+            processor = cchain.processors.aio.AsyncSimpleS3ChangesProcessor(
+                'test_bucket',
+                **kwargs
+            )
+        processor._bucket = s3_tests.FakeS3Bucket()
+        self.addCleanup(processor.cleanup)
+
+        return processor
+
+    def persist(self, processor):
+        processed_changes, seq = processor.process_changes(
+            samples.CHANGES_DOCS
+        )
+
+        asyncio.run(processor.persist_changes_async(processed_changes))
+
+    def test_persist_changes(self):
+        processor = self.get_processor()
+
+        self.persist(processor)
+
+        self.assertEqual(
+            sorted(processor._bucket.objects),
+            sorted(
+                '%s/%s' % (sample['id'], sample['changes'][0]['rev'])
+                for sample in samples.CHANGES_DOCS
+            )
+        )
+
+    def test_archive_batches(self):
+        processor = self.get_processor(archive_batches=True)
+
+        self.persist(processor)
+
+        self.assertEqual(len(processor._bucket.objects), 2)
+
+    def test_max_bytes_in_flight(self):
+        processor = self.get_processor(max_bytes_in_flight=1)
+        upload_budget = processor._upload_budget
+        upload_budget.acquire = mock.MagicMock(
+            name='acquire',
+            wraps=upload_budget.acquire
+        )
+
+        self.persist(processor)
+
+        self.assertEqual(
+            upload_budget.acquire.call_count,
+            len(samples.CHANGES_DOCS)
+        )
+        self.assertEqual(upload_budget.bytes_in_flight, 0)
+        self.assertEqual(
+            len(processor._bucket.objects),
+            len(samples.CHANGES_DOCS)
+        )
+
+    def test_errors(self):
+        processor = self.get_processor()
+        processor._store_doc = mock.MagicMock(
+            name='_store_doc',
+            side_effect=RuntimeError
+        )
+
+        self.assertRaises(RuntimeError, self.persist, processor)
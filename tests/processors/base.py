@@ -76,3 +76,149 @@ class BaseDocWithSeqChangesProcessorTestCase(
 
         processed_change = self.processor.process_change_line(change_line)
         self.assertEqual(processed_change, expected_result)
+
+
+class BaseDocChangesProcessorCopyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.change_line = copy.deepcopy(samples.CHANGES_DOCS[0])
+        self.change_line['doc']['nested'] = {
+            'key': 'value',
+        }
+
+    def test_shallow_copy(self):
+        processor = cchain.processors.base.BaseDocChangesProcessor()
+
+        doc, rev, seq = processor.process_change_line(self.change_line)
+
+        self.assertNotIn('_seq', self.change_line['doc'])
+        self.assertIs(doc['nested'], self.change_line['doc']['nested'])
+
+    def test_deep_copy(self):
+        processor = cchain.processors.base.BaseDocChangesProcessor(
+            deep_copy=True
+        )
+
+        doc, rev, seq = processor.process_change_line(self.change_line)
+
+        self.assertNotIn('_seq', self.change_line['doc'])
+        self.assertEqual(doc['nested'], self.change_line['doc']['nested'])
+        self.assertIsNot(doc['nested'], self.change_line['doc']['nested'])
+
+
+class NoSuperChangesProcessorTestCase(unittest.TestCase):
+    """Subclasses written before the base classes had an `__init__`
+    don't call it.
+
+    """
+
+    def test_base_processor(self):
+
+        class Processor(cchain.processors.base.BaseChangesProcessor):
+
+            def __init__(self):
+                pass
+
+        processor = Processor()
+
+        (processed_changes, seq, ) = processor.process_changes(
+            samples.CHANGES
+        )
+
+        self.assertEqual(len(processed_changes), len(samples.CHANGES))
+        self.assertEqual(seq, samples.CHANGES[-1]['seq'])
+        self.assertIsNone(processor.get_feed_filter())
+
+    def test_doc_processor(self):
+
+        class Processor(cchain.processors.base.BaseDocChangesProcessor):
+
+            def __init__(self):
+                pass
+
+        processor = Processor()
+
+        (processed_changes, seq, ) = processor.process_changes(
+            samples.CHANGES_DOCS
+        )
+
+        self.assertEqual(
+            [doc['_seq'] for (doc, rev, seq, ) in processed_changes],
+            [sample['seq'] for sample in samples.CHANGES_DOCS]
+        )
+
+
+class CoalescingChangesProcessorTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.processor = cchain.processors.base.BaseChangesProcessor(
+            coalesce=True
+        )
+        self.samples = copy.deepcopy(samples.CHANGES)
+
+        updated_change = copy.deepcopy(samples.CHANGES[0])
+        updated_change['seq'] = 12
+        self.samples.append(updated_change)
+
+    def test_process_changes(self):
+
+        (processed_changes, seq, ) = self.processor.process_changes(
+            self.samples
+        )
+
+        self.assertEqual(seq, 12)
+        self.assertEqual(
+            [seq for change_line, rev, seq in processed_changes],
+            [9, 11, 12]
+        )
+
+
+class FeedFilterChangesProcessorTestCase(unittest.TestCase):
+
+    def test_no_filter(self):
+        processor = cchain.processors.base.BaseChangesProcessor()
+
+        self.assertIsNone(processor.get_feed_filter())
+
+    def test_selector(self):
+        processor = cchain.processors.base.BaseChangesProcessor(
+            selector={'type': 'user'}
+        )
+
+        self.assertEqual(processor.get_feed_filter(), {
+            'filter': '_selector',
+            'data': {
+                'selector': {
+                    '$or': [{'type': 'user'}, {'_deleted': True}],
+                },
+            },
+        })
+
+    def test_doc_ids(self):
+        processor = cchain.processors.base.BaseChangesProcessor(
+            doc_ids=('a', 'b', )
+        )
+
+        self.assertEqual(
+            processor.get_feed_filter(),
+            {'filter': '_doc_ids', 'data': {'doc_ids': ['a', 'b']}}
+        )
+
+    def test_changes_filter(self):
+        processor = cchain.processors.base.BaseChangesProcessor(
+            changes_filter='app/by_type',
+            filter_params={'type': 'user'}
+        )
+
+        self.assertEqual(
+            processor.get_feed_filter(),
+            {'filter': 'app/by_type', 'type': 'user'}
+        )
+
+    def test_several_filters(self):
+        with self.assertRaises(ValueError):
+            cchain.processors.base.BaseChangesProcessor(
+                selector={'type': 'user'},
+                doc_ids=['a']
+            )
@@ -1,3 +1,4 @@
+import json
 import unittest
 
 import cchain
@@ -54,3 +55,243 @@ class SimpleCouchdbChangesProcessorTestCase(
         self.processor._target_couchdb.save_bulk.assert_called_once_with(
             expected_docs
         )
+
+
+class RevisionCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch('pycouchdb.Server'):
+            self.processor = (
+                cchain.processors.couchdb.SimpleCouchdbChangesProcessor(
+                    'http://localhost:5984',
+                    'test_db',
+                    rev_cache_size=2
+                )
+            )
+        self.samples = samples.CHANGES_DOCS
+
+        self.processor._target_couchdb.all = mock.MagicMock(
+            name='all',
+            return_value=[]
+        )
+        self.processor._target_couchdb.save_bulk = mock.MagicMock(
+            name='save_bulk',
+            side_effect=lambda docs: [
+                {'id': doc['_id'], 'rev': '10-abc'} for doc in docs
+            ]
+        )
+
+    def test_cached_revs(self):
+        processed_changes, seq = self.processor.process_changes(
+            self.samples[:2]
+        )
+        self.processor.persist_changes(processed_changes)
+
+        self.processor._target_couchdb.all.reset_mock()
+
+        processed_changes, seq = self.processor.process_changes(self.samples)
+        self.processor.persist_changes(processed_changes)
+
+        self.processor._target_couchdb.all.assert_called_once_with(
+            keys=[self.samples[2]['id']]
+        )
+        saved_docs = self.processor._target_couchdb.save_bulk.call_args[0][0]
+        self.assertEqual(saved_docs[0]['_rev'], '10-abc')
+
+    def test_lru_eviction(self):
+        rev_cache = cchain.processors.couchdb.RevisionCache(2)
+
+        rev_cache.set('a', '1-a')
+        rev_cache.set('b', '1-b')
+        rev_cache.get('a')
+        rev_cache.set('c', '1-c')
+
+        self.assertEqual(rev_cache.get('a'), '1-a')
+        self.assertIsNone(rev_cache.get('b'))
+        self.assertEqual(len(rev_cache), 2)
+
+    def test_conflicts_not_cached(self):
+        self.processor._target_couchdb.save_bulk = mock.MagicMock(
+            name='save_bulk',
+            return_value=[
+                {'id': self.samples[0]['id'], 'error': 'conflict'},
+            ]
+        )
+        self.processor._rev_cache.set(self.samples[0]['id'], '1-old')
+
+        processed_changes, seq = self.processor.process_changes(
+            self.samples[:1]
+        )
+
+        self.assertRaises(
+            cchain.processors.exceptions.ProcessingError,
+            self.processor.persist_changes,
+            processed_changes
+        )
+        self.assertIsNone(self.processor._rev_cache.get(self.samples[0]['id']))
+
+    def test_stale_rev_retried(self):
+        doc_id = self.samples[0]['id']
+
+        def save_bulk(docs):
+            return [
+                {'id': doc['_id'], 'error': 'conflict'}
+                if doc['_rev'] == '1-old' else
+                {'id': doc['_id'], 'rev': '3-new'}
+                for doc in docs
+            ]
+
+        self.processor._target_couchdb.save_bulk = mock.MagicMock(
+            name='save_bulk',
+            side_effect=save_bulk
+        )
+        self.processor._target_couchdb.all.return_value = [
+            {'key': doc_id, 'value': {'rev': '2-current'}},
+        ]
+        self.processor._rev_cache.set(doc_id, '1-old')
+
+        processed_changes, seq = self.processor.process_changes(
+            self.samples[:1]
+        )
+        self.processor.persist_changes(processed_changes)
+
+        self.processor._target_couchdb.all.assert_called_once_with(
+            keys=[doc_id]
+        )
+        save_bulk = self.processor._target_couchdb.save_bulk
+        self.assertEqual(save_bulk.call_count, 2)
+        self.assertEqual(save_bulk.call_args[0][0][0]['_rev'], '2-current')
+        self.assertEqual(self.processor._rev_cache.get(doc_id), '3-new')
+
+
+class ReplicatingCouchdbChangesProcessorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch('pycouchdb.Server'):
+            self.processor = (
+                cchain.processors.couchdb.SimpleCouchdbChangesProcessor(
+                    'http://localhost:5984',
+                    'test_db',
+                    new_edits=False,
+                    source_couchdb_uri='http://localhost:5984',
+                    source_couchdb_name='source_db'
+                )
+            )
+        self.samples = samples.CHANGES_DOCS
+
+        self.processor._target_couchdb.all = mock.MagicMock(name='all')
+        self.processor._target_couchdb.resource.post = mock.MagicMock(
+            name='post',
+            return_value=(None, [])
+        )
+        self.processor._source_couchdb = mock.MagicMock(name='source_couchdb')
+        self.processor._source_couchdb.resource.post.side_effect = (
+            self.bulk_get
+        )
+
+    def get_revisions(self, rev):
+        (start, rev_id, ) = rev.split('-')
+
+        return {
+            'start': int(start),
+            'ids': [rev_id] + [
+                'ancestor-%d' % i for i in range(int(start) - 1)
+            ],
+        }
+
+    def bulk_get(self, path, params=None, data=None):
+        results = []
+
+        for doc in json.loads(data)['docs']:
+            results.append({
+                'id': doc['id'],
+                'docs': [{
+                    'ok': {
+                        '_id': doc['id'],
+                        '_rev': doc['rev'],
+                        '_revisions': self.get_revisions(doc['rev']),
+                    },
+                }],
+            })
+
+        return (None, {'results': results}, )
+
+    def test_missing_source(self):
+        with mock.patch('pycouchdb.Server'):
+            self.assertRaises(
+                ValueError,
+                cchain.processors.couchdb.SimpleCouchdbChangesProcessor,
+                'http://localhost:5984',
+                'test_db',
+                new_edits=False
+            )
+
+    def test_persist_changes(self):
+        processed_changes, seq = self.processor.process_changes(self.samples)
+
+        self.processor.persist_changes(processed_changes)
+
+        self.assertFalse(self.processor._target_couchdb.all.called)
+
+        args, kwargs = self.processor._source_couchdb.resource.post.call_args
+        self.assertEqual(args, ('_bulk_get', ))
+        self.assertEqual(kwargs['params'], {'revs': 'true'})
+        self.assertEqual(
+            json.loads(kwargs['data'])['docs'],
+            [
+                {'id': sample['id'], 'rev': sample['changes'][0]['rev']}
+                for sample in self.samples
+            ]
+        )
+
+        args, kwargs = self.processor._target_couchdb.resource.post.call_args
+        self.assertEqual(args, ('_bulk_docs', ))
+
+        body = json.loads(kwargs['data'])
+        self.assertFalse(body['new_edits'])
+        self.assertEqual(
+            [doc['_rev'] for doc in body['docs']],
+            [sample['changes'][0]['rev'] for sample in self.samples]
+        )
+        # The ancestry is sent, so updates and deletions extend the
+        # existing branch instead of starting new ones.
+        self.assertEqual(
+            [doc['_revisions'] for doc in body['docs']],
+            [
+                self.get_revisions(sample['changes'][0]['rev'])
+                for sample in self.samples
+            ]
+        )
+
+    def test_missing_revision(self):
+        self.processor._source_couchdb.resource.post.side_effect = None
+        self.processor._source_couchdb.resource.post.return_value = (
+            None,
+            {'results': [{
+                'id': self.samples[0]['id'],
+                'docs': [{'error': {'error': 'not_found'}}],
+            }]},
+        )
+
+        processed_changes, seq = self.processor.process_changes(self.samples)
+
+        self.assertRaises(
+            cchain.processors.exceptions.ProcessingError,
+            self.processor.persist_changes,
+            processed_changes
+        )
+        self.assertFalse(self.processor._target_couchdb.resource.post.called)
+
+    def test_errors(self):
+        self.processor._target_couchdb.resource.post.return_value = (
+            None,
+            [{'id': self.samples[0]['id'], 'error': 'forbidden'}]
+        )
+
+        processed_changes, seq = self.processor.process_changes(self.samples)
+
+        self.assertRaises(
+            cchain.processors.exceptions.ProcessingError,
+            self.processor.persist_changes,
+            processed_changes
+        )
@@ -0,0 +1,165 @@
+import json
+import unittest
+
+import cchain
+import mock
+
+from . import samples
+
+
+class RedisEntityProcessorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('redis.StrictRedis')
+        self.redis_class = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.redis_server = self.redis_class.return_value
+        self.pipeline = self.redis_server.pipeline.return_value
+
+    def get_processor(self, **kwargs):
+        return cchain.processors.entity.RedisEntityProcessor(
+            'source_set',
+            'target_set',
+            **kwargs
+        )
+
+    def test_persist_changes(self):
+        processor = self.get_processor()
+
+        processed_changes, last_seq = processor.process_changes(
+            samples.CHANGES
+        )
+        processor.persist_changes(processed_changes)
+
+        self.redis_server.pipeline.assert_called_once_with(transaction=True)
+        self.assertEqual(self.pipeline.zadd.call_count, 1)
+
+        (set_name, mapping, ), kwargs = self.pipeline.zadd.call_args
+
+        self.assertEqual(set_name, 'target_set')
+        self.assertEqual(
+            sorted(mapping),
+            sorted(set(change['id'] for change in samples.CHANGES))
+        )
+        self.assertEqual(len(set(mapping.values())), 1)
+        self.assertEqual(kwargs, {'nx': False, 'lt': True})
+        self.pipeline.execute.assert_called_once_with()
+
+    def test_persist_changes_chunks(self):
+        processor = self.get_processor(merge_mode='nx', chunk_size=2)
+
+        processed_changes = [
+            ('entity_%d' % i, None, i, ) for i in range(5)
+        ]
+        processor.persist_changes(processed_changes)
+
+        chunk_sizes = [
+            len(call[0][1]) for call in self.pipeline.zadd.call_args_list
+        ]
+
+        self.assertEqual(chunk_sizes, [2, 2, 1])
+        for call in self.pipeline.zadd.call_args_list:
+            self.assertEqual(call[1], {'nx': True, 'lt': False})
+        self.pipeline.execute.assert_called_once_with()
+
+    def test_persist_changes_lua(self):
+        processor = self.get_processor(merge_mode='lua', chunk_size=2)
+        zadd_min = self.redis_server.register_script.return_value
+
+        processed_changes = [
+            ('entity_%d' % i, None, i, ) for i in range(3)
+        ]
+        processor.persist_changes(processed_changes)
+
+        self.assertEqual(zadd_min.call_count, 2)
+        self.assertFalse(self.pipeline.zadd.called)
+
+        kwargs = zadd_min.call_args_list[0][1]
+        self.assertEqual(kwargs['keys'], ['target_set'])
+        self.assertEqual(kwargs['args'][1:], ['entity_0', 'entity_1'])
+        self.assertIs(kwargs['client'], self.pipeline)
+        self.pipeline.execute.assert_called_once_with()
+
+    def test_invalid_merge_mode(self):
+        with self.assertRaises(ValueError):
+            self.get_processor(merge_mode='union')
+
+
+class RedisStreamProcessorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('redis.StrictRedis')
+        self.redis_class = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.redis_server = self.redis_class.return_value
+        self.pipeline = self.redis_server.pipeline.return_value
+
+    def get_processor(self, **kwargs):
+        return cchain.processors.entity.RedisStreamProcessor(
+            'changes_stream',
+            **kwargs
+        )
+
+    def test_process_changes(self):
+        processor = self.get_processor()
+
+        processed_changes, last_seq = processor.process_changes(
+            samples.CHANGES
+        )
+
+        self.assertEqual(len(processed_changes), len(samples.CHANGES))
+        self.assertEqual(last_seq, samples.CHANGES[-1]['seq'])
+
+        for (fields, rev, seq, ), change in zip(
+            processed_changes,
+            samples.CHANGES
+        ):
+            self.assertEqual(fields['id'], change['id'])
+            self.assertEqual(fields['rev'], change['changes'][0]['rev'])
+            self.assertEqual(fields['seq'], str(change['seq']))
+            self.assertEqual(
+                fields.get('deleted'),
+                '1' if change.get('deleted') else None
+            )
+            self.assertNotIn('doc', fields)
+
+    def test_process_changes_include_docs(self):
+        processor = self.get_processor(include_docs=True)
+
+        processed_changes, last_seq = processor.process_changes(
+            samples.CHANGES
+        )
+
+        for (fields, rev, seq, ), change in zip(
+            processed_changes,
+            samples.CHANGES
+        ):
+            if change.get('doc') is None:
+                self.assertNotIn('doc', fields)
+            else:
+                self.assertEqual(json.loads(fields['doc']), change['doc'])
+
+    def test_persist_changes(self):
+        processor = self.get_processor(max_len=100, chunk_size=2)
+
+        processed_changes = [
+            ({'id': 'doc_%d' % i}, None, i, ) for i in range(5)
+        ]
+        processor.persist_changes(processed_changes)
+
+        self.redis_server.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(
+            self.pipeline.xadd.call_args_list,
+            [
+                mock.call(
+                    'changes_stream',
+                    {'id': 'doc_%d' % i},
+                    maxlen=100,
+                    approximate=True
+                )
+                for i in range(5)
+            ]
+        )
+        self.assertEqual(self.pipeline.execute.call_count, 3)
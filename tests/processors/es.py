@@ -1,4 +1,6 @@
+import json
 import unittest
+import uuid
 
 import cchain
 import mock
@@ -87,8 +89,469 @@ class SimpleESChangesProcessorTestCase(
             self
         ).test_process_changes()
 
+        bulk_kwargs = {
+            'timeout': self.processor._bulk_timeout,
+        }
+        if not hasattr(self.processor._es, 'options'):
+            bulk_kwargs['request_timeout'] = self.processor._request_timeout
+
         self.processor._es.bulk.assert_called_once_with(
-            self.expected_bulk_ops,
-            timeout=self.processor._bulk_timeout,
-            request_timeout=self.processor._bulk_timeout
+            body=self.expected_bulk_ops,
+            **bulk_kwargs
+        )
+
+
+class BulkBodyBuilderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ops_and_items = [
+            ([{'index': {'_id': str(i)}}, {'value': 'x' * 10}], i)
+            for i in range(5)
+        ]
+
+    def test_single_body(self):
+        builder = cchain.processors.es.BulkBodyBuilder()
+
+        bodies = list(builder.iter_bodies(self.ops_and_items))
+
+        self.assertEqual(len(bodies), 1)
+        body, items = bodies[0]
+        self.assertEqual(items, list(range(5)))
+        self.assertEqual(len(body.splitlines()), 10)
+        self.assertEqual(
+            json.loads(body.splitlines()[1].decode('utf-8')),
+            {'value': 'x' * 10}
+        )
+
+    def test_max_bytes(self):
+        doc_size = len(
+            cchain.processors.es.BulkBodyBuilder().serialize(
+                self.ops_and_items[0][0]
+            )
+        )
+        builder = cchain.processors.es.BulkBodyBuilder(
+            max_bytes=doc_size * 2
+        )
+
+        bodies = list(builder.iter_bodies(self.ops_and_items))
+
+        self.assertEqual(
+            [items for body, items in bodies],
+            [[0, 1], [2, 3], [4]]
+        )
+        for body, items in bodies:
+            self.assertLessEqual(len(body), doc_size * 2)
+
+    def test_oversized_item(self):
+        builder = cchain.processors.es.BulkBodyBuilder(max_bytes=10)
+
+        bodies = list(builder.iter_bodies(self.ops_and_items))
+
+        self.assertEqual(
+            [items for body, items in bodies],
+            [[0], [1], [2], [3], [4]]
+        )
+
+
+    def test_interleaved_calls(self):
+        doc_size = len(
+            cchain.processors.es.BulkBodyBuilder().serialize(
+                self.ops_and_items[0][0]
+            )
+        )
+        builder = cchain.processors.es.BulkBodyBuilder(
+            max_bytes=doc_size * 2
+        )
+
+        expected_bodies = list(builder.iter_bodies(self.ops_and_items))
+
+        # Another caller (e.g. a thread) uses the builder in the middle
+        # of the first call.
+        other_bodies = builder.iter_bodies(self.ops_and_items)
+        interleaved_bodies = []
+
+        def ops_and_items():
+            for ops_and_item in self.ops_and_items:
+                yield ops_and_item
+                interleaved_bodies.append(next(other_bodies, None))
+
+        bodies = list(builder.iter_bodies(ops_and_items()))
+
+        self.assertEqual(bodies, expected_bodies)
+        self.assertEqual(
+            [body for body in interleaved_bodies if body is not None],
+            expected_bodies
+        )
+
+
+class MaxBulkBytesESChangesProcessorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = (
+            cchain.processors.es.SimpleESChangesProcessor(
+                ['http://localhost:5984'],
+                'test_index',
+                'test_type',
+                max_bulk_bytes=1
+            )
+        )
+        self.processed_changes, seq = self.processor.process_changes(
+            samples.CHANGES_DOCS
+        )
+        self.processor._es.bulk = mock.MagicMock(
+            name='bulk',
+            return_value={'errors': False, 'items': [{'update': {}}]}
+        )
+
+    def test_persist_changes(self):
+        self.processor.persist_changes(self.processed_changes)
+
+        bodies = [
+            call[1]['body'] for call in self.processor._es.bulk.call_args_list
+        ]
+
+        self.assertEqual(len(bodies), len(self.processed_changes))
+        self.assertEqual(
+            [
+                [json.loads(line) for line in body.splitlines()]
+                for body in bodies
+            ],
+            [
+                self.processor.get_ops_for_bulk(doc)
+                for (doc, rev, seq, ) in self.processed_changes
+            ]
+        )
+
+    def test_errors(self):
+        self.processor._es.bulk.return_value = {
+            'errors': True,
+            'items': [{'update': {'status': 400, 'error': {}}}],
+        }
+
+        self.assertRaises(
+            cchain.processors.exceptions.ProcessingError,
+            self.processor.persist_changes,
+            self.processed_changes
+        )
+
+
+class SimpleESChangesProcessorRetryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = (
+            cchain.processors.es.SimpleESChangesProcessor(
+                ['http://localhost:5984'],
+                'test_index',
+                'test_type',
+                max_retries=2,
+                retry_backoff=0
+            )
+        )
+        self.processed_changes, seq = self.processor.process_changes(
+            samples.CHANGES_DOCS
+        )
+
+    def get_bulk_response(self, statuses):
+        items = []
+
+        for status in statuses:
+            result = {
+                'status': status,
+            }
+            if status >= 400:
+                result['error'] = {
+                    'type': 'error',
+                }
+            items.append({'update': result})
+
+        return {
+            'errors': any(status >= 400 for status in statuses),
+            'items': items,
+        }
+
+    def test_retry_rejected_items(self):
+        self.processor._es.bulk = mock.MagicMock(
+            name='bulk',
+            side_effect=[
+                self.get_bulk_response([200, 429, 409]),
+                self.get_bulk_response([429, 200]),
+                self.get_bulk_response([200]),
+            ]
+        )
+
+        self.processor.persist_changes(self.processed_changes)
+
+        self.assertEqual(self.processor._es.bulk.call_count, 3)
+        self.assertEqual(
+            self.processor._es.bulk.call_args[1]['body'],
+            self.processor.get_bulk_ops(self.processed_changes[1:2])
+        )
+
+    def test_permanent_failures(self):
+        self.processor._es.bulk = mock.MagicMock(
+            name='bulk',
+            side_effect=[
+                self.get_bulk_response([400, 429, 200]),
+                self.get_bulk_response([200]),
+            ]
+        )
+        self.processor.handle_failed_changes = mock.MagicMock(
+            name='handle_failed_changes'
+        )
+
+        self.processor.persist_changes(self.processed_changes)
+
+        self.processor.handle_failed_changes.assert_called_once_with([
+            (self.processed_changes[0], {'type': 'error'}),
+        ])
+
+    def test_retries_exhausted(self):
+        self.processor._es.bulk = mock.MagicMock(
+            name='bulk',
+            return_value=self.get_bulk_response([429, 429, 429])
+        )
+
+        self.assertRaises(
+            cchain.processors.exceptions.ProcessingError,
+            self.processor.persist_changes,
+            self.processed_changes
+        )
+        self.assertEqual(self.processor._es.bulk.call_count, 3)
+
+
+class ConcurrentESChangesProcessorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = (
+            cchain.processors.es.SimpleESChangesProcessor(
+                ['http://localhost:5984'],
+                'test_index',
+                'test_type',
+                bulk_concurrency=2
+            )
+        )
+        self.processed_changes, seq = self.processor.process_changes(
+            samples.CHANGES_DOCS
+        )
+
+    def tearDown(self):
+        self.processor.cleanup()
+
+    def get_bulk_response(self, bulk_ops, status=200):
+        items = []
+
+        for bulk_op in bulk_ops:
+            for op_type in ('update', 'delete'):
+                if op_type in bulk_op:
+                    result = {
+                        '_id': bulk_op[op_type]['_id'],
+                        'status': status,
+                    }
+                    if status >= 400:
+                        result['error'] = {'type': 'error'}
+                    items.append({op_type: result})
+
+        return {
+            'errors': status >= 400,
+            'items': items,
+        }
+
+    def test_get_sub_bulks(self):
+        # Two more changes to the first document.
+        processed_changes = self.processed_changes + [
+            self.processed_changes[0],
+            self.processed_changes[0],
+        ]
+
+        sub_bulks = self.processor.get_sub_bulks(processed_changes)
+
+        self.assertEqual(
+            sorted(
+                (change for changes in sub_bulks for change in changes),
+                key=lambda change: change[2]
+            ),
+            sorted(processed_changes, key=lambda change: change[2])
+        )
+
+        for changes in sub_bulks:
+            doc_ids = set(doc['_id'] for (doc, rev, seq, ) in changes)
+            for other_changes in sub_bulks:
+                if other_changes is not changes:
+                    self.assertFalse(doc_ids.intersection(
+                        doc['_id'] for (doc, rev, seq, ) in other_changes
+                    ))
+
+            # The changes keep the order of the batch.
+            self.assertEqual(
+                changes,
+                [change for change in processed_changes if change in changes]
+            )
+
+    def test_get_sub_bulks_spread(self):
+        processed_changes = [
+            ({'_id': uuid.uuid4().hex}, '1-abc', seq, )
+            for seq in range(100)
+        ]
+
+        sub_bulks = self.processor.get_sub_bulks(processed_changes)
+
+        self.assertEqual(len(sub_bulks), 2)
+
+    def test_persist_changes(self):
+        self.processor._es.bulk = mock.MagicMock(
+            name='bulk',
+            side_effect=lambda body, **kwargs: self.get_bulk_response(
+                body
+            )
+        )
+        self.processor._metrics = mock.MagicMock(name='metrics')
+
+        self.processor.persist_changes(self.processed_changes)
+
+        sub_bulks = self.processor.get_sub_bulks(self.processed_changes)
+
+        self.assertEqual(self.processor._es.bulk.call_count, len(sub_bulks))
+        self.assertEqual(
+            sorted(
+                json.dumps(call[1]['body'], sort_keys=True)
+                for call in self.processor._es.bulk.call_args_list
+            ),
+            sorted(
+                json.dumps(
+                    self.processor.get_bulk_ops(changes),
+                    sort_keys=True
+                )
+                for changes in sub_bulks
+            )
+        )
+        self.assertEqual(
+            self.processor._metrics.timer.call_args_list,
+            [mock.call('es_bulk')] * len(sub_bulks)
+        )
+
+    def test_errors(self):
+        self.processor._es.bulk = mock.MagicMock(
+            name='bulk',
+            side_effect=lambda body, **kwargs: self.get_bulk_response(
+                body,
+                status=400
+            )
+        )
+
+        self.assertRaises(
+            cchain.processors.exceptions.ProcessingError,
+            self.processor.persist_changes,
+            self.processed_changes
+        )
+
+
+class VersionedESChangesProcessorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = (
+            cchain.processors.es.SimpleESChangesProcessor(
+                ['http://localhost:5984'],
+                'test_index',
+                'test_type',
+                versioning='rev'
+            )
+        )
+        self.samples = samples.CHANGES_DOCS
+
+    def test_get_ops_for_bulk_change(self):
+        doc, rev, seq = self.processor.process_change_line(self.samples[0])
+        bulk_ops = self.processor.get_ops_for_bulk(doc)
+
+        expected_bulk_ops = [
+            {
+                'index': {
+                    '_type': 'test_type',
+                    '_id': '6478c2ae800dfc387396d14e1fc39626',
+                    '_index': 'test_index',
+                    '_version': 2,
+                    '_version_type': 'external',
+                }
+            },
+            {
+                '_seq': 6,
+                '_rev': '2-7051cbe5c8faecd085a3fa619e6e6337',
+            },
+        ]
+
+        self.assertEqual(bulk_ops, expected_bulk_ops)
+
+    def test_get_ops_for_bulk_deletion(self):
+        doc, rev, seq = self.processor.process_change_line(self.samples[1])
+        bulk_ops = self.processor.get_ops_for_bulk(doc)
+
+        self.assertEqual(bulk_ops[0]['delete']['_version'], 3)
+
+    def test_version_by_seq(self):
+        processor = cchain.processors.es.SimpleESChangesProcessor(
+            ['http://localhost:5984'],
+            'test_index',
+            'test_type',
+            versioning='seq'
+        )
+
+        self.assertEqual(processor.get_version({'_seq': '11-g1AAAA'}), 11)
+        self.assertEqual(processor.get_version({'_seq': 11}), 11)
+
+    def test_stale_versions_ignored(self):
+        processed_changes, seq = self.processor.process_changes(self.samples)
+
+        self.processor._es.bulk = mock.MagicMock(
+            name='bulk',
+            return_value={
+                'errors': True,
+                'items': [
+                    {'index': {
+                        'status': 409,
+                        'error': {'type': 'version_conflict_engine_exception'},
+                    }},
+                    {'delete': {'status': 200}},
+                    {'index': {'status': 201}},
+                ],
+            }
+        )
+
+        self.assertFalse(
+            self.processor.has_errors(self.processor._es.bulk.return_value)
+        )
+
+        try:
+            self.processor.persist_changes(processed_changes)
+        except cchain.processors.exceptions.ProcessingError:
+            self.fail('Stale versions were treated as errors.')
+
+        self.assertEqual(self.processor._es.bulk.call_count, 1)
+
+    def test_other_errors(self):
+        processed_changes, seq = self.processor.process_changes(self.samples)
+
+        self.processor._es.bulk = mock.MagicMock(
+            name='bulk',
+            return_value={
+                'errors': True,
+                'items': [
+                    {'index': {
+                        'status': 409,
+                        'error': {'type': 'version_conflict_engine_exception'},
+                    }},
+                    {'delete': {'status': 200}},
+                    {'index': {
+                        'status': 400,
+                        'error': {'type': 'mapper_parsing_exception'},
+                    }},
+                ],
+            }
+        )
+
+        self.assertTrue(
+            self.processor.has_errors(self.processor._es.bulk.return_value)
+        )
+        self.assertRaises(
+            cchain.processors.exceptions.ProcessingError,
+            self.processor.persist_changes,
+            processed_changes
         )
@@ -0,0 +1,282 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import botocore.exceptions
+import cchain
+import mock
+
+from . import mixins
+from . import samples
+
+
+class FakeS3Object(object):
+    """A stand-in for boto3's s3 objects, storing data in a dict.
+
+    """
+
+    def __init__(self, objects, key):
+        self._objects = objects
+        self.key = key
+        self.e_tag = None
+
+    def put(self, Body, **kwargs):
+        if not isinstance(Body, bytes):
+            Body = Body.encode('utf-8')
+        self._objects[self.key] = (Body, kwargs)
+
+        return {
+            'ETag': self.get_etag(Body),
+        }
+
+    def get_etag(self, body):
+        return '"%s"' % hashlib.md5(body).hexdigest()
+
+    def load(self):
+        if self.key not in self._objects:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': '404'}},
+                'HeadObject'
+            )
+
+        body, kwargs = self._objects[self.key]
+        self.e_tag = self.get_etag(body)
+
+    def get(self, Range=None):
+        body, kwargs = self._objects[self.key]
+
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            body = body[int(start):int(end) + 1]
+
+        return {
+            'Body': io.BytesIO(body),
+        }
+
+
+class FakeS3Bucket(object):
+
+    def __init__(self):
+        self.objects = {}
+
+    def Object(self, key):
+        return FakeS3Object(self.objects, key)
+
+
+class SimpleS3ChangesProcessorTestCase(
+    unittest.TestCase,
+    mixins.ProcessChangesTestMixin
+):
+
+    def setUp(self):
+        with mock.patch('boto3.resource'):
+            self.processor = cchain.processors.s3.SimpleS3ChangesProcessor(
+                'test_bucket'
+            )
+        self.processor._bucket = FakeS3Bucket()
+        self.samples = samples.CHANGES_DOCS
+
+    def tearDown(self):
+        self.processor.cleanup()
+
+    def test_process_changes(self):
+        super(
+            SimpleS3ChangesProcessorTestCase,
+            self
+        ).test_process_changes()
+
+        self.assertEqual(
+            sorted(self.processor._bucket.objects),
+            sorted(
+                '%s/%s' % (sample['id'], sample['changes'][0]['rev'])
+                for sample in self.samples
+            )
+        )
+
+
+class ArchivingS3ChangesProcessorTestCase(
+    unittest.TestCase,
+    mixins.ProcessChangesTestMixin
+):
+
+    def setUp(self):
+        with mock.patch('boto3.resource'):
+            self.processor = cchain.processors.s3.SimpleS3ChangesProcessor(
+                'test_bucket',
+                archive_batches=True
+            )
+        self.processor._bucket = FakeS3Bucket()
+        self.samples = samples.CHANGES_DOCS
+
+    def tearDown(self):
+        self.processor.cleanup()
+
+    def test_process_changes(self):
+        super(
+            ArchivingS3ChangesProcessorTestCase,
+            self
+        ).test_process_changes()
+
+        self.assertEqual(
+            sorted(self.processor._bucket.objects),
+            [
+                'batches/6-11.jsonl.gz',
+                'batches/6-11.jsonl.gz.index.json',
+            ]
+        )
+
+    def test_get_s3_archive_key_name(self):
+        first_seq = '12-' + 'g1AAAAFTeJzLYWBg4MhgTmHgz8tPSTV0' * 10
+        last_seq = '20-' + 'g1AAAAFTeJzLYWBg4MhgTmHgz8tPSTV1' * 10
+
+        key_name = self.processor.get_s3_archive_key_name(first_seq, last_seq)
+
+        self.assertRegex(
+            key_name,
+            r'^batches/12-[0-9a-f]{12}-20-[0-9a-f]{12}\.jsonl\.gz$'
+        )
+        self.assertNotEqual(
+            key_name,
+            self.processor.get_s3_archive_key_name(first_seq, first_seq)
+        )
+
+    def test_get_archived_doc(self):
+        processed_changes, seq = self.processor.process_changes(self.samples)
+        self.processor.persist_changes(processed_changes)
+
+        archive_key_name = 'batches/6-11.jsonl.gz'
+        index = self.processor.get_archive_index(archive_key_name)
+
+        self.assertEqual(
+            [(entry['id'], entry['seq']) for entry in index],
+            [(sample['id'], sample['seq']) for sample in self.samples]
+        )
+
+        for entry, (doc, rev, seq) in zip(index, processed_changes):
+            self.assertEqual(
+                self.processor.get_archived_doc(archive_key_name, entry),
+                doc
+            )
+
+
+class DeduplicatingS3ChangesProcessorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.hash_index_path = os.path.join(self.temp_dir, 'hashes')
+        self.bucket = FakeS3Bucket()
+        self.samples = samples.CHANGES_DOCS
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_processor(self, **kwargs):
+        with mock.patch('boto3.resource'):
+            processor = cchain.processors.s3.SimpleS3ChangesProcessor(
+                'test_bucket',
+                hash_index_path=self.hash_index_path,
+                **kwargs
+            )
+        processor._bucket = self.bucket
+
+        return processor
+
+    def persist_samples(self, processor, samples):
+        processed_changes, seq = processor.process_changes(samples)
+        processor.persist_changes(processed_changes)
+        processor.cleanup()
+
+    def test_skip_uploaded(self):
+        self.persist_samples(self.get_processor(), self.samples)
+
+        # Replay the changes with different seqs after a restart.
+        replayed_samples = []
+        for sample in self.samples:
+            replayed_sample = dict(sample)
+            replayed_sample['seq'] = sample['seq'] + 100
+            replayed_samples.append(replayed_sample)
+
+        processor = self.get_processor()
+        with mock.patch.object(FakeS3Object, 'put') as put:
+            self.persist_samples(processor, replayed_samples)
+
+        self.assertFalse(put.called)
+
+    def test_verify_etags(self):
+        self.persist_samples(self.get_processor(), self.samples)
+
+        missing_key = '%s/%s' % (
+            self.samples[0]['id'],
+            self.samples[0]['changes'][0]['rev'],
+        )
+        del self.bucket.objects[missing_key]
+
+        self.persist_samples(
+            self.get_processor(verify_etags=True),
+            self.samples
+        )
+
+        self.assertIn(missing_key, self.bucket.objects)
+
+
+class ByteBudgetTestCase(unittest.TestCase):
+
+    def test_acquire_release(self):
+        budget = cchain.processors.s3.ByteBudget(10)
+        acquired = threading.Event()
+
+        budget.acquire(6)
+
+        def acquire():
+            budget.acquire(6)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+
+        self.assertFalse(acquired.wait(0.1))
+
+        budget.release(6)
+        thread.join(5)
+
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(budget.bytes_in_flight, 6)
+
+    def test_oversized_item(self):
+        budget = cchain.processors.s3.ByteBudget(10)
+
+        budget.acquire(20)
+
+        self.assertEqual(budget.bytes_in_flight, 20)
+
+
+class BudgetedS3ChangesProcessorTestCase(
+    unittest.TestCase,
+    mixins.ProcessChangesTestMixin
+):
+
+    def setUp(self):
+        with mock.patch('boto3.resource'):
+            self.processor = cchain.processors.s3.SimpleS3ChangesProcessor(
+                'test_bucket',
+                max_workers=2,
+                max_bytes_in_flight=100
+            )
+        self.processor._bucket = FakeS3Bucket()
+        self.samples = samples.CHANGES_DOCS
+
+    def tearDown(self):
+        self.processor.cleanup()
+
+    def test_process_changes(self):
+        super(
+            BudgetedS3ChangesProcessorTestCase,
+            self
+        ).test_process_changes()
+
+        self.assertEqual(len(self.processor._bucket.objects), 3)
+        self.assertEqual(self.processor._upload_budget.bytes_in_flight, 0)
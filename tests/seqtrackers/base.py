@@ -0,0 +1,269 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+import cchain
+import mock
+import pycouchdb
+
+
+class FilebasedSeqTrackerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.file_path = os.path.join(self.temp_dir, 'test.seq')
+
+    def test_get_seq_empty(self):
+        seqtracker = cchain.seqtrackers.base.FilebasedSeqTracker(
+            self.file_path
+        )
+
+        self.assertEqual(seqtracker.get_seq(), '')
+
+    def test_put_seq(self):
+        seqtracker = cchain.seqtrackers.base.FilebasedSeqTracker(
+            self.file_path
+        )
+
+        seqtracker.put_seq('12-abc')
+        seqtracker.put_seq(13)
+        seqtracker.cleanup()
+
+        seqtracker = cchain.seqtrackers.base.FilebasedSeqTracker(
+            self.file_path
+        )
+
+        self.assertEqual(seqtracker.get_seq(), '13')
+        # No temporary files are left behind.
+        self.assertEqual(os.listdir(self.temp_dir), ['test.seq'])
+
+    def test_put_seq_keeps_mode(self):
+        seqtracker = cchain.seqtrackers.base.FilebasedSeqTracker(
+            self.file_path
+        )
+        os.chmod(self.file_path, 0o644)
+
+        seqtracker.put_seq('12-abc')
+
+        self.assertEqual(
+            stat.S_IMODE(os.stat(self.file_path).st_mode),
+            0o644
+        )
+
+    def test_put_seq_failure(self):
+        seqtracker = cchain.seqtrackers.base.FilebasedSeqTracker(
+            self.file_path
+        )
+        seqtracker.put_seq('1')
+
+        with mock.patch('os.replace', side_effect=OSError):
+            with self.assertRaises(OSError):
+                seqtracker.put_seq('2')
+
+        self.assertEqual(seqtracker.get_seq(), '1')
+        self.assertEqual(os.listdir(self.temp_dir), ['test.seq'])
+
+
+class DebouncedSeqTrackerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.inner_seqtracker = mock.MagicMock(name='seqtracker')
+
+        patcher = mock.patch('cchain.seqtrackers.base.time')
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.monotonic.return_value = 100
+
+    def test_batches(self):
+        seqtracker = cchain.seqtrackers.base.DebouncedSeqTracker(
+            self.inner_seqtracker,
+            batches=3
+        )
+
+        for seq in range(1, 8):
+            seqtracker.put_seq(seq)
+
+        self.assertEqual(
+            self.inner_seqtracker.put_seq.call_args_list,
+            [mock.call(3), mock.call(6)]
+        )
+        self.assertEqual(seqtracker.get_seq(), 7)
+
+        seqtracker.cleanup()
+
+        self.inner_seqtracker.put_seq.assert_called_with(7)
+        self.inner_seqtracker.cleanup.assert_called_once_with()
+
+    def test_interval(self):
+        seqtracker = cchain.seqtrackers.base.DebouncedSeqTracker(
+            self.inner_seqtracker,
+            interval=10
+        )
+
+        seqtracker.put_seq(1)
+        self.time.monotonic.return_value = 105
+        seqtracker.put_seq(2)
+
+        self.assertFalse(self.inner_seqtracker.put_seq.called)
+
+        self.time.monotonic.return_value = 110
+        seqtracker.put_seq(3)
+
+        self.inner_seqtracker.put_seq.assert_called_once_with(3)
+
+    def test_no_policy(self):
+        seqtracker = cchain.seqtrackers.base.DebouncedSeqTracker(
+            self.inner_seqtracker
+        )
+
+        seqtracker.put_seq(1)
+
+        self.inner_seqtracker.put_seq.assert_called_once_with(1)
+
+    def test_get_seq_without_pending(self):
+        self.inner_seqtracker.get_seq.return_value = '5'
+
+        seqtracker = cchain.seqtrackers.base.DebouncedSeqTracker(
+            self.inner_seqtracker,
+            batches=10
+        )
+
+        self.assertEqual(seqtracker.get_seq(), '5')
+
+    def test_cleanup_without_pending(self):
+        seqtracker = cchain.seqtrackers.base.DebouncedSeqTracker(
+            self.inner_seqtracker,
+            batches=10
+        )
+
+        seqtracker.cleanup()
+
+        self.assertFalse(self.inner_seqtracker.put_seq.called)
+        self.inner_seqtracker.cleanup.assert_called_once_with()
+
+
+class DebouncedSeqTrackerTimerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.inner_seqtracker = mock.MagicMock(name='seqtracker')
+
+    def test_idle_feed(self):
+        seqtracker = cchain.seqtrackers.base.DebouncedSeqTracker(
+            self.inner_seqtracker,
+            interval=0.05
+        )
+        self.addCleanup(seqtracker.cleanup)
+
+        seqtracker.put_seq(1)
+        seqtracker.put_seq(2)
+
+        deadline = time.monotonic() + 5
+        while not self.inner_seqtracker.put_seq.called:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+        self.inner_seqtracker.put_seq.assert_called_once_with(2)
+
+    def test_cleanup_cancels_timer(self):
+        seqtracker = cchain.seqtrackers.base.DebouncedSeqTracker(
+            self.inner_seqtracker,
+            interval=60
+        )
+
+        seqtracker.put_seq(1)
+        timer = seqtracker._timer
+        seqtracker.cleanup()
+
+        self.inner_seqtracker.put_seq.assert_called_once_with(1)
+        timer.join(1)
+        self.assertFalse(timer.is_alive())
+
+
+class CouchDBLocalSeqTrackerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('pycouchdb.Server')
+        server_class = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.couchdb = server_class.return_value.database.return_value
+        self.couchdb.get.side_effect = pycouchdb.exceptions.NotFound
+        self.seq_resource = self.couchdb.resource.return_value
+
+    def get_seqtracker(self):
+        return cchain.seqtrackers.base.CouchDBLocalSeqTracker(
+            'http://localhost:5984',
+            'test_db',
+            'test_seq'
+        )
+
+    def test_get_seq(self):
+        self.couchdb.get.side_effect = None
+        self.couchdb.get.return_value = {
+            '_id': '_local/test_seq',
+            '_rev': '0-1',
+            'seq': '10-abc',
+        }
+
+        seqtracker = self.get_seqtracker()
+
+        self.couchdb.get.assert_called_once_with('_local/test_seq')
+        self.assertEqual(seqtracker.get_seq(), '10-abc')
+
+    def test_put_seq(self):
+        self.seq_resource.put.side_effect = [
+            (None, {'ok': True, 'rev': '0-1'}, ),
+            (None, {'ok': True, 'rev': '0-2'}, ),
+        ]
+
+        seqtracker = self.get_seqtracker()
+        seqtracker.put_seq('1-abc')
+        seqtracker.put_seq('2-abc')
+
+        self.couchdb.resource.assert_called_with('_local', 'test_seq')
+        self.assertEqual(
+            [
+                json.loads(call[1]['data'])
+                for call in self.seq_resource.put.call_args_list
+            ],
+            [
+                {'_id': '_local/test_seq', 'seq': '1-abc'},
+                {'_id': '_local/test_seq', '_rev': '0-1', 'seq': '2-abc'},
+            ]
+        )
+        self.assertEqual(seqtracker.get_seq(), '2-abc')
+
+    def test_put_seq_conflict(self):
+        self.seq_resource.put.side_effect = [
+            pycouchdb.exceptions.Conflict,
+            (None, {'ok': True, 'rev': '0-6'}, ),
+        ]
+        self.seq_resource.get.return_value = (
+            None,
+            {'_id': '_local/test_seq', '_rev': '0-5', 'seq': '3-abc'},
+        )
+
+        seqtracker = self.get_seqtracker()
+        seqtracker.put_seq('4-abc')
+
+        self.assertEqual(
+            json.loads(self.seq_resource.put.call_args[1]['data']),
+            {'_id': '_local/test_seq', '_rev': '0-5', 'seq': '4-abc'}
+        )
+        self.assertEqual(seqtracker._seq_doc['_rev'], '0-6')
+
+    def test_put_seq_too_many_conflicts(self):
+        self.seq_resource.put.side_effect = pycouchdb.exceptions.Conflict
+        self.seq_resource.get.return_value = (None, {'_rev': '0-5'}, )
+
+        seqtracker = self.get_seqtracker()
+
+        with self.assertRaises(pycouchdb.exceptions.Conflict):
+            seqtracker.put_seq('4-abc')
+
+        self.assertEqual(self.seq_resource.put.call_count, 4)
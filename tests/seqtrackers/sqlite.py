@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import cchain
+
+
+class SQLiteSeqTrackerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.file_path = os.path.join(self.temp_dir, 'seqs.db')
+
+    def get_seqtracker(self, pipeline_name, **kwargs):
+        seqtracker = cchain.seqtrackers.sqlite.SQLiteSeqTracker(
+            self.file_path,
+            pipeline_name,
+            **kwargs
+        )
+        return seqtracker
+
+    def test_get_seq_empty(self):
+        seqtracker = self.get_seqtracker('es')
+
+        self.assertEqual(seqtracker.get_seq(), '')
+        self.assertIsNone(seqtracker.get_stats())
+
+        seqtracker.cleanup()
+
+    def test_put_seq(self):
+        es_seqtracker = self.get_seqtracker('es')
+        s3_seqtracker = self.get_seqtracker('s3')
+
+        es_seqtracker.record_changes(10)
+        es_seqtracker.put_seq('10-abc')
+        es_seqtracker.record_changes(5)
+        es_seqtracker.put_seq('15-abc')
+        s3_seqtracker.put_seq(3)
+
+        es_seqtracker.cleanup()
+        s3_seqtracker.cleanup()
+
+        es_seqtracker = self.get_seqtracker('es')
+        s3_seqtracker = self.get_seqtracker('s3')
+
+        self.assertEqual(es_seqtracker.get_seq(), '15-abc')
+        self.assertEqual(s3_seqtracker.get_seq(), 3)
+
+        stats = es_seqtracker.get_stats()
+
+        self.assertEqual(stats['seq'], '15-abc')
+        self.assertEqual(stats['checkpoints'], 2)
+        self.assertEqual(stats['changes'], 15)
+        self.assertIsInstance(stats['updated_at'], float)
+
+        es_seqtracker.cleanup()
+        s3_seqtracker.cleanup()
+
+    def test_commit_every(self):
+        seqtracker = self.get_seqtracker('es', commit_every=2)
+        reader = self.get_seqtracker('es')
+
+        seqtracker.put_seq('1-abc')
+        self.assertEqual(reader.get_seq(), '')
+
+        seqtracker.put_seq('2-abc')
+        self.assertEqual(reader.get_seq(), '2-abc')
+
+        seqtracker.put_seq('3-abc')
+        seqtracker.cleanup()
+        self.assertEqual(reader.get_seq(), '3-abc')
+
+        reader.cleanup()
+
+    def test_commit_every_shared_file(self):
+        es_seqtracker = self.get_seqtracker('es', commit_every=3, timeout=0.1)
+        s3_seqtracker = self.get_seqtracker('s3', commit_every=3, timeout=0.1)
+
+        # Neither tracker keeps a transaction open between its commits,
+        # so they don't lock each other out.
+        for seq in range(1, 8):
+            es_seqtracker.record_changes(1)
+            es_seqtracker.put_seq(seq)
+            self.assertFalse(es_seqtracker._connection.in_transaction)
+
+            s3_seqtracker.record_changes(2)
+            s3_seqtracker.put_seq(seq * 10)
+            self.assertFalse(s3_seqtracker._connection.in_transaction)
+
+        self.assertEqual(es_seqtracker.get_seq(), 7)
+        self.assertEqual(es_seqtracker.get_stats()['seq'], 6)
+
+        es_seqtracker.cleanup()
+        s3_seqtracker.cleanup()
+
+        es_seqtracker = self.get_seqtracker('es')
+        s3_seqtracker = self.get_seqtracker('s3')
+
+        es_stats = es_seqtracker.get_stats()
+        s3_stats = s3_seqtracker.get_stats()
+
+        self.assertEqual(
+            (es_stats['seq'], es_stats['checkpoints'], es_stats['changes'], ),
+            (7, 7, 7, )
+        )
+        self.assertEqual(
+            (s3_stats['seq'], s3_stats['checkpoints'], s3_stats['changes'], ),
+            (70, 7, 14, )
+        )
+
+        es_seqtracker.cleanup()
+        s3_seqtracker.cleanup()
@@ -3,11 +3,51 @@
 import unittest
 
 
+from .consumers.aio import AsyncChangesConsumerTestCase
+from .consumers.base import BackfillChangesConsumerTestCase
+from .consumers.base import FeedFilterChangesConsumerTestCase
+from .consumers.fanout import FanOutChangesConsumerTestCase
+from .consumers.fanout import FanOutFeedReaderTestCase
+from .consumers.fanout import FanOutSeqTrackerTestCase
+from .consumers.mp import DeadPersisterTestCase
+from .consumers.mp import MPFeedReaderTestCase
+from .consumers.mp import PartitionedMPFeedReaderTestCase
+from .consumers.pipelined import PipelinedFeedReaderTestCase
+from .metrics.base import BaseMetricsSinkTestCase
+from .metrics.base import InstrumentedFeedReaderTestCase
+from .metrics.prometheus import PrometheusMetricsSinkTestCase
+from .metrics.statsd import StatsdMetricsSinkTestCase
+from .processors.aio import AsyncSimpleCouchdbChangesProcessorTestCase
+from .processors.aio import AsyncSimpleESChangesProcessorTestCase
+from .processors.aio import AsyncSimpleS3ChangesProcessorTestCase
 from .processors.base import BaseChangesProcessorTestCase
+from .processors.base import BaseDocChangesProcessorCopyTestCase
 from .processors.base import BaseDocChangesProcessorTestCase
 from .processors.base import BaseDocWithSeqChangesProcessorTestCase
+from .processors.base import CoalescingChangesProcessorTestCase
+from .processors.base import FeedFilterChangesProcessorTestCase
+from .processors.base import NoSuperChangesProcessorTestCase
+from .processors.couchdb import ReplicatingCouchdbChangesProcessorTestCase
+from .processors.couchdb import RevisionCacheTestCase
 from .processors.couchdb import SimpleCouchdbChangesProcessorTestCase
+from .processors.entity import RedisEntityProcessorTestCase
+from .processors.entity import RedisStreamProcessorTestCase
+from .processors.es import BulkBodyBuilderTestCase
+from .processors.es import ConcurrentESChangesProcessorTestCase
+from .processors.es import MaxBulkBytesESChangesProcessorTestCase
+from .processors.es import SimpleESChangesProcessorRetryTestCase
 from .processors.es import SimpleESChangesProcessorTestCase
+from .processors.es import VersionedESChangesProcessorTestCase
+from .processors.s3 import ArchivingS3ChangesProcessorTestCase
+from .processors.s3 import BudgetedS3ChangesProcessorTestCase
+from .processors.s3 import ByteBudgetTestCase
+from .processors.s3 import DeduplicatingS3ChangesProcessorTestCase
+from .processors.s3 import SimpleS3ChangesProcessorTestCase
+from .seqtrackers.base import CouchDBLocalSeqTrackerTestCase
+from .seqtrackers.base import DebouncedSeqTrackerTestCase
+from .seqtrackers.base import DebouncedSeqTrackerTimerTestCase
+from .seqtrackers.base import FilebasedSeqTrackerTestCase
+from .seqtrackers.sqlite import SQLiteSeqTrackerTestCase
 
 
 if __name__ == '__main__':